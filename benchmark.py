@@ -0,0 +1,484 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+# server.py builds a Spotify client and opens the feature cache on import.
+# The client is replaced by MockSpotify below and the cache stays in memory.
+os.environ.setdefault("CLIENT_ID", "benchmark")
+os.environ.setdefault("CLIENT_SECRET", "benchmark")
+os.environ.setdefault("FEATURE_CACHE_PATH", ":memory:")
+
+import numpy as np
+
+import server
+
+# Playlist sizes benchmarked by default
+DEFAULT_SIZES = [100, 1000, 5000, 20000]
+
+# Largest sizes the quadratic paths run at by default: the dense cost matrix
+# and the Flask endpoints, which build one
+MATRIX_MAX_TRACKS = 5000
+ENDPOINT_MAX_TRACKS = 5000
+
+# Largest size the cost engine's nearest-neighbour extraction runs at by
+# default. It scores every pair but never holds the whole matrix.
+ENGINE_MAX_TRACKS = 20000
+
+# Neighbours per song the cost engine extracts
+ENGINE_NEIGHBOURS = 10
+
+# evaluate_transition calls timed per size
+TRANSITION_PAIRS = 20000
+
+# Tempo clusters (weight, mean BPM, spread) roughly following what popular
+# playlists contain
+TEMPO_CLUSTERS = [(0.3, 122, 6), (0.25, 100, 12), (0.2, 140, 10), (0.15, 170, 8), (0.1, 80, 8)]
+
+
+def synthetic_audio_features(rng, track_id):
+    # Same shape as a Spotify /audio-features item, with feature
+    # distributions close to those of real catalog tracks
+    _, tempo, spread = rng.choices(TEMPO_CLUSTERS, weights=[c[0] for c in TEMPO_CLUSTERS])[0]
+    return {
+        "danceability": rng.betavariate(5, 3),
+        "energy": rng.betavariate(4, 2.5),
+        "key": -1 if rng.random() < 0.01 else rng.randrange(12),
+        "loudness": min(0.0, max(-60.0, rng.gauss(-8, 3.5))),
+        "mode": 1 if rng.random() < 0.62 else 0,
+        "speechiness": rng.betavariate(1, 10),
+        "acousticness": rng.betavariate(1, 3),
+        "instrumentalness": rng.betavariate(0.5, 5),
+        "liveness": rng.betavariate(2, 10),
+        "valence": rng.betavariate(2.5, 2.5),
+        "tempo": min(220.0, max(50.0, rng.gauss(tempo, spread))),
+        "type": "audio_features",
+        "id": track_id,
+        "uri": "spotify:track:" + track_id,
+        "track_href": "https://api.spotify.com/v1/tracks/" + track_id,
+        "analysis_url": "https://api.spotify.com/v1/audio-analysis/" + track_id,
+        "duration_ms": rng.randrange(120000, 360000),
+        "time_signature": 4,
+    }
+
+
+class SyntheticLibrary:
+    # Tracks and artists for the benchmarks, the same for a given size and seed
+
+    def __init__(self, n_tracks, seed=0):
+        rng = random.Random(seed)
+        genres = ["genre %d" % i for i in range(300)]
+        self.artists = {}
+        for i in range(max(1, n_tracks // 10)):
+            self.artists["artist%06d" % i] = rng.sample(genres, rng.randrange(1, 12))
+        artist_ids = list(self.artists)
+
+        self.tracks = {}
+        for i in range(n_tracks):
+            track_id = "%022d" % i
+            self.tracks[track_id] = (
+                synthetic_audio_features(rng, track_id), "Track %d" % i, rng.choice(artist_ids))
+        self.track_uris = ["spotify:track:" + track_id for track_id in self.tracks]
+
+    def songs(self):
+        artist_bits = {artist_id: server.genre_vocabulary.bits(genres)
+                       for artist_id, genres in self.artists.items()}
+        return [server.Song(audio_features, self.artists[artist_id], artist_bits[artist_id], name)
+                for audio_features, name, artist_id in self.tracks.values()]
+
+
+class MockSpotify:
+    # Answers the Spotify calls server.py makes from a SyntheticLibrary.
+    # Playlist "a" holds every track in library order, "b" the second half of
+    # them followed by the first half reversed.
+
+    def __init__(self, library):
+        self.library = library
+        uris = library.track_uris
+        half = len(uris) // 2
+        self.playlists = {"a": list(uris), "b": uris[half:] + uris[:half][::-1]}
+        self.snapshots = {"a": 0, "b": 0}
+
+    def _track(self, track_id):
+        track_id = track_id.split(":")[-1]
+        audio_features, name, artist_id = self.library.tracks[track_id]
+        return {
+            "id": track_id,
+            "uri": "spotify:track:" + track_id,
+            "name": name,
+            "duration_ms": audio_features["duration_ms"],
+            "popularity": 50,
+            "artists": [{"id": artist_id, "name": "Artist " + artist_id}],
+            "album": {"name": "Album", "images": [{"url": "https://i.scdn.co/image/" + track_id}]},
+        }
+
+    def track(self, track_id):
+        return self._track(track_id)
+
+    def tracks(self, track_ids):
+        return {"tracks": [self._track(track_id) for track_id in track_ids]}
+
+    def audio_features(self, track_ids):
+        if isinstance(track_ids, str):
+            track_ids = [track_ids]
+        return [self.library.tracks[track_id.split(":")[-1]][0] for track_id in track_ids]
+
+    def artist_related_artists(self, artist_id):
+        genres = self.library.artists[artist_id]
+        return {"artists": [{"genres": genres[i::3]} for i in range(3)]}
+
+    def playlist(self, playlist_id, fields=None):
+        return {"snapshot_id": "%s-%d" % (playlist_id, self.snapshots[playlist_id])}
+
+    def playlist_tracks(self, playlist_id, fields=None, limit=100, offset=0):
+        uris = self.playlists[playlist_id]
+        return {
+            "items": [{"track": {"uri": uri, "id": uri.split(":")[-1]}} for uri in uris[offset:offset + limit]],
+            "total": len(uris),
+        }
+
+    def _changed(self, playlist_id):
+        self.snapshots[playlist_id] += 1
+        return self.playlist(playlist_id)
+
+    def playlist_reorder_items(self, playlist_id, range_start, insert_before, range_length=1, snapshot_id=None):
+        uris = self.playlists[playlist_id]
+        block = uris[range_start:range_start + range_length]
+        if insert_before > range_start:
+            uris = uris[:range_start] + uris[range_start + range_length:insert_before] + block + uris[insert_before:]
+        else:
+            uris = uris[:insert_before] + block + uris[insert_before:range_start] + uris[range_start + range_length:]
+        self.playlists[playlist_id] = uris
+        return self._changed(playlist_id)
+
+    def playlist_add_items(self, playlist_id, items, position=None):
+        self.playlists[playlist_id] = self.playlists[playlist_id] + list(items)
+        return self._changed(playlist_id)
+
+    def playlist_remove_specific_occurrences_of_items(self, playlist_id, items, snapshot_id=None):
+        positions = {position for item in items for position in item["positions"]}
+        self.playlists[playlist_id] = [uri for position, uri in enumerate(self.playlists[playlist_id])
+                                       if position not in positions]
+        return self._changed(playlist_id)
+
+
+def percentile(values, q):
+    # Nearest-rank percentile
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(np.ceil(q / 100 * len(values))) - 1))]
+
+
+def measure(run, repeats, items):
+    # Peak memory from one traced run, which also warms caches, then the
+    # latency of each of the untraced runs after it
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies, items, peak)
+
+
+def summarize(latencies, items, peak_bytes):
+    p50 = percentile(latencies, 50)
+    return {
+        "repeats": len(latencies),
+        "p50_seconds": p50,
+        "p99_seconds": percentile(latencies, 99),
+        "mean_seconds": sum(latencies) / len(latencies),
+        "throughput": items / p50 if p50 else None,
+        "peak_bytes": peak_bytes,
+    }
+
+
+def dict_song_data(audio_features, genres, genre_bits, track_name):
+    # song_data as get_song_data built it before Song existed
+    song_data = audio_features.copy()
+    song_data["genre"] = genres
+    song_data["genre_bits"] = genre_bits
+    song_data["track_name"] = track_name
+    return song_data
+
+
+def measure_bytes(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after - before
+
+
+def bench_song_memory(library, args):
+    artist_bits = {artist_id: server.genre_vocabulary.bits(genres)
+                   for artist_id, genres in library.artists.items()}
+    records = [(audio_features, name, library.artists[artist_id], artist_bits[artist_id])
+               for audio_features, name, artist_id in library.tracks.values()]
+    dict_bytes = measure_bytes(lambda: [
+        dict_song_data(audio_features, genres, bits, name)
+        for audio_features, name, genres, bits in records])
+    song_bytes = measure_bytes(lambda: [
+        server.Song(audio_features, genres, bits, name)
+        for audio_features, name, genres, bits in records])
+    n_tracks = len(records)
+    return [{
+        "benchmark": "song_memory",
+        "dict_bytes_per_track": dict_bytes / n_tracks,
+        "song_bytes_per_track": song_bytes / n_tracks,
+        "reduction": 1 - song_bytes / dict_bytes,
+    }]
+
+
+def bench_transitions(library, args):
+    songs = library.songs()
+    rng = random.Random(args.seed)
+    pairs = [(rng.choice(songs), rng.choice(songs)) for _ in range(TRANSITION_PAIRS)]
+
+    latencies = []
+    for song1, song2 in pairs:
+        start = time.perf_counter()
+        server.evaluate_transition(song1, song2)
+        latencies.append(time.perf_counter() - start)
+    result = summarize(latencies, 1, None)
+    result["throughput"] = len(pairs) / sum(latencies)
+    result["throughput_unit"] = "pairs/s"
+    results = [{"benchmark": "evaluate_transition", **result}]
+
+    if len(songs) <= args.matrix_max_tracks:
+        features = server.pack_song_features(songs)
+        result = measure(lambda: server.transition_cost_matrix(features), args.repeat, len(songs) ** 2)
+        results.append({"benchmark": "transition_cost_matrix", "throughput_unit": "pairs/s", **result})
+    return results
+
+
+def mean_intra_cluster_distance(features, clusters):
+    # Mean clustering distance over all pairs of songs in the same cluster
+    total = 0.0
+    pairs = 0
+    for cluster in np.unique(clusters):
+        members = np.flatnonzero(clusters == cluster)
+        total += server.clustering_distances(features, members, members).sum() / 2
+        pairs += len(members) * (len(members) - 1) // 2
+    return total / pairs if pairs else 0.0
+
+
+def bench_clustering(library, args):
+    songs = library.songs()
+    features = server.pack_song_features(songs)
+    n_clusters = min(args.clusters, len(songs))
+    results = []
+    for method in server.CLUSTERING_METHODS:
+        if method == "agglomerative" and len(songs) > server.DENSE_CLUSTERING_LIMIT:
+            continue
+        result = measure(lambda: server.custom_clustering_algorithm(songs, n_clusters, method),
+                         args.repeat, len(songs))
+        clusters = server.custom_clustering_algorithm(songs, n_clusters, method)
+        results.append({
+            "benchmark": "custom_clustering_algorithm",
+            "method": method,
+            "clusters": n_clusters,
+            "throughput_unit": "tracks/s",
+            "mean_intra_cluster_cost": mean_intra_cluster_distance(features, clusters),
+            **result,
+        })
+    return results
+
+
+def bench_similarity(library, args):
+    mock = MockSpotify(library)
+    server.sp = mock
+    playlist1, playlist2 = mock.playlists["a"], mock.playlists["b"]
+    result = measure(lambda: server.calculate_similarity(playlist1, playlist2),
+                     args.repeat, len(playlist1) + len(playlist2))
+    return [{"benchmark": "calculate_similarity", "throughput_unit": "tracks/s", **result}]
+
+
+def bench_cost_engine(library, args):
+    features = server.pack_song_features(library.songs())
+    n_tracks = len(features["tempo"])
+    results = []
+    for workers in args.workers:
+        engine = server.CostEngine(workers=workers)
+        try:
+            runs = []
+            if n_tracks <= args.matrix_max_tracks:
+                runs.append(("matrix", lambda: engine.matrix(features), n_tracks ** 2))
+            if n_tracks <= args.engine_max_tracks:
+                runs.append(("nearest", lambda: engine.nearest(features, ENGINE_NEIGHBOURS), n_tracks ** 2))
+            for name, run, pairs in runs:
+                result = measure(run, args.repeat, pairs)
+                results.append({"benchmark": "cost_engine " + name, "method": "%d workers" % workers,
+                                "throughput_unit": "pairs/s", **result})
+        finally:
+            engine.shutdown()
+    return results
+
+
+def bench_sorts(library, args):
+    song_data_map = dict(zip(library.track_uris, library.songs()))
+    results = []
+    for name, order in (("warmup_order", server.warmup_order), ("cooldown_order", server.cooldown_order)):
+        result = measure(lambda: order(song_data_map), args.repeat, len(song_data_map))
+        results.append({"benchmark": name, "throughput_unit": "tracks/s", **result})
+    for arc in server.ENERGY_ARCS:
+        result = measure(lambda: server.arc_order(song_data_map, arc), args.repeat, len(song_data_map))
+        _, quality = server.arc_order(song_data_map, arc)
+        results.append({"benchmark": "arc_order", "method": arc, "throughput_unit": "tracks/s", **quality, **result})
+    return results
+
+
+def endpoint_requests(mock, args):
+    link = "https://open.spotify.com/playlist/%s?si=benchmark"
+    return {
+        "/optimize_playlist": {"playlist_link": link % "a", "time_budget": args.sequence_budget,
+                               "incremental": False},
+        "/generate_warmup": {"playlist_link": link % "a"},
+        "/generate_cooldown": {"playlist_link": link % "a"},
+        "/b2b_playlist": {"playlist1_link": link % "a", "playlist2_link": link % "b"},
+        "/compare_playlists": {"playlist1_link": link % "a", "playlist2_link": link % "b"},
+        "/find_best_transition": {"playlist_link": link % "a", "single_track": mock.playlists["b"][0], "k": 10},
+        "/reorder_playlist": {"playlist_id": "b", "new_uris": mock.playlists["a"][::-1]},
+        "/optimize_batch": {"playlists": [link % "a", link % "b"], "time_budget": args.sequence_budget,
+                            "incremental": False},
+    }
+
+
+def bench_endpoints(library, args):
+    if len(library.tracks) > args.endpoint_max_tracks:
+        return []
+    mock = MockSpotify(library)
+    server.sp = mock
+    user_client = server.spotify_client
+    server.spotify_client = lambda auth=None: mock
+    client = server.app.test_client()
+    results = []
+    playlist_b = list(mock.playlists["b"])
+    try:
+        for path, body in endpoint_requests(mock, args).items():
+            def run():
+                # Every reorder starts from the same order, not the last result
+                mock.playlists["b"] = list(playlist_b)
+                response = client.post(path, json=body, headers={"Authorization": "Bearer benchmark"})
+                payload = response.get_json()
+                if response.status_code != 200 or "error" in payload:
+                    raise RuntimeError("%s failed: %s" % (path, payload))
+            result = measure(run, args.repeat, len(library.tracks))
+            results.append({"benchmark": "endpoint", "endpoint": path, "throughput_unit": "tracks/s", **result})
+    finally:
+        server.spotify_client = user_client
+    return results
+
+
+BENCHMARKS = {
+    "memory": bench_song_memory,
+    "transitions": bench_transitions,
+    "clustering": bench_clustering,
+    "similarity": bench_similarity,
+    "engine": bench_cost_engine,
+    "sorts": bench_sorts,
+    "endpoints": bench_endpoints,
+}
+
+
+def result_key(result):
+    return (result["benchmark"], result["tracks"], result.get("method"), result.get("endpoint"))
+
+
+def describe(result):
+    name = result["benchmark"]
+    for field in ("method", "endpoint"):
+        if field in result:
+            name += " " + result[field]
+    return "%-40s %6d tracks" % (name, result["tracks"])
+
+
+def print_result(result, baseline=None):
+    line = describe(result)
+    if "p50_seconds" in result:
+        line += "  p50 %9.3g s  p99 %9.3g s" % (result["p50_seconds"], result["p99_seconds"])
+        if result.get("throughput"):
+            line += "  %12.0f %s" % (result["throughput"], result.get("throughput_unit", "items/s"))
+        if result.get("peak_bytes") is not None:
+            line += "  %8.1f MB peak" % (result["peak_bytes"] / 1e6)
+        if baseline and baseline.get("p50_seconds"):
+            line += "  p50 x%.2f vs baseline" % (result["p50_seconds"] / baseline["p50_seconds"])
+    else:
+        line += "  " + ", ".join("%s %.3g" % (key, value) for key, value in result.items()
+                                 if isinstance(value, float))
+    print(line)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the Audify backend")
+    parser.add_argument("benchmarks", nargs="*",
+                        help="benchmarks to run, from %s (default: all)" % ", ".join(BENCHMARKS))
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="comma separated playlist sizes")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per measurement")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--clusters", type=int, default=20)
+    parser.add_argument("--sequence-budget", type=float, default=0.5,
+                        help="time_budget sent to /optimize_playlist")
+    parser.add_argument("--matrix-max-tracks", type=int, default=MATRIX_MAX_TRACKS)
+    parser.add_argument("--endpoint-max-tracks", type=int, default=ENDPOINT_MAX_TRACKS)
+    parser.add_argument("--engine-max-tracks", type=int, default=ENGINE_MAX_TRACKS)
+    parser.add_argument("--workers", default="1,%d" % (os.cpu_count() or 1),
+                        help="comma separated cost engine worker counts")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+    args.workers = sorted(set(int(workers) for workers in args.workers.split(",")))
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error("unknown benchmarks: %s" % ", ".join(unknown))
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {result_key(result): result for result in json.load(f)["results"]}
+
+    results = []
+    for n_tracks in sorted(int(size) for size in args.sizes.split(",")):
+        library = SyntheticLibrary(n_tracks, args.seed)
+        for name in args.benchmarks or BENCHMARKS:
+            for result in BENCHMARKS[name](library, args):
+                result = {"tracks": n_tracks, **result}
+                results.append(result)
+                print_result(result, baseline.get(result_key(result)))
+                sys.stdout.flush()
+
+    if args.output:
+        report = {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "options": vars(args),
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import argparse
+import os
+import sys
+import time
+
+# Importing never talks to Spotify, but server.py builds a client on import
+os.environ.setdefault("CLIENT_ID", "import")
+os.environ.setdefault("CLIENT_SECRET", "import")
+
+import server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Import a local track dataset into a library directory that the "
+                    "server reads with LIBRARY_PATH.")
+    parser.add_argument("dataset", help="CSV, JSON Lines or Parquet file, optionally gzipped (not Parquet)")
+    parser.add_argument("library", help="directory to write the library to")
+    parser.add_argument("--format", choices=sorted(set(server.DATASET_FORMATS.values())),
+                        help="dataset format, by default from the file extension")
+    parser.add_argument("--chunk-size", type=int, default=server.LIBRARY_CHUNK_SIZE,
+                        help="rows read and written at a time")
+    args = parser.parse_args()
+
+    started_at = time.perf_counter()
+    try:
+        result = server.import_library(args.dataset, args.library, args.chunk_size, args.format)
+    except (OSError, ValueError, RuntimeError) as e:
+        sys.exit(f"import failed: {e}")
+
+    print(f"imported {result['tracks']} tracks into {args.library} in "
+          f"{time.perf_counter() - started_at:.1f} s "
+          f"({result['skipped']} rows skipped, {result['duplicates']} duplicate IDs)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import argparse
+import json
+import sys
+
+import server
+
+
+def read_playlists(args):
+    playlists = list(args.playlists)
+    if args.file:
+        f = sys.stdin if args.file == "-" else open(args.file)
+        with f:
+            playlists.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+    return playlists
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Optimize many playlists in one batch, loading the tracks they share once, "
+                    "and write one JSON line per playlist.")
+    parser.add_argument("playlists", nargs="*", help="playlist links or IDs")
+    parser.add_argument("--file", help="file with one playlist link or ID per line, - for stdin")
+    parser.add_argument("--output", help="JSON Lines file to write, by default stdout")
+    parser.add_argument("--time-budget", type=float, default=server.BATCH_TIME_BUDGET,
+                        help="seconds of local search per playlist")
+    parser.add_argument("--no-incremental", action="store_true",
+                        help="don't start from this process's earlier optimizations")
+    args = parser.parse_args()
+
+    playlists = read_playlists(args)
+    if not playlists:
+        parser.error("no playlists given")
+
+    data = {"playlists": playlists, "time_budget": args.time_budget, "incremental": not args.no_incremental}
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        for event in server.optimize_batch_events(data):
+            if event["event"] == "playlist":
+                output.write(json.dumps({key: value for key, value in event.items() if key != "event"}) + "\n")
+            elif event["event"] == "error":
+                sys.exit(f"batch failed: {event['error']}")
+            elif event["event"] == "result":
+                print(f"optimized {event['playlists_optimized']} playlists ({event['playlists_failed']} failed), "
+                      f"{event['tracks_total']} tracks ({event['unique_tracks']} unique) in "
+                      f"{event['seconds']:.1f} s, {event['tracks_per_second']:.0f} tracks/s", file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,33 @@
+import ast
+import bisect
+import csv
+import gzip
 import heapq
-from flask import Flask, request, jsonify
+import itertools
+import multiprocessing
+from flask import Flask, Response, request, jsonify, stream_with_context
 import os
+import json
+import math
+import requests
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
 import spotipy
 from dotenv import load_dotenv
 from spotipy.oauth2 import SpotifyClientCredentials
-from functools import lru_cache
-from concurrent.futures import ThreadPoolExecutor
-from sklearn.cluster import AgglomerativeClustering
+from collections import Counter, OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from scipy.sparse import csr_matrix
+from sklearn.cluster import AgglomerativeClustering, SpectralClustering
 from spotipy.exceptions import SpotifyException
+from urllib3.util.retry import Retry
 import numpy as np
 from flask_cors import CORS
 
@@ -16,53 +36,1147 @@ load_dotenv()
 app = Flask(__name__)
 CORS(app)
 
+# Stage timers, Spotify call counts and pool queue times for /metrics. With
+# METRICS_ENABLED=0 every hook returns straight away. METRICS_TIMING_HEADERS=1
+# also sends each non-streamed response's stage times as a Server-Timing header.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+METRICS_TIMING_HEADERS = os.getenv("METRICS_TIMING_HEADERS", "0") != "0"
+
+# Upper bounds in seconds of the latency histogram buckets
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+METRIC_HELP = {
+    'requests_total': ('counter', "Requests handled, by endpoint and status"),
+    'request_seconds': ('histogram', "Time spent handling a request, by endpoint"),
+    'stage_seconds': ('histogram', "Time one request spent in a stage, by endpoint and stage"),
+    'spotify_calls_total': ('counter', "Spotify API calls, by endpoint and client method"),
+    'executor_queue_seconds': ('histogram', "Time a task waited for a worker, by thread pool"),
+}
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+class StageTimer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record_stage(self.name, time.perf_counter() - self.started_at)
+
+class RequestMetrics:
+    # Stage totals of one request, recorded when it finishes
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.stages = {}
+        self.status = 500
+        self.streamed = False
+        self.started_at = time.perf_counter()
+
+class Metrics:
+    # Process-wide counters and histograms, keyed by metric name and a tuple
+    # of (label, value) pairs. Each thread knows the endpoint it is working
+    # for, so Spotify calls and stages are attributed to the request that
+    # caused them, and adds up its request's stage times until it finishes.
+
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.histograms = {}
+        self.local = threading.local()
+
+    def endpoint(self):
+        return getattr(self.local, 'endpoint', 'other')
+
+    def inc(self, name, labels, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name, labels] += value
+
+    def observe(self, name, labels, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            self._observe(name, labels, seconds)
+
+    def _observe(self, name, labels, seconds):
+        # [count per bucket with +Inf last, sum of the observations]
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[name, labels] = [[0] * (len(METRICS_BUCKETS) + 1), 0.0]
+        histogram[0][bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+
+    def stage(self, name):
+        # Context manager timing one stage of the current request
+        return StageTimer(self, name) if self.enabled else NO_STAGE
+
+    def record_stage(self, name, seconds):
+        current = self.current()
+        if current is None:
+            self.observe('stage_seconds', (('endpoint', self.endpoint()), ('stage', name)), seconds)
+        else:
+            current.stages[name] = current.stages.get(name, 0.0) + seconds
+
+    def current(self):
+        return getattr(self.local, 'request', None)
+
+    def begin(self, endpoint):
+        if self.enabled:
+            self.resume(RequestMetrics(endpoint))
+
+    def resume(self, current):
+        # Continues a request on this thread, such as a response stream
+        if current is not None:
+            self.local.request = current
+            self.local.endpoint = current.endpoint
+
+    def set_status(self, status):
+        current = self.current()
+        if current is not None:
+            current.status = status
+
+    def finish(self):
+        # Records the duration and stage totals of the request this thread ran
+        current = self.current()
+        if current is None:
+            return
+        elapsed = time.perf_counter() - current.started_at
+        endpoint = current.endpoint
+        with self.lock:
+            self.counters['requests_total', (('endpoint', endpoint), ('status', str(current.status)))] += 1
+            self._observe('request_seconds', (('endpoint', endpoint),), elapsed)
+            for name, seconds in current.stages.items():
+                self._observe('stage_seconds', (('endpoint', endpoint), ('stage', name)), seconds)
+        self.local.__dict__.clear()
+
+    def run_as(self, endpoint, function, *args, **kwargs):
+        # Calls function on this thread on behalf of endpoint
+        previous = getattr(self.local, 'endpoint', None)
+        self.local.endpoint = endpoint
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if previous is None:
+                self.local.__dict__.pop('endpoint', None)
+            else:
+                self.local.endpoint = previous
+
+    def server_timing(self):
+        current = self.current()
+        timings = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in current.stages.items()]
+        timings.append(f"total;dur={(time.perf_counter() - current.started_at) * 1000:.1f}")
+        return ', '.join(timings)
+
+    def render(self, prefix='audify_'):
+        # Prometheus text exposition of the counters and histograms
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(counts), total))
+                                for key, (counts, total) in self.histograms.items())
+
+        lines = []
+        for name, (kind, help_text) in METRIC_HELP.items():
+            lines.append(f"# HELP {prefix}{name} {help_text}")
+            lines.append(f"# TYPE {prefix}{name} {kind}")
+            for (metric, labels), value in counters:
+                if metric == name:
+                    lines.append(f"{prefix}{name}{format_labels(labels)} {value}")
+            for (metric, labels), (counts, total) in histograms:
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(METRICS_BUCKETS + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f"{prefix}{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{prefix}{name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{prefix}{name}_count{format_labels(labels)} {cumulative}")
+        return lines
+
+NO_STAGE = nullcontext()
+
+metrics = Metrics()
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    # Thread pool that records how long each task waits for a worker and runs
+    # it on behalf of the endpoint that submitted it
+
+    def __init__(self, name, max_workers):
+        super().__init__(max_workers=max_workers, thread_name_prefix=name)
+        self.name = name
+
+    def submit(self, fn, /, *args, **kwargs):
+        if not metrics.enabled:
+            return super().submit(fn, *args, **kwargs)
+        endpoint = metrics.endpoint()
+        submitted_at = time.perf_counter()
+
+        def run():
+            metrics.observe('executor_queue_seconds', (('pool', self.name),),
+                            time.perf_counter() - submitted_at)
+            return metrics.run_as(endpoint, fn, *args, **kwargs)
+        return super().submit(run)
+
+    def queued(self):
+        return self._work_queue.qsize()
+
 
 client_credentials_manager = SpotifyClientCredentials(
     client_id=os.getenv("CLIENT_ID"),
     client_secret=os.getenv("CLIENT_SECRET"),
 )
 
-sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager)
+# Spotify requests per second across the whole process, the most that may
+# be in flight at once, and how often one request is retried after a 429
+SPOTIFY_RATE_LIMIT = float(os.getenv("SPOTIFY_RATE_LIMIT", 20))
+SPOTIFY_MAX_CONCURRENCY = int(os.getenv("SPOTIFY_MAX_CONCURRENCY", 8))
+SPOTIFY_MAX_RETRIES = int(os.getenv("SPOTIFY_MAX_RETRIES", 5))
+
+# Seconds to back off after a 429 that carries no Retry-After header
+DEFAULT_RETRY_AFTER = 1.0
+
+class SharedSession(requests.Session):
+    # spotipy.Spotify closes its session when it is garbage collected, which
+    # would drop the pooled connections of every client sharing it. This one
+    # lives as long as the process.
+
+    def close(self):
+        pass
+
+def build_spotify_session():
+    # One pooled HTTP session for every Spotify client. Server errors are
+    # retried here like spotipy does by default, but 429s are not, so they
+    # reach the scheduler with their Retry-After header.
+    retry = Retry(total=3, connect=None, read=False, status=3, backoff_factor=0.3,
+                  allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+                  status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=4, pool_maxsize=SPOTIFY_MAX_CONCURRENCY, max_retries=retry)
+    session = SharedSession()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def retry_after_seconds(error):
+    try:
+        return float((error.headers or {}).get('Retry-After'))
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+class SpotifyScheduler:
+    # Process-wide gate every Spotify request passes through. A token bucket
+    # caps the request rate, and the number of requests in flight adapts:
+    # a 429 halves it and makes every request wait out its Retry-After, and
+    # each run of successes as long as the current limit raises it by one.
+
+    def __init__(self, rate=SPOTIFY_RATE_LIMIT, max_concurrency=SPOTIFY_MAX_CONCURRENCY):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.refilled_at = time.monotonic()
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+        self.counters = Counter()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.refilled_at) * self.rate)
+                self.refilled_at = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.in_flight >= self.concurrency:
+                    wait = None
+                elif self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                self.condition.wait(wait)
+
+    def release(self, retry_after=None):
+        with self.condition:
+            self.in_flight -= 1
+            if retry_after is None:
+                self.counters['requests'] += 1
+                self.successes += 1
+                if self.concurrency < self.max_concurrency and self.successes >= self.concurrency:
+                    self.concurrency += 1
+                    self.successes = 0
+            else:
+                self.counters['rate_limited'] += 1
+                self.concurrency = max(1, self.concurrency // 2)
+                self.successes = 0
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            self.condition.notify_all()
+
+    def call(self, function, *args, **kwargs):
+        for attempt in range(SPOTIFY_MAX_RETRIES + 1):
+            self.acquire()
+            try:
+                result = function(*args, **kwargs)
+            except SpotifyException as e:
+                if e.http_status != 429:
+                    self.release()
+                    raise
+                self.release(retry_after_seconds(e))
+                if attempt == SPOTIFY_MAX_RETRIES:
+                    raise
+                continue
+            except BaseException:
+                self.release()
+                raise
+            self.release()
+            return result
+
+    def stats(self):
+        with self.condition:
+            return {
+                "concurrency": self.concurrency,
+                "in_flight": self.in_flight,
+                "paused_for": max(0.0, self.paused_until - time.monotonic()),
+                **self.counters,
+            }
+
+class ScheduledSpotify:
+    # A spotipy client whose API calls all go through the scheduler
+
+    def __init__(self, client, scheduler):
+        self.client = client
+        self.scheduler = scheduler
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute):
+            return attribute
+
+        def scheduled(*args, **kwargs):
+            metrics.inc('spotify_calls_total', (('endpoint', metrics.endpoint()), ('method', name)))
+            return self.scheduler.call(attribute, *args, **kwargs)
+        return scheduled
+
+spotify_session = build_spotify_session()
+spotify_scheduler = SpotifyScheduler()
+
+# Every Spotify fetch runs on this one pool instead of a pool per request
+spotify_executor = InstrumentedExecutor('spotify', SPOTIFY_MAX_CONCURRENCY)
+
+def spotify_client(auth=None):
+    # Scheduled client on the shared session, with the app credentials or,
+    # given auth, a user's access token
+    return ScheduledSpotify(spotipy.Spotify(
+        auth=auth, client_credentials_manager=client_credentials_manager,
+        requests_session=spotify_session), spotify_scheduler)
+
+sp = spotify_client()
+
+class SingleFlight:
+    # Coalesces concurrent fetches of the same IDs across requests: the first
+    # request to ask for an ID fetches it and later ones wait for its result
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def fetch(self, fetch_many, ids):
+        # {id: item} like fetch_many(ids), which gets called only with the IDs
+        # no other request is already fetching
+        owned = {}
+        waiting = {}
+        with self.lock:
+            for item_id in dict.fromkeys(ids):
+                if item_id in self.pending:
+                    waiting[item_id] = self.pending[item_id]
+                else:
+                    owned[item_id] = self.pending[item_id] = Future()
 
-def get_all_playlist_tracks(uri):
-    offset = 0
+        try:
+            items = dict(fetch_many(list(owned))) if owned else {}
+        except BaseException as e:
+            self.finish(owned, {}, e)
+            raise
+        self.finish(owned, items)
+
+        for item_id, future in waiting.items():
+            item = future.result()
+            if item is not None:
+                items[item_id] = item
+        return items
+
+    def finish(self, owned, items, error=None):
+        with self.lock:
+            for item_id in owned:
+                del self.pending[item_id]
+        for item_id, future in owned.items():
+            if error is None:
+                future.set_result(items.get(item_id))
+            else:
+                future.set_exception(error)
+
+track_flights = SingleFlight()
+audio_features_flights = SingleFlight()
+artist_genre_flights = SingleFlight()
+
+# Largest page /playlists/{id}/tracks returns, and the only parts of each
+# item the endpoints read
+PLAYLIST_PAGE_SIZE = 100
+PLAYLIST_TRACK_FIELDS = "items(track(uri,id)),total"
+
+def get_playlist_track_pages(uri, client=None):
+    # Yields (items, total) for each page of a playlist, in order. The first
+    # page gives the total and the remaining pages are all requested
+    # concurrently before it is yielded, so callers work on one page while
+    # every later one loads.
+    client = client or sp
+    with metrics.stage("pagination"):
+        first = client.playlist_tracks(uri, fields=PLAYLIST_TRACK_FIELDS, limit=PLAYLIST_PAGE_SIZE, offset=0)
+    total = first["total"]
+    pages = [spotify_executor.submit(client.playlist_tracks, uri, fields=PLAYLIST_TRACK_FIELDS,
+                                     limit=PLAYLIST_PAGE_SIZE, offset=offset)
+             for offset in range(PLAYLIST_PAGE_SIZE, total, PLAYLIST_PAGE_SIZE)]
+    try:
+        yield first["items"], total
+        for page in pages:
+            with metrics.stage("pagination"):
+                items = page.result()["items"]
+            yield items, total
+    finally:
+        # Don't fetch pages nobody will read if the caller stops early
+        for page in pages:
+            page.cancel()
+
+def get_all_playlist_tracks(uri, client=None):
     tracks = []
+    for items, _ in get_playlist_track_pages(uri, client):
+        tracks.extend(items)
+    return tracks
+
+def playlist_snapshot_id(playlist_link):
+    playlist_id = playlist_link.split("/")[-1].split("?")[0]
+    return sp.playlist(playlist_id, fields="snapshot_id")["snapshot_id"]
+
+FEATURE_CACHE_PATH = os.getenv("FEATURE_CACHE_PATH", "feature_cache.sqlite3")
+
+# Seconds before a cached entry is refetched, 0 keeps entries forever.
+# Audio features never change, genres of related artists occasionally do.
+FEATURE_CACHE_TTLS = {
+    'tracks': float(os.getenv("FEATURE_CACHE_TRACK_TTL", 0)),
+    'artist_genres': float(os.getenv("FEATURE_CACHE_GENRE_TTL", 7 * 24 * 60 * 60)),
+}
+FEATURE_CACHE_MAX_ENTRIES = int(os.getenv("FEATURE_CACHE_MAX_ENTRIES", 200000))
+
+# SQLite's default limit on bound parameters in one statement
+SQLITE_MAX_VARIABLES = 999
+
+class FeatureStore:
+    # Persistent read-through cache for track features and artist genres.
+    # Each table holds at most max_entries rows, evicting the least recently
+    # used ones, and rows older than the table's TTL count as misses.
+
+    def __init__(self, path, ttls, max_entries):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.hits = {table: 0 for table in ttls}
+        self.misses = {table: 0 for table in ttls}
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            for table in ttls:
+                self.db.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} (id TEXT PRIMARY KEY, data TEXT NOT NULL, "
+                    "fetched_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+                self.db.execute(
+                    f"CREATE INDEX IF NOT EXISTS {table}_accessed_at ON {table} (accessed_at)")
+
+    def get_many(self, table, ids):
+        ids = list(dict.fromkeys(ids))
+        now = time.time()
+        ttl = self.ttls[table]
+        found = {}
+
+        with self.lock, self.db:
+            for chunk in chunked(ids, SQLITE_MAX_VARIABLES):
+                rows = self.db.execute(
+                    f"SELECT id, data, fetched_at FROM {table} WHERE id IN ({', '.join('?' * len(chunk))})",
+                    chunk)
+                for item_id, data, fetched_at in rows:
+                    if not ttl or now - fetched_at < ttl:
+                        found[item_id] = json.loads(data)
+
+            self.db.executemany(
+                f"UPDATE {table} SET accessed_at = ? WHERE id = ?",
+                [(now, item_id) for item_id in found])
+            self.hits[table] += len(found)
+            self.misses[table] += len(ids) - len(found)
+
+        return found
+
+    def get(self, table, item_id):
+        return self.get_many(table, [item_id]).get(item_id)
+
+    def put_many(self, table, items):
+        if not items:
+            return
+        now = time.time()
+
+        with self.lock, self.db:
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?, ?)",
+                [(item_id, json.dumps(value), now, now) for item_id, value in items.items()])
+
+            # Evict the least recently used rows once the table is over size
+            count = self.db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            if count > self.max_entries:
+                self.db.execute(
+                    f"DELETE FROM {table} WHERE id IN "
+                    f"(SELECT id FROM {table} ORDER BY accessed_at LIMIT ?)",
+                    (count - self.max_entries,))
+
+    def put(self, table, item_id, value):
+        self.put_many(table, {item_id: value})
+
+    def stats(self):
+        with self.lock:
+            return {table: {
+                'hits': self.hits[table],
+                'misses': self.misses[table],
+                'entries': self.db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0],
+            } for table in self.ttls}
+
+feature_store = FeatureStore(FEATURE_CACHE_PATH, FEATURE_CACHE_TTLS, FEATURE_CACHE_MAX_ENTRIES)
+
+def spotify_id(uri):
+    # Cache keys are bare IDs so URIs and IDs for the same track share an entry
+    return uri.split(':')[-1]
+
+class Song:
+    # Song data with only the fields evaluate_transition and the response
+    # builders read. Subscripting and get() work like on the audio_features
+    # dicts this replaced, so callers can treat it as one.
+    __slots__ = ('key', 'mode', 'danceability', 'energy', 'loudness', 'tempo', 'valence',
+                 'genre', 'genre_bits', 'track_name')
+
+    AUDIO_FEATURES = ('key', 'mode', 'danceability', 'energy', 'loudness', 'tempo', 'valence')
+
+    def __init__(self, audio_features, genre, genre_bits, track_name):
+        self.key = audio_features['key']
+        self.mode = audio_features['mode']
+        self.danceability = audio_features['danceability']
+        self.energy = audio_features['energy']
+        self.loudness = audio_features['loudness']
+        self.tempo = audio_features['tempo']
+        self.valence = audio_features['valence']
+        self.genre = genre
+        self.genre_bits = genre_bits
+        self.track_name = track_name
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
 
-    while True:
-        response = sp.playlist_tracks(uri, offset=offset)
-        tracks.extend(response["items"])
+    def get(self, name, default=None):
+        return getattr(self, name, default)
 
-        if response["next"]:
-            offset += len(response["items"])
-        else:
-            break
+    def __contains__(self, name):
+        return name in self.__slots__
 
-    return tracks
+    def keys(self):
+        return self.__slots__
 
-def get_song_data(track_id):
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+def track_record(track, audio_features):
+    # The parts of a track that get_song_data and the response builders need,
+    # as stored in the cache
     try:
-        track = sp.track(track_id)
-    except SpotifyException:
+        album_cover = track["album"]["images"][0]["url"]
+    except IndexError:
+        album_cover = None
+
+    return {
+        'audio_features': {name: audio_features[name] for name in Song.AUDIO_FEATURES},
+        'track_name': track['name'],
+        'artist_id': track['artists'][0]['id'],
+        'artist_name': track['artists'][0]['name'],
+        'album_name': track['album']['name'],
+        'album_cover': album_cover,
+        'popularity': track['popularity'],
+    }
+
+def song_data_from_record(record, genres, genre_bits):
+    return Song(record['audio_features'], genres, genre_bits, record['track_name'])
+
+def song_data_from_records(records, artist_genres):
+    # Songs by the same artist share one genre list and one bitset. Library
+    # records carry their own genres.
+    artist_bits = {artist_id: genre_vocabulary.bits(genres)
+                   for artist_id, genres in artist_genres.items()}
+    songs = {}
+    for track_id, record in records.items():
+        if 'genres' in record:
+            genres, bits = record['genres'], genre_vocabulary.bits(record['genres'])
+        else:
+            genres, bits = artist_genres[record['artist_id']], artist_bits[record['artist_id']]
+        songs[track_id] = song_data_from_record(record, genres, bits)
+    return songs
+
+# Directory of a track library imported with import_library.py. Its tracks are
+# served from there instead of the feature cache and Spotify, and with
+# LIBRARY_OFFLINE=1 tracks missing from it are skipped instead of fetched.
+LIBRARY_PATH = os.getenv("LIBRARY_PATH")
+LIBRARY_OFFLINE = os.getenv("LIBRARY_OFFLINE", "0") != "0"
+
+LIBRARY_FORMAT_VERSION = 1
+
+# Dataset rows read and written per chunk while importing
+LIBRARY_CHUNK_SIZE = 50000
+
+# Column names a dataset may use for each library field, first match wins.
+# The audio features use their Spotify names.
+LIBRARY_COLUMN_ALIASES = {
+    'id': ('track_id', 'id', 'uri'),
+    'track_name': ('track_name', 'name'),
+    'artist_name': ('artist_name', 'artists', 'artist'),
+    'album_name': ('album_name', 'album'),
+    'album_cover': ('album_cover', 'image_url'),
+    'popularity': ('popularity',),
+    'genres': ('genres', 'genre', 'track_genre', 'artist_genres'),
+}
+
+# Fixed-width columns and their dtypes. Strings are stored as one UTF-8 blob
+# per column with row offsets, and genres as offsets into genre IDs.
+LIBRARY_NUMERIC_COLUMNS = {
+    'key': 'i1',
+    'mode': 'i1',
+    'danceability': 'f8',
+    'energy': 'f8',
+    'loudness': 'f8',
+    'tempo': 'f8',
+    'valence': 'f8',
+    'popularity': 'i4',
+}
+LIBRARY_STRING_COLUMNS = ('id', 'track_name', 'artist_name', 'album_name', 'album_cover')
+
+DATASET_FORMATS = {
+    '.csv': 'csv',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.parquet': 'parquet',
+    '.pq': 'parquet',
+}
+
+def dataset_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    extension = os.path.splitext(name)[1].lower()
+    if extension not in DATASET_FORMATS:
+        raise ValueError(f"Can't tell the format of {path}, expected one of {', '.join(DATASET_FORMATS)}")
+    return DATASET_FORMATS[extension]
+
+def read_dataset_chunks(path, chunk_size=LIBRARY_CHUNK_SIZE, file_format=None):
+    # Yields the rows of a CSV, JSON Lines or Parquet file as lists of dicts,
+    # chunk_size at a time, without reading the whole file
+    file_format = file_format or dataset_format(path)
+    if file_format == 'parquet':
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Reading Parquet datasets needs pyarrow installed") from None
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pylist()
+        return
+
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', newline='') as f:
+        if file_format == 'csv':
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+def parse_list(value):
+    # Lists arrive as lists (JSON Lines, Parquet), as list literals
+    # ("['pop', 'dance pop']") or as ;-separated strings
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [str(item) for item in value if item]
+    value = str(value).strip()
+    if value.startswith('['):
+        try:
+            return [str(item) for item in ast.literal_eval(value) if item]
+        except (ValueError, SyntaxError):
+            pass
+    return [item.strip() for item in value.split(';') if item.strip()]
+
+def library_field(row, name):
+    for column in LIBRARY_COLUMN_ALIASES.get(name, (name,)):
+        value = row.get(column)
+        if value is not None and value != '':
+            return value
+    return None
+
+def library_row(row):
+    # The library fields of one dataset row, or None if it lacks an ID or an
+    # audio feature the scoring needs
+    track_id = library_field(row, 'id')
+    if track_id is None:
         return None
-    if track['duration_ms'] == 0:
+    try:
+        parsed = {name: float(library_field(row, name)) for name in Song.AUDIO_FEATURES}
+        parsed['key'] = int(parsed['key'])
+        parsed['mode'] = int(parsed['mode'])
+        popularity = library_field(row, 'popularity')
+        parsed['popularity'] = -1 if popularity is None else int(float(popularity))
+    except (TypeError, ValueError):
         return None
-    audio_features = sp.audio_features(track_id)[0]
-    artist_id = track['artists'][0]['id']
-    genres = get_related_artist_genres(artist_id)
 
-    song_data = audio_features.copy()
-    song_data['genre'] = genres
-    song_data['track_name'] = track['name']
-    return song_data
+    artists = parse_list(library_field(row, 'artist_name'))
+    parsed.update({
+        'id': spotify_id(str(track_id)),
+        'track_name': str(library_field(row, 'track_name') or ''),
+        'artist_name': artists[0] if artists else '',
+        'album_name': str(library_field(row, 'album_name') or ''),
+        'album_cover': str(library_field(row, 'album_cover') or ''),
+        'genres': parse_list(library_field(row, 'genres')),
+    })
+    return parsed
+
+class LibraryWriter:
+    # Appends dataset chunks to the column files of a new library directory
+    # next to path. close() writes the manifest last and only then swaps the
+    # directory in for path, so an interrupted import is never opened and a
+    # library already at path stays usable until the new one is complete.
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        parent = os.path.dirname(self.path)
+        os.makedirs(parent, exist_ok=True)
+        self.build_path = tempfile.mkdtemp(prefix=f'.{os.path.basename(self.path)}.', dir=parent)
+        # mkdtemp makes the directory private to this user
+        os.chmod(self.build_path, 0o755)
+        self.count = 0
+        self.skipped = 0
+        self.genres = GenreVocabulary()
+        self.files = {}
+        self.lengths = Counter()
+        # Every column file exists even if no row is ever appended
+        for name, dtype in LIBRARY_NUMERIC_COLUMNS.items():
+            self.write(name, np.zeros(0, dtype=dtype))
+        for name in LIBRARY_STRING_COLUMNS + ('genres',):
+            self.write(name, np.zeros(0, dtype='u1' if name != 'genres' else 'i4'))
+            self.write(f'{name}_offsets', np.zeros(1, dtype='i8'))
+
+    def write(self, name, values):
+        if name not in self.files:
+            self.files[name] = open(os.path.join(self.build_path, f'{name}.bin'), 'wb')
+        values.tofile(self.files[name])
+        self.lengths[name] += len(values)
+
+    def abort(self):
+        for f in self.files.values():
+            f.close()
+        shutil.rmtree(self.build_path, ignore_errors=True)
+
+    def append(self, rows):
+        parsed = [row for row in map(library_row, rows) if row is not None]
+        self.skipped += len(rows) - len(parsed)
+        if not parsed:
+            return
+
+        for name, dtype in LIBRARY_NUMERIC_COLUMNS.items():
+            self.write(name, np.array([row[name] for row in parsed], dtype=dtype))
+
+        for name in LIBRARY_STRING_COLUMNS:
+            encoded = [row[name].encode('utf-8') for row in parsed]
+            offsets = self.lengths[name] + np.cumsum([len(value) for value in encoded], dtype='i8')
+            self.write(name, np.frombuffer(b''.join(encoded), dtype='u1'))
+            self.write(f'{name}_offsets', offsets)
+
+        genre_ids = [[self.genres.intern(genre) for genre in row['genres']] for row in parsed]
+        offsets = self.lengths['genres'] + np.cumsum([len(ids) for ids in genre_ids], dtype='i8')
+        self.write('genres', np.array([genre_id for ids in genre_ids for genre_id in ids], dtype='i4'))
+        self.write('genres_offsets', offsets)
+        self.count += len(parsed)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+        # Sort the IDs once here so lookups are a binary search over a
+        # memory-mapped array. A repeated ID keeps its first row.
+        offsets = np.fromfile(os.path.join(self.build_path, 'id_offsets.bin'), dtype='i8')
+        blob = np.fromfile(os.path.join(self.build_path, 'id.bin'), dtype='u1').tobytes()
+        ids = np.array([blob[offsets[i]:offsets[i + 1]] for i in range(self.count)],
+                       dtype=f'S{max(1, int(np.diff(offsets).max(initial=1)))}')
+        rows = np.argsort(ids, kind='stable')
+        ids = ids[rows]
+        first = np.ones(len(ids), dtype=bool)
+        first[1:] = ids[1:] != ids[:-1]
+        self.duplicates = int(len(ids) - first.sum())
+        ids[first].tofile(os.path.join(self.build_path, 'ids.bin'))
+        rows[first].astype('i8').tofile(os.path.join(self.build_path, 'rows.bin'))
+
+        columns = {name: [np.dtype(dtype).str, self.lengths[name]]
+                   for name, dtype in LIBRARY_NUMERIC_COLUMNS.items()}
+        for name in LIBRARY_STRING_COLUMNS + ('genres',):
+            columns[name] = ['|u1' if name != 'genres' else '<i4', self.lengths[name]]
+            columns[f'{name}_offsets'] = ['<i8', self.lengths[f'{name}_offsets']]
+        columns['ids'] = [ids.dtype.str, int(first.sum())]
+        columns['rows'] = ['<i8', int(first.sum())]
+
+        manifest = {
+            'format': LIBRARY_FORMAT_VERSION,
+            'count': self.count - self.duplicates,
+            'genres': sorted(self.genres.ids, key=self.genres.ids.get),
+            'columns': columns,
+        }
+        with open(os.path.join(self.build_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+        # Servers that already mapped the old files keep reading them until
+        # they restart
+        if os.path.exists(self.path):
+            old_path = f'{self.build_path}.old'
+            os.rename(self.path, old_path)
+            os.rename(self.build_path, self.path)
+            shutil.rmtree(old_path, ignore_errors=True)
+        else:
+            os.rename(self.build_path, self.path)
 
-@lru_cache(maxsize=128)
-def get_related_artist_genres(artist_id):
+def import_library(dataset_path, library_path, chunk_size=LIBRARY_CHUNK_SIZE, file_format=None):
+    # Streams a dataset into a library directory a chunk at a time. Returns
+    # the number of tracks imported, rows skipped and duplicate IDs dropped.
+    writer = LibraryWriter(library_path)
+    try:
+        for chunk in read_dataset_chunks(dataset_path, chunk_size, file_format):
+            writer.append(chunk)
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    return {'tracks': writer.count - writer.duplicates, 'skipped': writer.skipped,
+            'duplicates': writer.duplicates}
+
+class LibraryStore:
+    # Read-only view of an imported library. Every column is memory-mapped,
+    # so opening it takes the same time for any number of tracks and only the
+    # rows requests touch are paged in.
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest['format'] != LIBRARY_FORMAT_VERSION:
+            raise ValueError(f"{path} is library format {manifest['format']}, "
+                             f"expected {LIBRARY_FORMAT_VERSION}; import it again")
+        self.count = manifest['count']
+        self.genres = manifest['genres']
+        self.columns = {name: self.map(name, dtype, length)
+                        for name, (dtype, length) in manifest['columns'].items()}
+
+    def __len__(self):
+        return self.count
+
+    def map(self, name, dtype, length):
+        # np.memmap can't map an empty file
+        if length == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, f'{name}.bin'), dtype=dtype, mode='r', shape=(length,))
+
+    def find(self, track_ids):
+        # {track_id: row} for the track IDs or URIs in the library
+        ids = self.columns['ids']
+        keys = {track_id: spotify_id(track_id).encode('utf-8') for track_id in track_ids}
+        keys = {track_id: key for track_id, key in keys.items() if len(key) <= ids.dtype.itemsize}
+        if not keys or not len(ids):
+            return {}
+
+        wanted = np.array(list(keys.values()), dtype=ids.dtype)
+        positions = np.minimum(np.searchsorted(ids, wanted), len(ids) - 1)
+        found = ids[positions] == wanted
+        rows = self.columns['rows'][positions]
+        return {track_id: int(row) for track_id, is_found, row in zip(keys, found, rows) if is_found}
+
+    def string(self, name, row):
+        offsets = self.columns[f'{name}_offsets']
+        return self.columns[name][offsets[row]:offsets[row + 1]].tobytes().decode('utf-8')
+
+    def records(self, track_ids):
+        # Records shaped like track_record's, plus the track's own genres
+        rows = self.find(track_ids)
+        if not rows:
+            return {}
+        indices = np.fromiter(rows.values(), dtype='i8', count=len(rows))
+        numeric = {name: self.columns[name][indices].tolist() for name in LIBRARY_NUMERIC_COLUMNS}
+        genre_offsets = self.columns['genres_offsets']
+
+        records = {}
+        for i, (track_id, row) in enumerate(rows.items()):
+            genre_ids = self.columns['genres'][genre_offsets[row]:genre_offsets[row + 1]]
+            records[track_id] = {
+                'audio_features': {name: numeric[name][i] for name in Song.AUDIO_FEATURES},
+                'track_name': self.string('track_name', row),
+                'artist_id': None,
+                'artist_name': self.string('artist_name', row),
+                'album_name': self.string('album_name', row),
+                'album_cover': self.string('album_cover', row) or None,
+                'popularity': numeric['popularity'][i] if numeric['popularity'][i] >= 0 else None,
+                'genres': [self.genres[genre_id] for genre_id in genre_ids.tolist()],
+            }
+        return records
+
+library = LibraryStore(LIBRARY_PATH) if LIBRARY_PATH else None
+
+def get_song_data(track_id):
+    if library is not None:
+        record = library.records([track_id]).get(track_id)
+        if record is not None:
+            return song_data_from_record(record, record['genres'], genre_vocabulary.bits(record['genres']))
+        if LIBRARY_OFFLINE:
+            return None
+
+    record = feature_store.get('tracks', spotify_id(track_id))
+    if record is None:
+        try:
+            track = sp.track(track_id)
+        except SpotifyException as e:
+            # Rate limiting that outlasted the retries is not a missing track
+            if e.http_status == 429:
+                raise
+            return None
+        if track['duration_ms'] == 0:
+            return None
+        audio_features = sp.audio_features(track_id)[0]
+        if audio_features is None:
+            return None
+        record = track_record(track, audio_features)
+        feature_store.put('tracks', spotify_id(track_id), record)
+
+    genres = get_related_artist_genres(record['artist_id'])
+    return song_data_from_record(record, genres, genre_vocabulary.bits(genres))
+
+def fetch_related_artist_genres(artist_id):
     related_artists = sp.artist_related_artists(artist_id)
     genres = []
     for artist in related_artists['artists']:
         genres.extend(artist['genres'])
     return list(set(genres))
 
+def get_related_artist_genres(artist_id):
+    genres = feature_store.get('artist_genres', artist_id)
+    if genres is None:
+        genres = fetch_related_artist_genres(artist_id)
+        feature_store.put('artist_genres', artist_id, genres)
+    return genres
+
+# Maximum number of IDs the Spotify batch endpoints accept per request
+TRACKS_BATCH_SIZE = 50
+AUDIO_FEATURES_BATCH_SIZE = 100
+
+def chunked(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def fetch_in_batches(fetch, ids, batch_size):
+    # Returns {id: item} for every ID the batch endpoint returned an item for
+    def fetch_chunk(chunk):
+        try:
+            return list(zip(chunk, fetch(chunk)))
+        except SpotifyException as e:
+            if e.http_status == 429:
+                raise
+            # A single bad ID fails the whole batch, so retry one at a time
+            results = []
+            for item_id in chunk:
+                try:
+                    results.extend(zip([item_id], fetch([item_id])))
+                except SpotifyException as e:
+                    if e.http_status == 429:
+                        raise
+            return results
+
+    items = {}
+    for results in spotify_executor.map(fetch_chunk, chunked(ids, batch_size)):
+        items.update((item_id, item) for item_id, item in results if item)
+    return items
+
+def load_track_records(track_ids):
+    # Returns ({track_id: record}, {artist_id: genres}) for the tracks that
+    # get_song_data would return data for. Tracks in the offline library are
+    # read from it, and cache misses are fetched with the /tracks and
+    # /audio-features batch endpoints.
+    track_ids = list(dict.fromkeys(track_ids))
+    library_records = library.records(track_ids) if library is not None else {}
+    if LIBRARY_OFFLINE:
+        return library_records, {}
+
+    spotify_track_ids = [track_id for track_id in track_ids if track_id not in library_records]
+    cached = feature_store.get_many('tracks', [spotify_id(track_id) for track_id in spotify_track_ids])
+    records = {track_id: cached[spotify_id(track_id)]
+               for track_id in spotify_track_ids if spotify_id(track_id) in cached}
+    missing = [track_id for track_id in spotify_track_ids if track_id not in records]
+
+    # IDs another request is fetching right now are waited for, not refetched
+    if missing:
+        tracks = track_flights.fetch(lambda ids: fetch_in_batches(
+            lambda chunk: sp.tracks(chunk)['tracks'], ids, TRACKS_BATCH_SIZE), missing)
+        missing = [track_id for track_id in missing
+                   if track_id in tracks and tracks[track_id]['duration_ms'] != 0]
+
+        audio_features = audio_features_flights.fetch(lambda ids: fetch_in_batches(
+            sp.audio_features, ids, AUDIO_FEATURES_BATCH_SIZE), missing)
+        fetched = {track_id: track_record(tracks[track_id], audio_features[track_id])
+                   for track_id in missing if track_id in audio_features}
+        feature_store.put_many('tracks', {spotify_id(track_id): record
+                                          for track_id, record in fetched.items()})
+        records.update(fetched)
+
+    # Related artists have no batch endpoint, so look each artist up once
+    artist_ids = list(dict.fromkeys(record['artist_id'] for record in records.values()))
+    artist_genres = feature_store.get_many('artist_genres', artist_ids)
+    missing_artists = [artist_id for artist_id in artist_ids if artist_id not in artist_genres]
+    fetched_genres = artist_genre_flights.fetch(lambda ids: dict(zip(
+        ids, spotify_executor.map(fetch_related_artist_genres, ids))), missing_artists)
+    feature_store.put_many('artist_genres', fetched_genres)
+    artist_genres.update(fetched_genres)
+
+    records.update(library_records)
+    records = {track_id: records[track_id] for track_id in track_ids if track_id in records}
+    return records, artist_genres
+
+def get_song_data_bulk(track_ids):
+    # Same Song records as get_song_data, keyed by track ID in input order.
+    # Tracks that get_song_data would return None for are left out.
+    records, artist_genres = load_track_records(track_ids)
+    return song_data_from_records(records, artist_genres)
+
+# Tracks fetched between two progress events of a streamed response
+PROGRESS_CHUNK_SIZE = 500
+
+def progress_event(stage, done, total):
+    return {"event": "progress", "stage": stage, "done": done, "total": total}
+
+class TrackContext:
+    # Request-scoped view of the tracks a request works with. The fetch phase
+    # fills it once and later stages, including the response, read from it
+    # instead of going back to Spotify.
+
+    def __init__(self):
+        self.records = {}
+        self.song_data_map = {}
+        self.requested = set()
+
+    def load(self, track_ids):
+        # Returns {track_id: song_data} for track_ids, fetching only tracks
+        # this context hasn't seen yet
+        track_ids = list(dict.fromkeys(track_ids))
+        missing = [track_id for track_id in track_ids if track_id not in self.requested]
+        self.requested.update(missing)
+
+        with metrics.stage("features"):
+            records, artist_genres = load_track_records(missing)
+            self.records.update(records)
+            self.song_data_map.update(song_data_from_records(records, artist_genres))
+
+        return {track_id: self.song_data_map[track_id]
+                for track_id in track_ids if track_id in self.song_data_map}
+
+    def load_playlist(self, playlist_id, track_uris, started=False):
+        # Loads the tracks of a playlist a page at a time while later pages are
+        # still being fetched, appending their URIs to track_uris and yielding
+        # a progress event after each page. The first event goes out before
+        # the first request, while the playlist's size is still unknown,
+        # unless the caller already sent it (started).
+        if not started:
+            yield progress_event("fetch", 0, None)
+        for items, total in get_playlist_track_pages(playlist_id):
+            page_uris = [item["track"]["uri"] for item in items]
+            self.load(page_uris)
+            track_uris.extend(page_uris)
+            yield progress_event("fetch", len(track_uris), total)
+
+    def load_progressively(self, track_ids):
+        # Same as load, in chunks, yielding a progress event after each chunk
+        track_ids = list(dict.fromkeys(track_ids))
+        yield progress_event("fetch", 0, len(track_ids))
+        for start in range(0, len(track_ids), PROGRESS_CHUNK_SIZE):
+            self.load(track_ids[start:start + PROGRESS_CHUNK_SIZE])
+            yield progress_event(
+                "fetch", min(start + PROGRESS_CHUNK_SIZE, len(track_ids)), len(track_ids))
+
+    def copy(self, track_ids):
+        # New context that already knows track_ids, sharing their song data
+        context = TrackContext()
+        track_ids = set(track_ids)
+        context.records = {track_id: record for track_id, record in self.records.items() if track_id in track_ids}
+        context.song_data_map = {track_id: song for track_id, song in self.song_data_map.items() if track_id in track_ids}
+        context.requested = self.requested & track_ids
+        return context
+
+    def track_entry(self, track_id, position):
+        record = self.records[track_id]
+        song_data = self.song_data_map[track_id]
+        return {
+            "position": position,
+            "track_name": record["track_name"],
+            "artist": record["artist_name"],
+            "album_name": record["album_name"],
+            "album_cover": record["album_cover"],
+            "popularity": record["popularity"],
+            "tempo": song_data["tempo"],
+            "danceability": song_data["danceability"],
+            "uri": track_id,
+        }
+
+    def serialize(self, track_ids, first_position=1):
+        return [self.track_entry(track_id, first_position + i) for i, track_id in enumerate(track_ids)]
+
+# Request field that can list track IDs instead of each playlist link field,
+# for example to run an endpoint against the offline library
+TRACK_ID_FIELDS = {
+    'playlist_link': 'track_ids',
+    'playlist1_link': 'playlist1_track_ids',
+    'playlist2_link': 'playlist2_track_ids',
+}
+
+def has_requested_tracks(data, link_field):
+    return bool(data.get(link_field) or data.get(TRACK_ID_FIELDS[link_field]))
+
+def load_requested_tracks(context, data, link_field, track_uris, started=False):
+    # Loads the tracks listed in the request or, if it lists none, those of
+    # the playlist at its link field, appending their URIs to track_uris
+    track_ids = data.get(TRACK_ID_FIELDS[link_field])
+    if track_ids:
+        yield from context.load_progressively(track_ids)
+        track_uris.extend(track_ids)
+    else:
+        uri = data[link_field].split("/")[-1].split("?")[0]
+        yield from context.load_playlist(uri, track_uris, started)
+
 def get_relative_key(key, mode):
     if mode == 1:  # Major key
         return (key + 9) % 12  # Relative minor key
@@ -77,6 +1191,10 @@ def steps_in_circle_of_fifths(key1, key2):
     return min(steps, 12 - steps)
 
 def key_compatibility(key1, mode1, key2, mode2):
+    # Key -1 means Spotify detected no key, so there is nothing to clash with
+    if key1 < 0 or key2 < 0:
+        return True
+
     if key1 == key2:
         return True
 
@@ -91,35 +1209,97 @@ def key_compatibility(key1, mode1, key2, mode2):
 
     return False
 
+# Key/mode slot of tracks Spotify couldn't detect a key for (key -1), in
+# either mode. key_compatibility treats them as compatible with every key,
+# so their row and column are all zero and the key term drops out.
+NO_KEY = 24
+KEY_SLOTS = NO_KEY + 1
+
+def key_index(key, mode):
+    # Row or column of a key and mode in KEY_PENALTY
+    return NO_KEY if key < 0 else key * 2 + mode
+
+def _key_penalty_table():
+    table = np.full((KEY_SLOTS, KEY_SLOTS), 6.0)
+    for key1 in range(-1, 12):
+        for mode1 in (0, 1):
+            for key2 in range(-1, 12):
+                for mode2 in (0, 1):
+                    if key_compatibility(key1, mode1, key2, mode2):
+                        table[key_index(key1, mode1), key_index(key2, mode2)] = 0.0
+    return table
+
+# Score evaluate_transition adds for moving between two key/mode slots,
+# built from key_compatibility so the rules live in one place
+KEY_PENALTY = _key_penalty_table()
+_KEY_PENALTY_ROWS = KEY_PENALTY.tolist()
+
+class GenreVocabulary:
+    # Process-wide interning of genre names to small integer IDs, so a set of
+    # genres can be kept and compared as a bitset instead of a list of strings
+
+    def __init__(self):
+        self.ids = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def intern(self, genre):
+        genre_id = self.ids.get(genre)
+        if genre_id is None:
+            with self.lock:
+                genre_id = self.ids.setdefault(genre, len(self.ids))
+        return genre_id
+
+    def bits(self, genres):
+        # Python int with bit i set for the genre with ID i
+        bits = 0
+        for genre in genres or ():
+            bits |= 1 << self.intern(genre)
+        return bits
+
+genre_vocabulary = GenreVocabulary()
+
+def popcount(bits):
+    # int.bit_count needs Python 3.10
+    return bin(bits).count('1')
+
+def song_genre_bits(song):
+    bits = song.get('genre_bits')
+    return genre_vocabulary.bits(song['genre']) if bits is None else bits
+
 def genre_similarity(genres1, genres2):
     if not genres1 or not genres2:
         return 0
-    shared_genres = len(set(genres1).intersection(genres2))
+    shared_genres = popcount(genre_vocabulary.bits(genres1) & genre_vocabulary.bits(genres2))
     return min(shared_genres, 5)
 
+def song_genre_similarity(song1, song2):
+    # genre_similarity for two songs, using their precomputed bitsets
+    return min(popcount(song_genre_bits(song1) & song_genre_bits(song2)), 5)
+
+# Weights for different attributes
+TRANSITION_WEIGHTS = {
+    'danceability': 7,
+    'energy': 5,
+    'loudness': 1,
+    'tempo': 100,
+    'valence': 5,
+    'genre': 4
+}
+
 def evaluate_transition(song1, song2):
     score = 0
 
-    # Weights for different attributes
-    weights = {
-        'danceability': 7,
-        'energy': 5,
-        'loudness': 1,
-        'tempo': 100,
-        'valence': 5,
-        'genre': 4
-    }
-
-    # Check key compatibility
-    if not key_compatibility(song1['key'], song1['mode'], song2['key'], song2['mode']):
-        score += 6  # Return a large score if keys are not compatible
+    # Add a large score if keys are not compatible
+    score += _KEY_PENALTY_ROWS[key_index(song1['key'], song1['mode'])][key_index(song2['key'], song2['mode'])]
 
     # Calculate the differences in attributes
     diff = {}
-    for attribute in weights:
+    for attribute in TRANSITION_WEIGHTS:
         if attribute == 'genre':
-            diff[attribute] = 5 - \
-                genre_similarity(song1[attribute], song2[attribute])
+            diff[attribute] = 5 - song_genre_similarity(song1, song2)
         else:
             diff[attribute] = abs(song1[attribute] - song2[attribute])
 
@@ -135,171 +1315,1507 @@ def evaluate_transition(song1, song2):
     diff['tempo'] = tempo_diff / 200  # Normalize tempo difference
 
     # Calculate the transition score
-    for attribute in weights:
-        score += weights[attribute] * diff[attribute]
+    for attribute in TRANSITION_WEIGHTS:
+        score += TRANSITION_WEIGHTS[attribute] * diff[attribute]
 
     return score
 
+# Columns evaluate_transition reads from a song, packed into one array each
+FEATURE_COLUMNS = ['key', 'mode', 'danceability', 'energy', 'loudness', 'tempo', 'valence']
+
+# Upper bound on the number of elements in one (rows, cols, words) genre block
+GENRE_BLOCK_ELEMENTS = 1 << 22
+
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def pack_song_features(songs):
+    features = {}
+    for column in FEATURE_COLUMNS:
+        dtype = np.int64 if column in ('key', 'mode') else np.float64
+        features[column] = np.array([song[column] for song in songs], dtype=dtype)
+    features['key_slot'] = np.where(features['key'] < 0, NO_KEY, features['key'] * 2 + features['mode'])
+
+    # One bit per genre vocabulary ID, 64 genres per word, only as many words
+    # as the highest ID these songs use
+    genre_bits = [song_genre_bits(song) for song in songs]
+    n_words = max(1, (max((bits.bit_length() for bits in genre_bits), default=0) + 63) // 64)
+    packed = b''.join(bits.to_bytes(n_words * 8, 'little') for bits in genre_bits)
+    features['genre_bits'] = np.frombuffer(packed, dtype='<u8').astype(np.uint64).reshape(len(songs), n_words)
+
+    return features
+
+def _popcount(words):
+    # Number of set bits in each 64-bit word
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    as_bytes = words.view(np.uint8).reshape(words.shape + (8,))
+    return _POPCOUNT_TABLE[as_bytes].sum(axis=-1, dtype=np.uint8)
+
+def _pad_words(bits, n_words):
+    if bits.shape[1] == n_words:
+        return bits
+    padded = np.zeros((bits.shape[0], n_words), dtype=np.uint64)
+    padded[:, :bits.shape[1]] = bits
+    return padded
+
+def shared_genre_matrix(bits1, bits2):
+    n_words = max(bits1.shape[1], bits2.shape[1])
+    bits1 = _pad_words(bits1, n_words)
+    bits2 = _pad_words(bits2, n_words)
+
+    # Words no genre on both sides falls in can't add to any count
+    active = (np.bitwise_or.reduce(bits1, axis=0) & np.bitwise_or.reduce(bits2, axis=0)) != 0
+    if not active.any():
+        return np.zeros((bits1.shape[0], bits2.shape[0]), dtype=np.int64)
+    bits1 = bits1[:, active]
+    bits2 = bits2[:, active]
+    n_words = bits1.shape[1]
+
+    # One word at a time into a 2-D accumulator, so no (rows, cols, words)
+    # intermediate is ever built
+    shared = np.zeros((bits1.shape[0], bits2.shape[0]), dtype=np.int64)
+    block_rows = max(1, GENRE_BLOCK_ELEMENTS // max(1, bits2.shape[0]))
+    for start in range(0, bits1.shape[0], block_rows):
+        rows = bits1[start:start + block_rows]
+        both = np.empty((rows.shape[0], bits2.shape[0]), dtype=np.uint64)
+        for word in range(n_words):
+            np.bitwise_and(rows[:, word, None], bits2[None, :, word], out=both)
+            shared[start:start + block_rows] += _popcount(both)
+    return shared
+
+def transition_cost_matrix(features1, features2=None):
+    # Entry [i, j] equals evaluate_transition(songs1[i], songs2[j]). The terms
+    # are added in the same order as the scalar version so the scores match
+    # exactly, not just approximately.
+    if features2 is None:
+        features2 = features1
+
+    def column(features, name, axis):
+        values = features[name]
+        return values[:, None] if axis == 0 else values[None, :]
+
+    score = KEY_PENALTY[features1['key_slot'][:, None], features2['key_slot'][None, :]]
+
+    score += 7 * np.abs(column(features1, 'danceability', 0) - column(features2, 'danceability', 1))
+    score += 5 * np.abs(column(features1, 'energy', 0) - column(features2, 'energy', 1))
+    score += 1 * (np.abs(column(features1, 'loudness', 0) - column(features2, 'loudness', 1)) / 60)
+
+    tempo1 = column(features1, 'tempo', 0)
+    tempo2 = column(features2, 'tempo', 1)
+    tempo_diff = np.minimum(np.minimum(
+        np.abs(tempo1 - tempo2),
+        np.abs(tempo1 * 2 - tempo2)),
+        np.abs(tempo1 / 2 - tempo2))
+    score += 100 * (tempo_diff / 200)
+
+    score += 5 * np.abs(column(features1, 'valence', 0) - column(features2, 'valence', 1))
+
+    shared = shared_genre_matrix(features1['genre_bits'], features2['genre_bits'])
+    score += 4 * (5 - np.minimum(shared, 5))
+
+    return score
+
+# Worker processes of the tiled cost engine and how they are started. Spawned
+# workers import this module fresh instead of forking the server's threads.
+COST_ENGINE_WORKERS = int(os.getenv("COST_ENGINE_WORKERS", os.cpu_count() or 1))
+COST_ENGINE_START_METHOD = os.getenv("COST_ENGINE_START_METHOD", "spawn")
+
+# Rows and columns per tile, and the fewest cost entries worth handing to the
+# worker processes instead of scoring them in this one
+COST_TILE_SIZE = 1024
+COST_ENGINE_MIN_ENTRIES = 1 << 22
+
+# Where parallel cost matrices are assembled: shared memory when the system
+# has it mounted
+COST_OUTPUT_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# Shared-memory segments a worker keeps attached between tasks
+COST_WORKER_SEGMENTS = 64
+
+class SharedFeatures:
+    # Packed song features copied once into shared memory. Workers attach to
+    # the segments by name, so tasks carry names and row indices instead of
+    # pickled songs.
+
+    def __init__(self, features):
+        self.segments = []
+        self.spec = {}
+        try:
+            for name, values in features.items():
+                values = np.ascontiguousarray(values)
+                segment = shared_memory.SharedMemory(create=True, size=max(1, values.nbytes))
+                self.segments.append(segment)
+                np.ndarray(values.shape, values.dtype, buffer=segment.buf)[...] = values
+                self.spec[name] = (segment.name, values.shape, values.dtype.str)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+        self.segments = []
+
+_worker_segments = OrderedDict()
+
+def attach_features(spec):
+    # In a worker: views of shared features. Segments stay attached between
+    # tasks, least recently used ones are detached beyond COST_WORKER_SEGMENTS.
+    features = {}
+    for name, (segment_name, shape, dtype) in spec.items():
+        segment = _worker_segments.get(segment_name)
+        if segment is None:
+            segment = shared_memory.SharedMemory(name=segment_name)
+            _worker_segments[segment_name] = segment
+        _worker_segments.move_to_end(segment_name)
+        features[name] = np.ndarray(shape, dtype, buffer=segment.buf)
+
+    while len(_worker_segments) > COST_WORKER_SEGMENTS:
+        _, segment = _worker_segments.popitem(last=False)
+        segment.close()
+    return features
+
+def cost_block(task, features1, features2, rows, cols, arg=None):
+    # Scores the songs at rows of features1 against those at cols of
+    # features2 and reduces the block for task:
+    #   'matrix': the block itself, which workers write into the output
+    #     segment named by arg instead
+    #   'max': its largest entry as (cost, row, col)
+    #   'nearest': the arg[0] cheapest cols of each row as (cols, costs),
+    #     skipping a song and itself if arg[1] is set
+    #   'assign': the closest col of each row by clustering_distances, where
+    #     features2 is features1
+    if task == 'assign':
+        return clustering_distances(features1, rows, cols).argmin(axis=1)
+
+    costs = transition_cost_matrix(take_song_features(features1, rows), take_song_features(features2, cols))
+    if task == 'matrix':
+        return costs
+    if task == 'max':
+        row, col = np.unravel_index(costs.argmax(), costs.shape)
+        return float(costs[row, col]), int(rows[row]), int(cols[col])
+    if task == 'nearest':
+        k, exclude_self = arg
+        if exclude_self:
+            costs[rows[:, None] == cols[None, :]] = np.inf
+        k = min(k, costs.shape[1])
+        best = np.argpartition(costs, k - 1, axis=1)[:, :k]
+        return cols[best], np.take_along_axis(costs, best, axis=1)
+    raise ValueError(f"Unknown cost task {task}")
+
+def cost_block_task(task, spec1, spec2, rows, cols, arg):
+    features1 = attach_features(spec1)
+    features2 = features1 if spec2 is None else attach_features(spec2)
+    block = cost_block(task, features1, features2, rows, cols, arg)
+    if task != 'matrix':
+        return block
+
+    # Matrix blocks are far larger than the other results, so they go
+    # straight into the caller's output file instead of being pickled back
+    output_path, shape = arg
+    costs = np.memmap(output_path, dtype=np.float64, mode='r+', shape=shape)
+    costs[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1] = block
+    del costs
+
+def tile_blocks(n1, n2, tile_size=COST_TILE_SIZE):
+    return [(np.arange(row, min(row + tile_size, n1)), np.arange(col, min(col + tile_size, n2)))
+            for row in range(0, n1, tile_size) for col in range(0, n2, tile_size)]
+
+class CostSession:
+    # Two song sets a series of blocks is scored between. In parallel the
+    # features are shared with the workers once for the whole session.
+
+    def __init__(self, engine, features1, features2, parallel):
+        self.features1 = features1
+        self.features2 = features2
+        self.engine = engine
+        self.parallelism = engine.workers if parallel else 1
+        self.shared = []
+        if parallel:
+            self.shared.append(SharedFeatures(features1))
+            if features2 is not None:
+                self.shared.append(SharedFeatures(features2))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for shared in self.shared:
+            shared.close()
+        self.shared = []
+
+    def map(self, task, blocks, arg=None):
+        # Yields ((rows, cols), result) for each block, in the order the
+        # blocks finish
+        if not self.shared:
+            features2 = self.features1 if self.features2 is None else self.features2
+            for rows, cols in blocks:
+                yield (rows, cols), cost_block(task, self.features1, features2, rows, cols, arg)
+            return
+
+        pool = self.engine.get_pool()
+        spec2 = self.shared[1].spec if len(self.shared) > 1 else None
+        futures = {pool.submit(cost_block_task, task, self.shared[0].spec, spec2, rows, cols, arg): (rows, cols)
+                   for rows, cols in blocks}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        except BrokenProcessPool:
+            self.engine.shutdown()
+            raise
+        finally:
+            # Nothing may still be reading the segments once they're unlinked
+            for future in futures:
+                future.cancel()
+            wait(futures)
+
+class CostEngine:
+    # Tiled evaluate_transition scores across a pool of worker processes.
+    # Callers get each block's reduced result as it finishes, so the full
+    # matrix only exists when it is asked for. Small jobs, or a single
+    # worker, are scored in this process with the same results.
+
+    def __init__(self, workers=COST_ENGINE_WORKERS, start_method=COST_ENGINE_START_METHOD):
+        self.workers = max(1, workers)
+        self.start_method = start_method
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context(self.start_method))
+                # Workers start one per submitted task, so start them all now
+                # rather than during the first session
+                for _ in range(self.workers):
+                    self.pool.submit(int)
+            return self.pool
+
+    def shutdown(self):
+        # Also drops a pool whose worker died, so the next session starts a
+        # new one
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def session(self, features1, features2=None, entries=None):
+        if entries is None:
+            entries = len(features1['tempo']) * len((features1 if features2 is None else features2)['tempo'])
+        return CostSession(self, features1, features2, self.workers > 1 and entries >= COST_ENGINE_MIN_ENTRIES)
+
+    def matrix(self, features1, features2=None):
+        # Same as transition_cost_matrix, assembled from tiles. Only one
+        # tile's temporaries exist at a time, so memory stays near the size
+        # of the result whatever the worker count.
+        n1 = len(features1['tempo'])
+        n2 = len((features1 if features2 is None else features2)['tempo'])
+        with self.session(features1, features2) as session:
+            if session.parallelism == 1:
+                costs = np.empty((n1, n2))
+                for (rows, cols), block in session.map('matrix', tile_blocks(n1, n2)):
+                    costs[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1] = block
+                return costs
+
+            # Workers write into a file mapped by every process. It is
+            # unlinked once they're done and the returned array keeps the
+            # mapping, so the result is never copied.
+            fd, output_path = tempfile.mkstemp(prefix='audify-costs-', dir=COST_OUTPUT_DIR)
+            try:
+                with os.fdopen(fd, 'wb') as output:
+                    output.truncate(n1 * n2 * 8)
+                costs = np.memmap(output_path, dtype=np.float64, mode='r+', shape=(n1, n2))
+                for _ in session.map('matrix', tile_blocks(n1, n2), (output_path, (n1, n2))):
+                    pass
+            finally:
+                os.unlink(output_path)
+            return np.asarray(costs)
+
+    def nearest(self, features, k, rows=None, cols=None):
+        # (cols, costs), both (len(rows), k): for every song at rows the k
+        # songs at cols it transitions into most cheaply, cheapest first,
+        # never itself. rows and cols are sorted and default to every song.
+        # Rows with fewer candidates are padded with -1 and inf, and columns
+        # no row fills are dropped.
+        n = len(features['tempo'])
+        rows = np.arange(n) if rows is None else np.unique(rows)
+        cols = np.arange(n) if cols is None else np.unique(cols)
+        k = max(0, min(k, len(cols)))
+        best_cols = np.full((len(rows), k), -1, dtype=np.int64)
+        best_costs = np.full((len(rows), k), np.inf)
+        if not k or not len(rows):
+            return best_cols[:, :0], best_costs[:, :0]
+
+        blocks = [(rows[block_rows], cols[block_cols]) for block_rows, block_cols in tile_blocks(len(rows), len(cols))]
+        with self.session(features, entries=len(rows) * len(cols)) as session:
+            for (block_rows, _), (block_cols, block_costs) in session.map('nearest', blocks, (k, True)):
+                positions = np.searchsorted(rows, block_rows)
+                best_cols[positions], best_costs[positions] = merge_nearest(
+                    best_cols[positions], best_costs[positions], block_cols, block_costs, k)
+
+        order = np.argsort(best_costs, axis=1, kind='stable')
+        best_cols = np.take_along_axis(best_cols, order, axis=1)
+        best_costs = np.take_along_axis(best_costs, order, axis=1)
+        width = int((best_cols >= 0).sum(axis=1).max())
+        return best_cols[:, :width], best_costs[:, :width]
+
+def merge_nearest(cols, costs, more_cols, more_costs, k):
+    # The k cheapest of two candidate lists per row, in no particular order
+    cols = np.concatenate([cols, more_cols], axis=1)
+    costs = np.concatenate([costs, more_costs], axis=1)
+    k = min(k, costs.shape[1])
+    if not k:
+        return cols[:, :0], costs[:, :0]
+    keep = np.argpartition(costs, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(cols, keep, axis=1), np.take_along_axis(costs, keep, axis=1)
+
+cost_engine = CostEngine()
+
 def custom_distance(song1, song2):
     return evaluate_transition(song1, song2)
 
-def custom_clustering_algorithm(songs, n_clusters):
-    # Calculate pairwise distances
-    distances = np.zeros((len(songs), len(songs)))
-    for i in range(len(songs)):
-        for j in range(i + 1, len(songs)):
-            distance = custom_distance(songs[i], songs[j])
-            distances[i, j] = distance
-            distances[j, i] = distance
+# custom_clustering_algorithm uses the dense agglomerative backend up to
+# this many songs and mini-batch k-medoids above it, unless told otherwise
+DENSE_CLUSTERING_LIMIT = 2000
+
+# Mini-batch k-medoids: songs sampled per iteration, most iterations, and
+# songs assigned to their medoid at once in the final pass
+KMEDOIDS_BATCH_SIZE = 1024
+KMEDOIDS_ITERATIONS = 10
+KMEDOIDS_ASSIGN_BLOCK = 4096
+
+def clustering_distances(features, rows, cols):
+    # Distances between the songs at rows and cols as custom_clustering_algorithm
+    # sees them: the cost from the earlier song to the later one, 0 for a song
+    # and itself
+    rows_features = take_song_features(features, rows)
+    cols_features = take_song_features(features, cols)
+    forward = transition_cost_matrix(rows_features, cols_features)
+    backward = transition_cost_matrix(cols_features, rows_features).T
+    distances = np.where(rows[:, None] < cols[None, :], forward, backward)
+    distances[rows[:, None] == cols[None, :]] = 0
+    return distances
+
+def agglomerative_clusters(features, n_clusters):
+    # Calculate pairwise distances, using song i -> song j for i < j
+    costs = transition_cost_matrix(features)
+    distances = np.triu(costs, 1)
+    distances = distances + distances.T
 
     # Apply Agglomerative Clustering
     clustering = AgglomerativeClustering(
-        n_clusters=n_clusters, affinity='precomputed', linkage='complete')
+        n_clusters=n_clusters, metric='precomputed', linkage='complete')
     clusters = clustering.fit_predict(distances)
 
     return clusters
 
-def find_best_transition(single_track, playlist_tracks):
-    # Fetch song data in parallel
-    with ThreadPoolExecutor() as executor:
-        song_data_map = {song: data for song, data in zip(
-            playlist_tracks, executor.map(get_song_data, playlist_tracks)) if data is not None}
+def _seed_medoids(features, batch, n_clusters, rng):
+    # k-medoids++: each next medoid is drawn with probability proportional to
+    # its squared distance from the closest medoid so far
+    medoids = [batch[rng.integers(len(batch))]]
+    closest = clustering_distances(features, batch, np.array(medoids))[:, 0]
+    while len(medoids) < n_clusters:
+        weights = closest ** 2
+        if weights.sum() > 0:
+            medoid = batch[rng.choice(len(batch), p=weights / weights.sum())]
+        else:
+            medoid = rng.choice(np.setdiff1d(batch, medoids))
+        medoids.append(medoid)
+        closest = np.minimum(closest, clustering_distances(features, batch, np.array([medoid]))[:, 0])
+    return np.array(medoids)
+
+def kmedoids_clusters(features, n_clusters, seed=0):
+    # Mini-batch k-medoids on the transition cost. Medoids are refined on
+    # random batches, then every song joins its closest medoid a block at a
+    # time, so memory stays linear in the number of songs.
+    n = len(features['tempo'])
+    rng = np.random.default_rng(seed)
+    batch_size = min(n, max(KMEDOIDS_BATCH_SIZE, 4 * n_clusters))
+
+    medoids = _seed_medoids(features, rng.choice(n, batch_size, replace=False), n_clusters, rng)
+    for _ in range(KMEDOIDS_ITERATIONS):
+        batch = np.union1d(rng.choice(n, batch_size, replace=False), medoids)
+        nearest = clustering_distances(features, batch, medoids).argmin(axis=1)
+
+        # Each cluster's new medoid is the member closest to all the others
+        new_medoids = medoids.copy()
+        for cluster in range(n_clusters):
+            members = batch[nearest == cluster]
+            if len(members):
+                within = clustering_distances(features, members, members)
+                new_medoids[cluster] = members[within.sum(axis=1).argmin()]
+        if np.array_equal(new_medoids, medoids):
+            break
+        medoids = new_medoids
+
+    clusters = np.empty(n, dtype=np.int64)
+    blocks = [(np.arange(start, min(start + KMEDOIDS_ASSIGN_BLOCK, n)), medoids)
+              for start in range(0, n, KMEDOIDS_ASSIGN_BLOCK)]
+    with cost_engine.session(features, entries=2 * n * n_clusters) as session:
+        for (rows, _), nearest in session.map('assign', blocks):
+            clusters[rows] = nearest
+    return clusters
 
-    single_track_data = get_song_data(single_track)
-    transition_scores = {track: evaluate_transition(
-        single_track_data, song_data) for track, song_data in song_data_map.items()}
+def graph_clusters(features, n_clusters, graph=None):
+    # Spectral clustering on the edges of a TransitionGraph, built here if
+    # none is given, so memory stays linear in the number of songs. LOBPCG
+    # finds the eigenvectors of the sparse graph far faster than ARPACK.
+    if graph is None:
+        graph = TransitionGraph.build(range(len(features['tempo'])), features)
+    clustering = SpectralClustering(
+        n_clusters=n_clusters, affinity='precomputed_nearest_neighbors',
+        n_neighbors=int(np.diff(graph.indptr).min()), eigen_solver='lobpcg',
+        assign_labels='cluster_qr', random_state=0)
+    return clustering.fit_predict(graph.sparse())
+
+CLUSTERING_METHODS = {
+    'agglomerative': agglomerative_clusters,
+    'kmedoids': kmedoids_clusters,
+    'graph': graph_clusters,
+}
+
+def custom_clustering_algorithm(songs, n_clusters, method=None, graph=None):
+    # graph, a TransitionGraph over songs, is used by the graph method,
+    # which is the default when one is given
+    if method is None and graph is not None:
+        method = 'graph'
+    elif method is None:
+        method = 'agglomerative' if len(songs) <= DENSE_CLUSTERING_LIMIT else 'kmedoids'
+    if method not in CLUSTERING_METHODS:
+        raise ValueError(f"method must be one of {', '.join(CLUSTERING_METHODS)}")
+    if n_clusters >= len(songs):
+        return np.arange(len(songs))
+
+    with metrics.stage("clustering"):
+        if method == 'graph':
+            return graph_clusters(pack_song_features(songs), n_clusters, graph)
+        return CLUSTERING_METHODS[method](pack_song_features(songs), n_clusters)
+
+# Default seconds optimize_playlist spends improving an ordering, and the
+# most a request may ask for
+SEQUENCE_TIME_BUDGET = float(os.getenv("SEQUENCE_TIME_BUDGET", 2.0))
+MAX_SEQUENCE_TIME_BUDGET = 30.0
+
+# Local search only tries moves that create an edge to one of a track's
+# cheapest successors
+SEQUENCE_CANDIDATES = 10
+
+# optimize_playlist sequences playlists up to this many tracks on their full
+# cost matrix, and larger ones on their TransitionGraph
+DENSE_SEQUENCE_LIMIT = int(os.getenv("DENSE_SEQUENCE_LIMIT", 10000))
+
+# Longest run of tracks an Or-opt move relocates
+OR_OPT_MAX_SEGMENT = 3
+
+# Most non-overlapping 2-opt moves applied per local search pass
+TWO_OPT_MOVES_PER_PASS = 256
+
+def path_cost(costs, order):
+    order = np.asarray(order)
+    return float(costs[order[:-1], order[1:]].sum())
+
+def nearest_neighbour_path(costs, start=0):
+    n = len(costs)
+    visited = np.zeros(n, dtype=bool)
+    order = np.empty(n, dtype=np.int64)
+    current = start
+    for step in range(n):
+        order[step] = current
+        visited[current] = True
+        if step < n - 1:
+            row = np.where(visited, np.inf, costs[current])
+            current = int(np.argmin(row))
+    return order
+
+def candidate_successors(costs, k):
+    # The k cheapest next tracks for every track, excluding itself
+    k = min(k, len(costs) - 1)
+    masked = costs.astype(np.float64, copy=True)
+    np.fill_diagonal(masked, np.inf)
+    return np.argpartition(masked, k - 1, axis=1)[:, :k]
+
+def _two_opt_deltas(costs, order, pos, candidates):
+    # Reversing order[i..j] replaces edges (i-1 -> i) and (j -> j+1) with
+    # (i-1 -> j) and (i -> j+1) and flips every edge in between. Each
+    # candidate successor c of the track at p gives two such moves.
+    n = len(order)
+    forward = np.concatenate(([0.0], np.cumsum(costs[order[:-1], order[1:]])))
+    backward = np.concatenate(([0.0], np.cumsum(costs[order[1:], order[:-1]])))
+
+    p = np.repeat(np.arange(n), candidates.shape[1])
+    q = pos[candidates[order].ravel()]
+    keep = q > p + 1
+    p, q = p[keep], q[keep]
+    i = np.concatenate((p + 1, p))
+    j = np.concatenate((q, q - 1))
+
+    delta = (backward[j] - backward[i]) - (forward[j] - forward[i])
+    left = order[np.maximum(i - 1, 0)]
+    delta += np.where(i > 0, costs[left, order[j]] - costs[left, order[i]], 0.0)
+    right = order[np.minimum(j + 1, n - 1)]
+    delta += np.where(j < n - 1, costs[order[i], right] - costs[order[j], right], 0.0)
+    return i, j, delta
+
+def _or_opt_deltas(costs, order, pos, candidates, length):
+    # Moving order[i..e] (kept in direction) to just before order[q]. The
+    # candidate successors of the segment's last track pick q.
+    n = len(order)
+    e = np.repeat(np.arange(length - 1, n), candidates.shape[1])
+    q = pos[candidates[order[length - 1:]].ravel()]
+    i = e - length + 1
+    keep = (q < i) | (q > e + 1)
+    i, e, q = i[keep], e[keep], q[keep]
+
+    first, last = order[i], order[e]
+    prev = order[np.maximum(i - 1, 0)]
+    after = order[np.minimum(e + 1, n - 1)]
+    delta = (np.where((i > 0) & (e < n - 1), costs[prev, after], 0.0)
+             - np.where(i > 0, costs[prev, first], 0.0)
+             - np.where(e < n - 1, costs[last, after], 0.0))
+
+    target = order[q]
+    before = order[np.maximum(q - 1, 0)]
+    delta += costs[last, target] + np.where(q > 0, costs[before, first] - costs[before, target], 0.0)
+    return i, e, q, delta
+
+def _apply_two_opt_moves(order, i, j, delta):
+    # Applies the best improving reversals that don't touch each other's edges
+    taken = np.zeros(len(order) + 2, dtype=bool)
+    applied = 0
+    for move in np.argsort(delta)[:TWO_OPT_MOVES_PER_PASS]:
+        if delta[move] >= -1e-9:
+            break
+        start, end = i[move], j[move]
+        if taken[start:end + 3].any():
+            continue
+        taken[start:end + 3] = True
+        order[start:end + 1] = order[start:end + 1][::-1].copy()
+        applied += 1
+    return applied
+
+def _apply_or_opt_move(order, i, e, q):
+    segment = order[i:e + 1]
+    rest = np.concatenate((order[:i], order[e + 1:]))
+    insert_at = q if q < i else q - len(segment)
+    return np.concatenate((rest[:insert_at], segment, rest[insert_at:]))
+
+def improve_path(costs, order, time_budget, candidates=None):
+    # 2-opt and Or-opt local search over candidate successor lists, until no
+    # improving move is left or time_budget seconds have passed
+    n = len(order)
+    if n < 3:
+        return order
+    if candidates is None:
+        candidates = candidate_successors(costs, SEQUENCE_CANDIDATES)
+
+    order = np.array(order, dtype=np.int64)
+    pos = np.empty(n, dtype=np.int64)
+    deadline = time.perf_counter() + time_budget
+
+    while time.perf_counter() < deadline:
+        pos[order] = np.arange(n)
+        i, j, delta = _two_opt_deltas(costs, order, pos, candidates)
+        if len(delta) and _apply_two_opt_moves(order, i, j, delta):
+            continue
+
+        best = None
+        for length in range(1, min(OR_OPT_MAX_SEGMENT, n - 1) + 1):
+            i, e, q, delta = _or_opt_deltas(costs, order, pos, candidates, length)
+            if len(delta):
+                move = int(np.argmin(delta))
+                if delta[move] < -1e-9 and (best is None or delta[move] < best[0]):
+                    best = (delta[move], i[move], e[move], q[move])
+        if best is None:
+            break
+        order = _apply_or_opt_move(order, *best[1:])
+
+    return order
+
+def sequence_tracks(costs, time_budget=SEQUENCE_TIME_BUDGET, graph=None):
+    # Orders tracks so the sum of consecutive transition costs is small,
+    # treating costs[i, j] as the cost of playing j right after i. A
+    # TransitionGraph over the same tracks supplies the local search's
+    # candidate successors instead of another pass over costs.
+    if len(costs) == 0:
+        return np.empty(0, dtype=np.int64)
+    order = nearest_neighbour_path(costs)
+    candidates = graph.candidates(SEQUENCE_CANDIDATES) if graph is not None else None
+    return improve_path(costs, order, time_budget, candidates)
+
+def take_song_features(features, indices):
+    return {name: values[indices] for name, values in features.items()}
+
+class NearestTransitionIndex:
+    # Best next track lookups over a set of candidates that shrinks as
+    # candidates are used. Costs are computed one source row at a time, so
+    # memory stays linear in the number of candidates.
+
+    def __init__(self, features, graph=None):
+        self.features = features
+        self.graph = graph
+        self.remaining = np.ones(len(features['key']), dtype=bool)
+        self.count = len(self.remaining)
+
+    def __len__(self):
+        return self.count
+
+    def best_next(self, source_features, source=None):
+        # Index of the cheapest remaining candidate to play after the single
+        # song packed in source_features. When that song is candidate source
+        # and there is a TransitionGraph over the candidates, its cheapest
+        # remaining successor there is the answer without scoring anything.
+        if source is not None and self.graph is not None:
+            successors, _ = self.graph.successors(source)
+            successors = successors[self.remaining[successors]]
+            if len(successors):
+                return int(successors[0])
+
+        costs = transition_cost_matrix(source_features, self.features)[0]
+        costs[~self.remaining] = np.inf
+        return int(np.argmin(costs))
+
+    def remove(self, index):
+        if self.remaining[index]:
+            self.remaining[index] = False
+            self.count -= 1
+
+# Successors kept per track in a TransitionGraph, and how many playlist
+# graphs stay in memory. With TRANSITION_GRAPH_DIR set, playlist graphs are
+# also saved there and outlive the process.
+TRANSITION_GRAPH_K = int(os.getenv("TRANSITION_GRAPH_K", 16))
+TRANSITION_GRAPH_CACHE_SIZE = int(os.getenv("TRANSITION_GRAPH_CACHE_SIZE", 8))
+TRANSITION_GRAPH_DIR = os.getenv("TRANSITION_GRAPH_DIR")
+
+TRANSITION_GRAPH_FORMAT_VERSION = 1
+
+class TransitionGraph:
+    # The k cheapest next tracks of every track with their costs, as a CSR
+    # adjacency: the successors of track i are indices[indptr[i]:indptr[i + 1]],
+    # cheapest first. Memory is O(N·k) where a cost matrix is O(N²). A graph
+    # never changes once built; update returns a new one.
+
+    def __init__(self, track_ids, indptr, indices, costs, k):
+        self.track_ids = list(track_ids)
+        self.indptr = indptr
+        self.indices = indices
+        self.costs = costs
+        self.k = k
+        self.rows_reused = 0
+        self._positions = None
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    @classmethod
+    def from_nearest(cls, track_ids, cols, costs, k):
+        # From CostEngine.nearest output, dropping its padding
+        filled = cols >= 0
+        indptr = np.concatenate(([0], np.cumsum(filled.sum(axis=1)))).astype(np.int64)
+        return cls(track_ids, indptr, cols[filled].astype(np.int32), costs[filled], k)
+
+    @classmethod
+    def build(cls, track_ids, features, k=TRANSITION_GRAPH_K):
+        cols, costs = cost_engine.nearest(features, k)
+        return cls.from_nearest(track_ids, cols, costs, k)
+
+    @classmethod
+    def from_costs(cls, track_ids, costs, k=TRANSITION_GRAPH_K):
+        # From a cost matrix that has already been computed, a few rows at a
+        # time so only about one tile's worth of entries is copied
+        n = len(costs)
+        width = max(0, min(k, n - 1))
+        cols = np.empty((n, width), dtype=np.int64)
+        best_costs = np.empty((n, width))
+        tile_rows = max(1, COST_TILE_SIZE * COST_TILE_SIZE // max(n, 1))
+        for start in range(0, n if width else 0, tile_rows):
+            rows = np.arange(start, min(start + tile_rows, n))
+            block = np.array(costs[start:rows[-1] + 1], dtype=np.float64)
+            block[np.arange(len(rows)), rows] = np.inf
+            best = np.argpartition(block, width - 1, axis=1)[:, :width]
+            best_block = np.take_along_axis(block, best, axis=1)
+            order = np.argsort(best_block, axis=1, kind='stable')
+            cols[rows] = np.take_along_axis(best, order, axis=1)
+            best_costs[rows] = np.take_along_axis(best_block, order, axis=1)
+        return cls.from_nearest(track_ids, cols, best_costs, k)
+
+    def position(self, track_id):
+        if self._positions is None:
+            self._positions = {track_id: i for i, track_id in enumerate(self.track_ids)}
+        return self._positions.get(track_id)
+
+    def successors(self, i):
+        # (indices, costs) of track i's successors, cheapest first
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.indices[start:end], self.costs[start:end]
+
+    def padded(self, width=None):
+        # Successors as (n, width) arrays, padded with -1 and inf
+        counts = np.diff(self.indptr)
+        if width is None:
+            width = int(counts.max()) if len(counts) else 0
+        cols = np.full((len(self), width), -1, dtype=np.int64)
+        costs = np.full((len(self), width), np.inf)
+        slot = np.arange(len(self.indices)) - np.repeat(self.indptr[:-1], counts)
+        fits = slot < width
+        row = np.repeat(np.arange(len(self)), counts)
+        cols[row[fits], slot[fits]] = self.indices[fits]
+        costs[row[fits], slot[fits]] = self.costs[fits]
+        return cols, costs
+
+    def candidates(self, k):
+        # The k cheapest successors of every track as improve_path takes
+        # them, or None when some track has fewer than the graph allows
+        counts = np.diff(self.indptr)
+        k = min(k, len(self) - 1)
+        if not len(self) or counts.min() < k:
+            return None
+        return self.padded(k)[0]
+
+    def sparse(self):
+        return csr_matrix((self.costs, self.indices, self.indptr), shape=(len(self), len(self)))
+
+    def update(self, track_ids, features, k=None):
+        # The graph over track_ids, whose songs are packed in features in
+        # that order. Rows of tracks still here are reused and only offered
+        # the added tracks as new successors. A row is scored again only if
+        # one of its successors was removed, since the one that would
+        # replace it isn't known.
+        k = self.k if k is None else k
+        if k != self.k:
+            return TransitionGraph.build(track_ids, features, k)
+
+        track_ids = list(track_ids)
+        old = np.array([-1 if self.position(track_id) is None else self.position(track_id)
+                        for track_id in track_ids], dtype=np.int64)
+        if len(track_ids) == len(self) and np.array_equal(old, np.arange(len(self))):
+            return self
+
+        kept = np.flatnonzero(old >= 0)
+        added = np.flatnonzero(old < 0)
+        new_position = np.full(len(self), -1, dtype=np.int64)
+        new_position[old[kept]] = kept
+
+        # Kept rows with their successors renumbered, removed ones as -1
+        cols, costs = self.padded()
+        cols, costs = cols[old[kept]], costs[old[kept]]
+        listed = cols >= 0
+        cols = np.where(listed, new_position[np.maximum(cols, 0)], -1)
+        lost = (listed & (cols < 0)).any(axis=1)
+        # A row that listed every other track still lists all that are left
+        complete = listed.sum(axis=1) >= len(self) - 1
+        costs = np.where(cols >= 0, costs, np.inf)
+
+        redo = np.concatenate((kept[lost & ~complete], added))
+        reused = ~(lost & ~complete)
+        width = max(0, min(k, len(track_ids) - 1))
+        rows = kept[reused]
+        cols, costs = cols[reused], costs[reused]
+        if len(rows) and len(added):
+            added_cols, added_costs = cost_engine.nearest(features, k, rows, added)
+            cols, costs = merge_nearest(cols, costs, added_cols, added_costs, width)
+        elif cols.shape[1] > width:
+            cols, costs = merge_nearest(cols, costs, cols[:, :0], costs[:, :0], width)
+
+        best_cols = np.full((len(track_ids), width), -1, dtype=np.int64)
+        best_costs = np.full((len(track_ids), width), np.inf)
+        best_cols[rows, :cols.shape[1]] = cols
+        best_costs[rows, :cols.shape[1]] = costs
+        if len(redo):
+            redo = np.sort(redo)
+            redo_cols, redo_costs = cost_engine.nearest(features, k, redo)
+            best_cols[redo, :redo_cols.shape[1]] = redo_cols
+            best_costs[redo, :redo_cols.shape[1]] = redo_costs
+
+        order = np.argsort(best_costs, axis=1, kind='stable')
+        graph = TransitionGraph.from_nearest(
+            track_ids, np.take_along_axis(best_cols, order, axis=1), np.take_along_axis(best_costs, order, axis=1), k)
+        graph.rows_reused = len(rows)
+        return graph
+
+    def save(self, path):
+        # Written beside path and renamed over it, so readers never see half a file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, version=TRANSITION_GRAPH_FORMAT_VERSION, k=self.k,
+                     track_ids=np.array(self.track_ids, dtype=str), indptr=self.indptr,
+                     indices=self.indices, costs=self.costs)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as saved:
+            if int(saved['version']) != TRANSITION_GRAPH_FORMAT_VERSION:
+                raise ValueError(f"{path} has transition graph format {int(saved['version'])}")
+            return cls(saved['track_ids'].tolist(), saved['indptr'], saved['indices'], saved['costs'], int(saved['k']))
+
+transition_graphs = OrderedDict()
+transition_graphs_lock = threading.Lock()
+
+def transition_graph_path(playlist_id):
+    return os.path.join(TRANSITION_GRAPH_DIR, f"{playlist_id}.npz")
+
+def cached_transition_graph(playlist_id):
+    # The last graph built for a playlist, from memory or TRANSITION_GRAPH_DIR
+    with transition_graphs_lock:
+        graph = transition_graphs.get(playlist_id)
+        if graph is not None:
+            transition_graphs.move_to_end(playlist_id)
+            return graph
+    if not TRANSITION_GRAPH_DIR or not os.path.exists(transition_graph_path(playlist_id)):
+        return None
 
-    best_transition_track_uri = min(
-        transition_scores, key=transition_scores.get)
+    try:
+        graph = TransitionGraph.load(transition_graph_path(playlist_id))
+    except (OSError, ValueError, KeyError):
+        return None
+    remember_transition_graph(playlist_id, graph, save=False)
+    return graph
+
+def remember_transition_graph(playlist_id, graph, save=True):
+    with transition_graphs_lock:
+        transition_graphs[playlist_id] = graph
+        transition_graphs.move_to_end(playlist_id)
+        while len(transition_graphs) > TRANSITION_GRAPH_CACHE_SIZE:
+            transition_graphs.popitem(last=False)
+    if save and TRANSITION_GRAPH_DIR:
+        os.makedirs(TRANSITION_GRAPH_DIR, exist_ok=True)
+        graph.save(transition_graph_path(playlist_id))
+
+def get_transition_graph(playlist_id, track_ids, features, build=True):
+    # A playlist's TransitionGraph over track_ids, updated from the cached
+    # one if tracks were added or removed since. Without a cached graph one
+    # is built, or None returned if build is false. Without a playlist ID
+    # the graph is built and not kept.
+    graph = cached_transition_graph(playlist_id) if playlist_id is not None else None
+    if graph is None and not build:
+        return None
 
-    best_transition_track = sp.track(best_transition_track_uri)
+    new_graph = TransitionGraph.build(track_ids, features) if graph is None else graph.update(track_ids, features)
+    if playlist_id is not None and new_graph is not graph:
+        remember_transition_graph(playlist_id, new_graph)
+    return new_graph
+
+def graph_path(graph, features, start=0):
+    # nearest_neighbour_path without a cost matrix: each step follows the
+    # current track's cheapest unplayed successor in the graph, and only
+    # scores it against every unplayed track when all of them were played
+    n = len(graph)
+    visited = np.zeros(n, dtype=bool)
+    order = np.empty(n, dtype=np.int64)
+    current = start
+    for step in range(n):
+        order[step] = current
+        visited[current] = True
+        if step == n - 1:
+            break
 
-    return best_transition_track
+        successors, _ = graph.successors(current)
+        successors = successors[~visited[successors]]
+        if len(successors):
+            current = int(successors[0])
+            continue
+        unplayed = np.flatnonzero(~visited)
+        costs = transition_cost_matrix(take_song_features(features, [current]),
+                                       take_song_features(features, unplayed))[0]
+        current = int(unplayed[np.argmin(costs)])
+    return order
+
+# Consecutive transitions feature_path_cost scores at once
+PATH_COST_CHUNK = 64
+
+def feature_path_cost(features, order):
+    # path_cost without a cost matrix
+    order = np.asarray(order)
+    total = 0.0
+    for start in range(0, len(order) - 1, PATH_COST_CHUNK):
+        sources = order[start:start + PATH_COST_CHUNK]
+        targets = order[start + 1:start + PATH_COST_CHUNK + 1]
+        sources = sources[:len(targets)]
+        costs = transition_cost_matrix(take_song_features(features, sources), take_song_features(features, targets))
+        total += float(np.trace(costs))
+    return total
+
+# Width in BPM of the tempo bands TransitionIndex groups tracks by
+TEMPO_BAND_WIDTH = 4.0
+
+# Most tracks in one TransitionIndex leaf, and about how many tracks a
+# query scores at once
+INDEX_LEAF_SIZE = 32
+INDEX_QUERY_BATCH = 512
+
+# Playlist indexes kept for /find_best_transition, keyed by snapshot
+PLAYLIST_INDEX_CACHE_SIZE = int(os.getenv("PLAYLIST_INDEX_CACHE_SIZE", 8))
+
+def _range_gap(value, low, high):
+    # Distance from value to the closest point of [low, high]
+    return np.maximum(0.0, np.maximum(low - value, value - high))
+
+def _split_leaves(points, rows, leaf_size):
+    # kd-tree style split of rows into leaves of at most leaf_size, always
+    # halving along the dimension with the widest spread
+    leaves = []
+    pending = [rows]
+    while pending:
+        rows = pending.pop()
+        if len(rows) <= leaf_size:
+            leaves.append(rows)
+            continue
+        values = points[rows]
+        dimension = int(np.argmax(values.max(axis=0) - values.min(axis=0)))
+        rows = rows[np.argsort(values[:, dimension], kind='stable')]
+        middle = len(rows) // 2
+        pending.append(rows[middle:])
+        pending.append(rows[:middle])
+    return leaves
+
+class TransitionIndex:
+    # Top-k best next track queries over a fixed library without a full scan.
+    # Tracks are grouped by key, mode and tempo band, then split into small
+    # leaves of similar danceability, energy, loudness and valence. Each leaf
+    # keeps the range of every feature and the union of its genres, which
+    # bound the cost of any transition into it from below. Leaves are scored
+    # in order of that bound until it can't beat the current k-th best.
+
+    def __init__(self, track_ids, songs, tempo_band_width=TEMPO_BAND_WIDTH, leaf_size=INDEX_LEAF_SIZE):
+        features = pack_song_features(songs)
+        n = len(track_ids)
+
+        band = np.floor(features['tempo'] / tempo_band_width).astype(np.int64)
+        n_bands = int(band.max()) + 1 if n else 1
+        bucket_of = features['key_slot'] * n_bands + band
+        by_bucket = np.argsort(bucket_of, kind='stable')
+        bucket_starts = np.flatnonzero(np.r_[True, np.diff(bucket_of[by_bucket]) != 0]) if n else []
+
+        # Scaled by their evaluate_transition weights so splits follow cost
+        points = np.column_stack([
+            7 * features['danceability'],
+            5 * features['energy'],
+            features['loudness'] / 60,
+            5 * features['valence'],
+            features['tempo'] / 2,
+        ])
+        leaves = []
+        for rows in np.split(by_bucket, bucket_starts[1:]) if n else []:
+            leaves.extend(_split_leaves(points, rows, leaf_size))
+        order = np.concatenate(leaves) if leaves else np.empty(0, np.int64)
+
+        self.track_ids = [track_ids[i] for i in order]
+        self.positions = order
+        self.features = take_song_features(features, order)
+
+        sizes = np.array([len(rows) for rows in leaves], dtype=np.int64)
+        self.starts = np.cumsum(sizes) - sizes
+        self.ends = self.starts + sizes
+        self.low = {}
+        self.high = {}
+        for column in ('danceability', 'energy', 'loudness', 'tempo', 'valence'):
+            values = self.features[column]
+            self.low[column] = np.minimum.reduceat(values, self.starts) if n else values
+            self.high[column] = np.maximum.reduceat(values, self.starts) if n else values
+        self.leaf_key_slot = self.features['key_slot'][self.starts]
+        genre_bits = self.features['genre_bits']
+        self.leaf_genres = np.bitwise_or.reduceat(genre_bits, self.starts, axis=0) if n else genre_bits
+        self.leaf_common_genres = np.bitwise_and.reduceat(genre_bits, self.starts, axis=0) if n else genre_bits
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def lower_bounds(self, source):
+        # Lowest cost any track in each leaf can have after the source song,
+        # following the same terms as evaluate_transition
+        bound = KEY_PENALTY[source['key_slot'][0], self.leaf_key_slot]
+
+        bound += 7 * _range_gap(source['danceability'][0], self.low['danceability'], self.high['danceability'])
+        bound += 5 * _range_gap(source['energy'][0], self.low['energy'], self.high['energy'])
+        bound += 1 * (_range_gap(source['loudness'][0], self.low['loudness'], self.high['loudness']) / 60)
+
+        tempo = source['tempo'][0]
+        tempo_gap = np.minimum(np.minimum(
+            _range_gap(tempo, self.low['tempo'], self.high['tempo']),
+            _range_gap(tempo * 2, self.low['tempo'], self.high['tempo'])),
+            _range_gap(tempo / 2, self.low['tempo'], self.high['tempo']))
+        bound += 100 * (tempo_gap / 200)
+
+        bound += 5 * _range_gap(source['valence'][0], self.low['valence'], self.high['valence'])
+
+        shared = shared_genre_matrix(source['genre_bits'], self.leaf_genres)[0]
+        bound += 4 * (5 - np.minimum(shared, 5))
+        return bound
+
+    def upper_bounds(self, other):
+        # Highest cost any transition from a track in one of these leaves to a
+        # track in one of other's leaves can have, as [own leaf, other leaf]
+        def spread(low1, high1, low2, high2):
+            # Largest distance between a point of [low1, high1] and one of [low2, high2]
+            return np.maximum(high1[:, None] - low2[None, :], high2[None, :] - low1[:, None])
+
+        def column_spread(column):
+            return spread(self.low[column], self.high[column], other.low[column], other.high[column])
+
+        bound = KEY_PENALTY[self.leaf_key_slot[:, None], other.leaf_key_slot[None, :]].astype(np.float64)
+
+        bound += 7 * column_spread('danceability')
+        bound += 5 * column_spread('energy')
+        bound += 1 * (column_spread('loudness') / 60)
+
+        low, high = self.low['tempo'], self.high['tempo']
+        other_low, other_high = other.low['tempo'], other.high['tempo']
+        tempo_spread = np.minimum(np.minimum(
+            spread(low, high, other_low, other_high),
+            spread(low * 2, high * 2, other_low, other_high)),
+            spread(low / 2, high / 2, other_low, other_high))
+        bound += 100 * (tempo_spread / 200)
+
+        bound += 5 * column_spread('valence')
+
+        # Genres every track of both leaves has are shared by every pair
+        shared = shared_genre_matrix(self.leaf_common_genres, other.leaf_common_genres)
+        bound += 4 * (5 - np.minimum(shared, 5))
+        return bound
+
+    def query(self, source, k=1, exclude=()):
+        # The k cheapest (track_id, cost) transitions after the single song
+        # packed in source, cheapest first, ties broken by library order
+        if not len(self):
+            return []
+        bounds = self.lower_bounds(source)
+        leaves = np.argsort(bounds, kind='stable')
+
+        # Max-heap of the best k so far, worst on top
+        best = []
+        next_leaf = 0
+        while next_leaf < len(leaves):
+            # Score the next few leaves whose bound can still beat the k-th best
+            batch = []
+            batch_size = 0
+            while next_leaf < len(leaves) and batch_size < INDEX_QUERY_BATCH:
+                leaf = leaves[next_leaf]
+                if len(best) == k and bounds[leaf] > -best[0][0] + 1e-9:
+                    next_leaf = len(leaves)
+                    break
+                batch.append(np.arange(self.starts[leaf], self.ends[leaf]))
+                batch_size += len(batch[-1])
+                next_leaf += 1
+            if not batch:
+                break
+
+            rows = np.concatenate(batch)
+            costs = transition_cost_matrix(source, take_song_features(self.features, rows))[0]
+            for candidate in np.argsort(costs, kind='stable')[:k + len(exclude)]:
+                row = rows[candidate]
+                if self.track_ids[row] in exclude:
+                    continue
+                item = (-costs[candidate], -self.positions[row], row)
+                if len(best) < k:
+                    heapq.heappush(best, item)
+                elif item[:2] > best[0][:2]:
+                    heapq.heapreplace(best, item)
+
+        return [(self.track_ids[row], float(-cost)) for cost, _, row in sorted(best, reverse=True)]
+
+playlist_indexes = OrderedDict()
+playlist_indexes_lock = threading.Lock()
+
+def build_transition_index(track_uris):
+    context = TrackContext()
+    song_data_map = context.load(track_uris)
+    with metrics.stage("index"):
+        index = TransitionIndex(list(song_data_map), list(song_data_map.values()))
+    return index, context
+
+def get_playlist_index(playlist_id):
+    # (TransitionIndex, TrackContext) for a playlist, rebuilt only when its
+    # snapshot changes
+    key = (playlist_id, playlist_snapshot_id(playlist_id))
+    with playlist_indexes_lock:
+        if key in playlist_indexes:
+            playlist_indexes.move_to_end(key)
+            return playlist_indexes[key]
+
+    track_uris = [x["track"]["uri"] for x in get_all_playlist_tracks(playlist_id)]
+    index, context = build_transition_index(track_uris)
+
+    with playlist_indexes_lock:
+        playlist_indexes[key] = (index, context)
+        while len(playlist_indexes) > PLAYLIST_INDEX_CACHE_SIZE:
+            playlist_indexes.popitem(last=False)
+    return index, context
+
+# Tracks per "tracks" event of a streamed response
+STREAM_CHUNK_SIZE = 100
+
+STREAM_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'sse': 'text/event-stream',
+}
+
+def track_events(context, name, track_ids):
+    # Serializes track_ids a chunk at a time so a streamed response never holds
+    # the whole list. Always yields at least one event so the list exists.
+    track_ids = list(track_ids)
+    for start in range(0, max(len(track_ids), 1), STREAM_CHUNK_SIZE):
+        with metrics.stage("response"):
+            tracks = context.serialize(track_ids[start:start + STREAM_CHUNK_SIZE], start + 1)
+        yield {"event": "tracks", "name": name, "tracks": tracks}
+
+def error_event(error, status):
+    return {"event": "error", "error": error, "status": status}
+
+def number_option(data, name, default, maximum=None):
+    # Non-negative number a request gives for name, or default, capped at
+    # maximum. Raises ValueError for anything else, which callers answer
+    # with a 400 error event.
+    value = data.get(name, default)
+    try:
+        number = float(value) if not isinstance(value, bool) else None
+    except (TypeError, ValueError):
+        number = None
+    if number is None or not math.isfinite(number) or number < 0:
+        raise ValueError(f"{name} must be a non-negative number")
+    return min(number, maximum) if maximum is not None else number
+
+def integer_option(data, name, default, minimum=1):
+    # Whole number of at least minimum a request gives for name, or default.
+    # Raises ValueError for anything else, like number_option.
+    value = data.get(name, default)
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    try:
+        number = int(value) if not isinstance(value, (bool, float)) else None
+    except (TypeError, ValueError):
+        number = None
+    if number is None or number < minimum:
+        raise ValueError(f"{name} must be a whole number of at least {minimum}")
+    return number
+
+def collect_events(events, on_progress=None):
+    # Runs an endpoint's events to completion and assembles the regular
+    # JSON response from them
+    response_data = {}
+    for event in events:
+        if event["event"] == "progress" and on_progress is not None:
+            on_progress(event)
+        elif event["event"] == "tracks":
+            response_data.setdefault(event["name"], []).extend(event["tracks"])
+        elif event["event"] == "playlist":
+            response_data.setdefault("playlists", []).append(
+                {key: value for key, value in event.items() if key != "event"})
+        elif event["event"] == "result":
+            response_data.update((key, value) for key, value in event.items() if key != "event")
+        elif event["event"] == "error":
+            return {"error": event["error"]}, event["status"]
+    return response_data, 200
+
+def requested_stream_format(data):
+    stream_format = data.get('stream')
+    if stream_format in STREAM_MIMETYPES:
+        return stream_format
+    for stream_format, mimetype in STREAM_MIMETYPES.items():
+        if request.accept_mimetypes.best == mimetype:
+            return stream_format
+    return None
+
+def format_event(event, stream_format):
+    if stream_format == 'sse':
+        return f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+    return json.dumps(event) + "\n"
+
+def respond(events, data):
+    # Streams the events as NDJSON or server-sent events when the client asks
+    # for it with "stream" in the body or the Accept header, otherwise sends
+    # one JSON body once everything is done
+    stream_format = requested_stream_format(data)
+    if stream_format is None:
+        response_data, status = collect_events(events)
+        with metrics.stage("response"):
+            return jsonify(response_data), status
+
+    # The stream runs after the request has returned, so it finishes the
+    # request's metrics itself
+    request_metrics = metrics.current()
+    if request_metrics is not None:
+        request_metrics.streamed = True
+
+    def stream():
+        # A failure after the first chunk can't change the status any more,
+        # so the stream ends with an error event instead of just stopping
+        metrics.resume(request_metrics)
+        try:
+            for event in events:
+                yield format_event(event, stream_format)
+        except Exception as e:
+            app.logger.exception("Streamed response failed")
+            metrics.set_status(500)
+            yield format_event(error_event(str(e), 500), stream_format)
+        finally:
+            metrics.finish()
+
+    return Response(
+        stream_with_context(stream()),
+        mimetype=STREAM_MIMETYPES[stream_format],
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route('/find_best_transition', methods=['POST'])
 def find_best_transition():
     data = request.get_json()
     single_track = data.get('single_track')
-    playlist_link = data.get('playlist_link')
-
-    if not single_track or not playlist_link:
-        return jsonify({"error": "Both single_track and playlist_link are required"}), 400
-
-    uri = playlist_link.split("/")[-1].split("?")[0]
-    playlist_tracks = [x["track"]["uri"] for x in get_all_playlist_tracks(uri)]
-
-    # Fetch song data in parallel
-    with ThreadPoolExecutor() as executor:
-        song_data_map = {song: data for song, data in zip(
-            playlist_tracks, executor.map(get_song_data, playlist_tracks)) if data is not None}
 
-    single_track_data = get_song_data(single_track)
-    transition_scores = {track: evaluate_transition(single_track_data, song_data) for track, song_data in song_data_map.items()}
+    if not single_track or not has_requested_tracks(data, 'playlist_link'):
+        return jsonify({"error": "Both single_track and playlist_link (or track_ids) are required"}), 400
 
-    best_transition_track = min(transition_scores, key=transition_scores.get)
-
-    # Get track details
-    track = sp.track(best_transition_track)
-    track_name = track["name"]
-    artist = track["artists"][0]["name"]
-
-    # Get tempo details
-    original_track_tempo = single_track_data['tempo']
-    best_track_tempo = song_data_map[best_transition_track]['tempo']
+    try:
+        k = integer_option(data, 'k', 1)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Listed track IDs get an index of their own, playlists a cached one.
+    # A playlist that already has a TransitionGraph answers for its own
+    # tracks from there.
+    graph = None
+    if data.get('track_ids'):
+        index, context = build_transition_index(data['track_ids'])
+    else:
+        uri = data['playlist_link'].split("/")[-1].split("?")[0]
+        index, context = get_playlist_index(uri)
+        with metrics.stage("graph"):
+            graph = get_transition_graph(uri, index.track_ids, index.features, build=False)
+
+    single_track_data = TrackContext().load([single_track]).get(single_track)
+    if single_track_data is None:
+        return jsonify({"error": "single_track could not be found"}), 400
+
+    # Suggest the cheapest transitions out of the track, other than itself
+    position = graph.position(single_track) if graph is not None and k <= graph.k else None
+    with metrics.stage("costs"):
+        if position is not None:
+            successors, costs = graph.successors(position)
+            suggestions = [(graph.track_ids[i], float(cost)) for i, cost in zip(successors[:k], costs[:k])]
+        else:
+            suggestions = index.query(pack_song_features([single_track_data]), k, exclude={single_track})
+    if not suggestions:
+        return jsonify({"error": "The playlist is empty or not accessible"}), 400
+
+    def suggestion(track_id, cost):
+        record = context.records[track_id]
+        return {
+            "track_name": record["track_name"],
+            "artist": record["artist_name"],
+            "uri": track_id,
+            "tempo": context.song_data_map[track_id]['tempo'],
+            "transition_cost": cost,
+        }
 
     response_data = {
         "original_track": {
             "uri": single_track,
-            "tempo": original_track_tempo,
+            "tempo": single_track_data['tempo'],
         },
-        "best_transition_track": {
-            "track_name": track_name,
-            "artist": artist,
-            "uri": best_transition_track,
-            "tempo": best_track_tempo,
-        }
+        "best_transition_track": suggestion(*suggestions[0]),
+        "suggestions": [suggestion(*match) for match in suggestions],
     }
 
     return jsonify(response_data), 200
 
-@app.route('/b2b_playlist', methods=['POST'])
-def generate_b2b_playlist():
-    data = request.get_json()
-    playlist1_link = data.get('playlist1_link')
-    playlist2_link = data.get('playlist2_link')
-
-    if not playlist1_link or not playlist2_link:
-        return jsonify({"error": "Both playlist1_link and playlist2_link are required"}), 400
+def b2b_playlist_events(data):
+    if not has_requested_tracks(data, 'playlist1_link') or not has_requested_tracks(data, 'playlist2_link'):
+        yield error_event("Both playlist1_link (or playlist1_track_ids) and "
+                          "playlist2_link (or playlist2_track_ids) are required", 400)
+        return
 
-    # Get track URIs from playlist1
-    playlist1_uri = playlist1_link.split("/")[-1].split("?")[0]
-    playlist1_tracks = [x["track"]["uri"]
-                        for x in get_all_playlist_tracks(playlist1_uri)]
-
-    # Get track URIs from playlist2
-    playlist2_uri = playlist2_link.split("/")[-1].split("?")[0]
-    playlist2_tracks = [x["track"]["uri"]
-                        for x in get_all_playlist_tracks(playlist2_uri)]
+    # Fetch song data for both playlists once, while paging through them
+    context = TrackContext()
+    playlist1_tracks = []
+    yield from load_requested_tracks(context, data, 'playlist1_link', playlist1_tracks)
+    playlist2_tracks = []
+    yield from load_requested_tracks(context, data, 'playlist2_link', playlist2_tracks)
 
     if not playlist1_tracks or not playlist2_tracks:
-        return jsonify({"error": "One or both playlists are empty or not accessible"}), 400
-
-    b2b_playlist = []
+        yield error_event("One or both playlists are empty or not accessible", 400)
+        return
 
-    # Start with the first track from playlist1
-    current_track = playlist1_tracks[0]
-    b2b_playlist.append(sp.track(current_track))
+    song_data_map = context.load(playlist1_tracks + playlist2_tracks)
+    playlist1_tracks = [track for track in playlist1_tracks if track in song_data_map]
+    playlist2_tracks = list(dict.fromkeys(
+        track for track in playlist2_tracks if track in song_data_map))
 
-    # Iterate through playlist2 and playlist1 alternately
-    while playlist2_tracks:
-        try:
-            best_transition_track = find_best_transition(
-                current_track, playlist2_tracks)
-            b2b_playlist.append(best_transition_track)
-
-            # Remove the used track from playlist2
-            playlist2_tracks.remove(best_transition_track['uri'])
-
-            if playlist1_tracks:
-                # Find the best track from playlist1 excluding the current track
-                current_track = playlist1_tracks[0]
-                playlist1_tracks.remove(current_track)
-        except SpotifyException as e:
-            return jsonify({"error": str(e)}), 500
+    if not playlist1_tracks or not playlist2_tracks:
+        yield error_event("One or both playlists are empty or not accessible", 400)
+        return
+
+    with metrics.stage("costs"):
+        playlist1_features = pack_song_features([song_data_map[track] for track in playlist1_tracks])
+        playlist2_features = pack_song_features([song_data_map[track] for track in playlist2_tracks])
+
+    # After a playlist2 track, the next one comes from playlist2's cached
+    # TransitionGraph, which is built the first time
+    graph = None
+    if not data.get('playlist2_track_ids'):
+        with metrics.stage("graph"):
+            graph = get_transition_graph(data['playlist2_link'].split("/")[-1].split("?")[0],
+                                         playlist2_tracks, playlist2_features)
+    candidates = NearestTransitionIndex(playlist2_features, graph)
+
+    # Alternate between playlist1 in order and the best remaining transition
+    # into playlist2. Once playlist1 runs out, keep chaining playlist2 tracks.
+    with metrics.stage("sequence"):
+        b2b_playlist = []
+        next_playlist1 = 0
+        while candidates:
+            source = None
+            if next_playlist1 < len(playlist1_tracks):
+                b2b_playlist.append(playlist1_tracks[next_playlist1])
+                current = take_song_features(playlist1_features, [next_playlist1])
+                next_playlist1 += 1
+            else:
+                source = best
+
+            best = candidates.best_next(current, source)
+            candidates.remove(best)
+            b2b_playlist.append(playlist2_tracks[best])
+            current = take_song_features(playlist2_features, [best])
 
     # Build the response
-    response_data = {
-        "b2b_playlist": []
-    }
-
-    for i, track in enumerate(b2b_playlist):
-        position = i + 1
-        track_name = track["name"]
-        artist = track["artists"][0]["name"]
-        album_name = track["album"]["name"]
-
-        try:
-            album_cover = track["album"]["images"][0]["url"]
-        except IndexError:
-            album_cover = None
-
-        popularity = track["popularity"]
-        tempo = track["tempo"]
-        danceability = track["danceability"]
+    yield from track_events(context, "b2b_playlist", b2b_playlist)
 
-        response_data["b2b_playlist"].append({
-            "position": position,
-            "track_name": track_name,
-            "artist": artist,
-            "album_name": album_name,
-            "album_cover": album_cover,
-            "popularity": popularity,
-            "tempo": tempo,
-            "danceability": danceability,
-            "uri": track["uri"],
-        })
-
-    return jsonify(response_data), 200
+@app.route('/b2b_playlist', methods=['POST'])
+def generate_b2b_playlist():
+    data = request.get_json()
+    return respond(b2b_playlist_events(data), data)
+
+# Most items one playlist add or remove request takes
+PLAYLIST_WRITE_BATCH = 100
+
+def longest_increasing_subsequence(values):
+    # One longest strictly increasing subsequence of values, as a list of values
+    tails = []
+    tail_indices = []
+    previous = [None] * len(values)
+    for i, value in enumerate(values):
+        length = bisect.bisect_left(tails, value)
+        if length == len(tails):
+            tails.append(value)
+            tail_indices.append(i)
+        else:
+            tails[length] = value
+            tail_indices[length] = i
+        previous[i] = tail_indices[length - 1] if length else None
+
+    subsequence = []
+    i = tail_indices[-1] if tail_indices else None
+    while i is not None:
+        subsequence.append(values[i])
+        i = previous[i]
+    return subsequence[::-1]
+
+def playlist_moves(current, target, limit=None):
+    # (range_start, insert_before, range_length) reorders that turn current
+    # into target, which must hold the same tracks. Tracks on a longest
+    # increasing run of target positions stay put and every other track moves
+    # once, to just after the track before it in target, along with any
+    # tracks already lined up behind it. None if it takes more than limit moves.
+    slots = {}
+    for position, uri in enumerate(target):
+        slots.setdefault(uri, []).append(position)
+    for positions in slots.values():
+        positions.reverse()
+    order = [slots[uri].pop() for uri in current]
+
+    stays = set(longest_increasing_subsequence(order))
+    moves = []
+    for value in range(len(order)):
+        if value in stays:
+            continue
+        start = order.index(value)
+        before = order.index(value - 1) + 1 if value else 0
+        if start == before:
+            continue
+        length = 1
+        while (start + length < len(order) and order[start + length] == value + length
+               and value + length not in stays):
+            length += 1
+
+        block = order[start:start + length]
+        if before > start:
+            order = order[:start] + order[start + length:before] + block + order[before:]
+        else:
+            order = order[:before] + block + order[before:start] + order[start + length:]
+        moves.append((start, before, length))
+        if limit is not None and len(moves) > limit:
+            return None
+    return moves
+
+def surplus_positions(current, target):
+    # Positions in current of the occurrences target doesn't have, keeping
+    # the first occurrences of each track
+    remaining = Counter(target)
+    positions = []
+    for position, uri in enumerate(current):
+        if remaining[uri]:
+            remaining[uri] -= 1
+        else:
+            positions.append(position)
+    return positions
+
+def batch_count(n):
+    return -(-n // PLAYLIST_WRITE_BATCH)
+
+def remove_playlist_positions(client, playlist_id, current, positions, snapshot_id):
+    # Removes the tracks at ascending positions of current, a batch per
+    # request. Returns the new snapshot ID.
+    for start in range(0, len(positions), PLAYLIST_WRITE_BATCH):
+        # Earlier batches already shifted these positions down by start
+        by_uri = {}
+        for position in positions[start:start + PLAYLIST_WRITE_BATCH]:
+            by_uri.setdefault(current[position], []).append(position - start)
+        items = [{"uri": uri, "positions": uri_positions} for uri, uri_positions in by_uri.items()]
+        snapshot_id = client.playlist_remove_specific_occurrences_of_items(
+            playlist_id, items, snapshot_id)["snapshot_id"]
+    return snapshot_id
+
+def add_playlist_items(client, playlist_id, uris, snapshot_id):
+    for start in range(0, len(uris), PLAYLIST_WRITE_BATCH):
+        snapshot_id = client.playlist_add_items(
+            playlist_id, uris[start:start + PLAYLIST_WRITE_BATCH])["snapshot_id"]
+    return snapshot_id
+
+def write_playlist_order(client, playlist_id, new_uris):
+    # Makes the playlist hold exactly new_uris, in order, with as few write
+    # requests as possible and without ever dropping a track that new_uris
+    # keeps. Each write names the snapshot the previous one produced.
+    snapshot_id = client.playlist(playlist_id, fields="snapshot_id")["snapshot_id"]
+    current = [item["track"]["uri"] for item in get_all_playlist_tracks(playlist_id, client)]
+
+    # Remove only the tracks new_uris doesn't have, append the ones it adds
+    # and move the rest into place...
+    removed = surplus_positions(current, new_uris)
+    removed_positions = set(removed)
+    kept = [uri for position, uri in enumerate(current) if position not in removed_positions]
+    added = [new_uris[position] for position in surplus_positions(new_uris, kept)]
+    edit_calls = batch_count(len(removed)) + batch_count(len(added))
+
+    # ...unless appending the whole new order and then removing the old
+    # tracks in front of it takes fewer requests
+    rebuild_calls = batch_count(len(new_uris)) + batch_count(len(current))
+    moves = playlist_moves(kept + added, new_uris, rebuild_calls - edit_calls)
+
+    if moves is None:
+        snapshot_id = add_playlist_items(client, playlist_id, new_uris, snapshot_id)
+        remove_playlist_positions(client, playlist_id, current + new_uris, list(range(len(current))), snapshot_id)
+        return {"strategy": "rebuild", "removed": len(current), "added": len(new_uris),
+                "moves": 0, "write_calls": rebuild_calls}
+
+    snapshot_id = remove_playlist_positions(client, playlist_id, current, removed, snapshot_id)
+    snapshot_id = add_playlist_items(client, playlist_id, added, snapshot_id)
+    for range_start, insert_before, range_length in moves:
+        snapshot_id = client.playlist_reorder_items(
+            playlist_id, range_start, insert_before, range_length, snapshot_id)["snapshot_id"]
+    return {"strategy": "moves", "removed": len(removed), "added": len(added),
+            "moves": len(moves), "write_calls": edit_calls + len(moves)}
 
 # this is a path to reorder the playlist
 @app.route('/reorder_playlist', methods=['POST'])
@@ -315,352 +2831,938 @@ def reorder_playlist():
     access_token = request.headers.get('Authorization')[
         7:]  # Remove "Bearer " prefix
 
-    # Create a new Spotipy instance with the existing app credentials and the user's access token
-    sp_user = spotipy.Spotify(
-        client_credentials_manager=client_credentials_manager, auth=access_token)
+    # Spotify client with the user's access token, sharing the app's session
+    # and rate limits
+    sp_user = spotify_client(auth=access_token)
 
     try:
-        # Clear the playlist
-        sp_user.playlist_replace_items(playlist_id, [])
-
-        # Split the uris into chunks of 100
-        uri_chunks = [new_uris[i:i + 100]
-                      for i in range(0, len(new_uris), 100)]
-
-        for chunk in uri_chunks:
-            sp_user.playlist_add_items(playlist_id, chunk)
-
-        return {"message": "Playlist reordered successfully. However, if you don't have full access it may not be available to you. Please email sharma.manav@northeastern.edu so we can add you to authorized users."}
+        response = write_playlist_order(sp_user, playlist_id, new_uris)
+        response["message"] = "Playlist reordered successfully. However, if you don't have full access it may not be available to you. Please email sharma.manav@northeastern.edu so we can add you to authorized users."
+        return response
     except Exception as e:
         return {"error": str(e)}
 
-@app.route('/optimize_playlist', methods=['POST'])
-def optimize_playlist():
-    data = request.get_json()
-    playlist_link = data.get('playlist_link')
-    if not playlist_link:
-        return jsonify({"error": "playlist_link is required"}), 400
-
-    uri = playlist_link.split("/")[-1].split("?")[0]
-    track_uris = [x["track"]["uri"] for x in get_all_playlist_tracks(uri)]
-
-    # Fetch song data in parallel
-    with ThreadPoolExecutor() as executor:
-        song_data_map = {song: data for song, data in zip(
-            track_uris, executor.map(get_song_data, track_uris)) if data is not None}
+# Most cost matrix entries kept across all remembered optimizations. A
+# playlist whose matrix alone is larger isn't remembered; its response says so.
+OPTIMIZATION_CACHE_MAX_ENTRIES = int(os.getenv("OPTIMIZATION_CACHE_MAX_ENTRIES", 25000000))
+
+class PlaylistOptimization:
+    # What /optimize_playlist computed for one snapshot of a playlist, so the
+    # next request for it only has to handle what changed
+
+    def __init__(self, snapshot_id, track_uris, context, costs, order):
+        self.snapshot_id = snapshot_id
+        self.track_uris = track_uris
+        self.context = context
+        self.costs = costs
+        self.order = order
+
+optimizations = OrderedDict()
+optimizations_lock = threading.Lock()
+
+def get_optimization(playlist_id):
+    with optimizations_lock:
+        optimization = optimizations.get(playlist_id)
+        if optimization is not None:
+            optimizations.move_to_end(playlist_id)
+        return optimization
+
+def remember_optimization(playlist_id, optimization):
+    # Returns whether the optimization fits in the cache at all. One that
+    # doesn't is dropped without evicting the others.
+    if optimization.costs.size > OPTIMIZATION_CACHE_MAX_ENTRIES:
+        with optimizations_lock:
+            optimizations.pop(playlist_id, None)
+        return False
+    with optimizations_lock:
+        optimizations[playlist_id] = optimization
+        optimizations.move_to_end(playlist_id)
+        while optimizations and sum(o.costs.size for o in optimizations.values()) > OPTIMIZATION_CACHE_MAX_ENTRIES:
+            optimizations.popitem(last=False)
+    return True
+
+def incremental_costs(previous, track_uris, features):
+    # Cost matrix over track_uris that copies the entries previous already
+    # computed and only scores rows and columns of tracks it didn't have.
+    # Returns the matrix and the indices of reused and added tracks.
+    old_position = {track_id: i for i, track_id in enumerate(previous.track_uris)} if previous else {}
+    kept = np.array([i for i, track_id in enumerate(track_uris) if track_id in old_position], dtype=np.int64)
+    added = np.array([i for i, track_id in enumerate(track_uris) if track_id not in old_position], dtype=np.int64)
+    if not len(kept):
+        return cost_engine.matrix(features), kept, added
+
+    old = np.array([old_position[track_uris[i]] for i in kept], dtype=np.int64)
+    if len(kept) == len(previous.track_uris) and not len(added) and np.array_equal(old, kept):
+        return previous.costs, kept, added
+
+    costs = np.empty((len(track_uris), len(track_uris)))
+    costs[np.ix_(kept, kept)] = previous.costs[np.ix_(old, old)]
+    if len(added):
+        added_features = take_song_features(features, added)
+        costs[added, :] = cost_engine.matrix(added_features, features)
+        costs[:, added] = cost_engine.matrix(features, added_features)
+    return costs, kept, added
+
+def insert_tracks(costs, order, tracks):
+    # Cheapest insertion of each track into order, one track at a time
+    order = list(order)
+    for track in tracks:
+        if not order:
+            order.append(track)
+            continue
+        path = np.array(order)
+        between = costs[path[:-1], track] + costs[track, path[1:]] - costs[path[:-1], path[1:]]
+        deltas = np.r_[costs[track, path[0]], between, costs[path[-1], track]]
+        order.insert(int(np.argmin(deltas)), track)
+    return np.array(order, dtype=np.int64)
+
+def optimize_playlist_events(data):
+    if not has_requested_tracks(data, 'playlist_link'):
+        yield error_event("playlist_link or track_ids is required", 400)
+        return
+    try:
+        time_budget = number_option(data, 'time_budget', SEQUENCE_TIME_BUDGET, MAX_SEQUENCE_TIME_BUDGET)
+        clustering = data.get('clustering')
+        if clustering is not None and clustering not in tuple(CLUSTERING_METHODS):
+            raise ValueError(f"clustering must be one of {', '.join(CLUSTERING_METHODS)}")
+        n_clusters = integer_option(data, 'clusters', OPTIMIZE_CLUSTERS)
+    except ValueError as e:
+        yield error_event(str(e), 400)
+        return
+
+    # Start from the last optimization of this playlist, if there is one. An
+    # unchanged snapshot doesn't even need the track list refetched. Listed
+    # track IDs have no snapshot, so they are always optimized from scratch.
+    if data.get('track_ids'):
+        uri = snapshot_id = previous = None
+    else:
+        # The snapshot lookup is a Spotify request, so report the fetch as
+        # started before it
+        yield progress_event("fetch", 0, None)
+        uri = data['playlist_link'].split("/")[-1].split("?")[0]
+        snapshot_id = playlist_snapshot_id(uri)
+        previous = get_optimization(uri) if data.get('incremental', True) else None
+    unchanged = previous is not None and previous.snapshot_id == snapshot_id
+
+    # Fetch song data once for the whole request, only for tracks the last
+    # optimization didn't have
+    if unchanged:
+        track_uris = previous.track_uris
+        context = previous.context.copy(track_uris)
+        yield from context.load_progressively(track_uris)
+    else:
+        context = previous.context.copy(previous.track_uris) if previous else TrackContext()
+        track_uris = []
+        yield from load_requested_tracks(context, data, 'playlist_link', track_uris, started=uri is not None)
+    song_data_map = context.load(track_uris)
 
     track_uris = list(song_data_map.keys())
 
-    # Apply custom clustering algorithm
-    n_clusters = min(8, len(track_uris))
-    clusters = custom_clustering_algorithm(
-        list(song_data_map.values()), n_clusters)
-
-    # Sort songs within each cluster by tempo
-    clustered_songs = {cluster_id: [] for cluster_id in range(n_clusters)}
-    for i, song in enumerate(track_uris):
-        clustered_songs[clusters[i]].append(
-            (song, song_data_map[song]['tempo']))
-    for cluster_id in clustered_songs:
-        clustered_songs[cluster_id].sort(key=lambda x: x[1])
-
-    # Create a playlist with songs ordered by cluster
-    optimal_playlist = []
-    for cluster_id in range(n_clusters):
-        for song, _ in clustered_songs[cluster_id]:
-            optimal_playlist.append(song)
-
-        # Build the response
-    response_data = {
-        "optimal_playlist": [],
+    yield progress_event("sequence", 0, 1)
+    with metrics.stage("costs"):
+        features = pack_song_features(list(song_data_map.values()))
+    if clustering is not None:
+        order, result = clustered_optimize_tracks(
+            uri, track_uris, list(song_data_map.values()), features, clustering, n_clusters, time_budget)
+    else:
+        order, result = optimize_tracks(uri, snapshot_id, track_uris, context, features, time_budget, previous)
+    optimal_playlist = [track_uris[i] for i in order]
+    yield progress_event("sequence", 1, 1)
+
+    # Build the response
+    yield from track_events(context, "optimal_playlist", optimal_playlist)
+    yield {"event": "result", **result}
+
+def optimize_tracks(uri, snapshot_id, track_uris, context, features, time_budget, previous=None):
+    # Orders track_uris, whose songs are packed in features, by minimizing
+    # the summed cost of consecutive transitions, and remembers the result
+    # for the playlist uri if there is one. When most tracks were already
+    # ordered by previous, the new ones are inserted where they cost least
+    # and local search repairs the rest. Returns the order and the response's
+    # result fields.
+    unchanged = previous is not None and previous.snapshot_id == snapshot_id
+    if len(track_uris) > DENSE_SEQUENCE_LIMIT:
+        return graph_optimize_tracks(uri, track_uris, features, unchanged)
+
+    with metrics.stage("costs"):
+        costs, kept, added = incremental_costs(previous, track_uris, features)
+    with metrics.stage("graph"):
+        graph = TransitionGraph.from_costs(track_uris, costs)
+    reuse_order = previous is not None and len(kept) >= len(added)
+    with metrics.stage("sequence"):
+        if reuse_order:
+            new_position = {track_id: i for i, track_id in enumerate(track_uris)}
+            order = [new_position[previous.track_uris[i]] for i in previous.order
+                     if previous.track_uris[i] in new_position]
+            order = improve_path(costs, insert_tracks(costs, order, added), time_budget,
+                                 graph.candidates(SEQUENCE_CANDIDATES))
+        else:
+            order = sequence_tracks(costs, time_budget, graph)
+
+    remembered = False
+    if uri is not None:
+        remembered = remember_optimization(uri, PlaylistOptimization(snapshot_id, track_uris, context, costs, order))
+        remember_transition_graph(uri, graph)
+
+    return order, {
+        "transition_cost_before": path_cost(costs, np.arange(len(track_uris))),
+        "transition_cost_after": path_cost(costs, order),
+        "reuse": {
+            "snapshot_unchanged": unchanged,
+            "tracks_reused": len(kept),
+            "tracks_added": len(added),
+            "tracks_removed": len(previous.track_uris) - len(kept) if previous else 0,
+            "cost_entries_reused": len(kept) ** 2,
+            "cost_entries_computed": len(track_uris) ** 2 - len(kept) ** 2,
+            "ordering_reused": reuse_order,
+            "remembered": remembered,
+        },
     }
 
-    for i, song in enumerate(optimal_playlist):
-        song_data = get_song_data(song)
-        track = sp.track(song)  # Get the full track object
+def graph_optimize_tracks(uri, track_uris, features, unchanged):
+    # optimize_tracks for playlists over DENSE_SEQUENCE_LIMIT tracks, which
+    # never builds their cost matrix. The playlist's TransitionGraph is
+    # updated from its last one and the ordering is the greedy path through
+    # it, without local search.
+    previous = cached_transition_graph(uri) if uri is not None else None
+    with metrics.stage("graph"):
+        graph = get_transition_graph(uri, track_uris, features)
+    with metrics.stage("sequence"):
+        order = graph_path(graph, features)
+
+    with metrics.stage("costs"):
+        cost_before = feature_path_cost(features, np.arange(len(track_uris)))
+        cost_after = feature_path_cost(features, order)
+    kept = sum(previous.position(track_id) is not None for track_id in track_uris) if previous else 0
+    return order, {
+        "transition_cost_before": cost_before,
+        "transition_cost_after": cost_after,
+        "reuse": {
+            "snapshot_unchanged": unchanged,
+            "tracks_reused": kept,
+            "tracks_added": len(track_uris) - kept,
+            "tracks_removed": len(previous) - kept if previous else 0,
+            "graph_rows_reused": len(graph) if graph is previous else graph.rows_reused,
+            "ordering_reused": False,
+            "remembered": uri is not None,
+        },
+    }
 
-        position = i + 1
-        track_name = track["name"]
-        artist = track["artists"][0]["name"]
-        album_name = track["album"]["name"]
+# Clusters a playlist is split into when an /optimize_playlist request asks
+# for clustering without saying how many
+OPTIMIZE_CLUSTERS = int(os.getenv("OPTIMIZE_CLUSTERS", 8))
+
+def clustered_optimize_tracks(uri, track_uris, songs, features, method, n_clusters, time_budget):
+    # optimize_tracks for a request that names a clustering backend. The
+    # tracks are split with custom_clustering_algorithm, each cluster is
+    # sequenced on its own with a share of the time budget by size, and the
+    # clusters play from the slowest mean tempo to the fastest. Only one
+    # cluster's cost matrix exists at a time, so playlists over
+    # DENSE_SEQUENCE_LIMIT still get local search within their clusters.
+    # The order isn't remembered for incremental reuse.
+    n = len(track_uris)
+    graph = None
+    if method == 'graph' and n > n_clusters:
+        with metrics.stage("graph"):
+            graph = get_transition_graph(uri, track_uris, features)
+    clusters = custom_clustering_algorithm(songs, n_clusters, method, graph)
+    members = sorted((np.flatnonzero(clusters == cluster) for cluster in np.unique(clusters)),
+                     key=lambda rows: features['tempo'][rows].mean())
+
+    order = []
+    for rows in members:
+        cluster_features = take_song_features(features, rows)
+        if len(rows) > DENSE_SEQUENCE_LIMIT:
+            with metrics.stage("graph"):
+                cluster_graph = TransitionGraph.build(range(len(rows)), cluster_features)
+            with metrics.stage("sequence"):
+                path = graph_path(cluster_graph, cluster_features)
+        else:
+            with metrics.stage("costs"):
+                costs = cost_engine.matrix(cluster_features)
+            with metrics.stage("sequence"):
+                path = sequence_tracks(costs, time_budget * len(rows) / n)
+        order.extend(rows[path])
+    order = np.array(order, dtype=np.int64)
+
+    with metrics.stage("costs"):
+        cost_before = feature_path_cost(features, np.arange(n))
+        cost_after = feature_path_cost(features, order)
+    return order, {
+        "transition_cost_before": cost_before,
+        "transition_cost_after": cost_after,
+        "clustering": {"method": method, "sizes": [len(rows) for rows in members]},
+    }
 
+@app.route('/optimize_playlist', methods=['POST'])
+def optimize_playlist():
+    data = request.get_json()
+    return respond(optimize_playlist_events(data), data)
+
+
+# Most playlists one batch may list, threads that fetch and order the
+# playlists of a batch, and the default seconds of local search per playlist
+BATCH_MAX_PLAYLISTS = int(os.getenv("BATCH_MAX_PLAYLISTS", 500))
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", os.cpu_count() or 1))
+BATCH_TIME_BUDGET = float(os.getenv("BATCH_TIME_BUDGET", 0.5))
+
+batch_executor = InstrumentedExecutor('batch', BATCH_WORKERS)
+
+def fetch_batch_playlist(playlist_id, incremental):
+    # (snapshot_id, previous optimization, track URIs) of a batch playlist.
+    # An unchanged snapshot reuses the last optimization's track list.
+    snapshot_id = playlist_snapshot_id(playlist_id)
+    previous = get_optimization(playlist_id) if incremental else None
+    if previous is not None and previous.snapshot_id == snapshot_id:
+        return snapshot_id, previous, previous.track_uris
+    return snapshot_id, previous, [x["track"]["uri"] for x in get_all_playlist_tracks(playlist_id)]
+
+def optimize_batch_events(data):
+    # optimize_playlist for many playlists at once. Song data is loaded once
+    # for the union of their tracks, so tracks and artists they share are
+    # looked up once, and the playlists are ordered on batch_executor against
+    # the shared cost engine. Each playlist's result is a compact "playlist"
+    # event with track URIs only, sent as soon as it is ready.
+    playlists = data.get('playlists')
+    if not playlists or not isinstance(playlists, list):
+        yield error_event("playlists must be a non-empty list of playlist links or IDs", 400)
+        return
+    if len(playlists) > BATCH_MAX_PLAYLISTS:
+        yield error_event(f"At most {BATCH_MAX_PLAYLISTS} playlists can be optimized at once", 400)
+        return
+    try:
+        time_budget = number_option(data, 'time_budget', BATCH_TIME_BUDGET, MAX_SEQUENCE_TIME_BUDGET)
+    except ValueError as e:
+        yield error_event(str(e), 400)
+        return
+
+    started_at = time.perf_counter()
+    playlist_ids = list(dict.fromkeys(link.split("/")[-1].split("?")[0] for link in playlists))
+    incremental = data.get('incremental', True)
+
+    # Track lists are fetched concurrently. A playlist that can't be fetched
+    # fails on its own.
+    fetches = {playlist_id: batch_executor.submit(fetch_batch_playlist, playlist_id, incremental)
+               for playlist_id in playlist_ids}
+    for done, _ in enumerate(as_completed(fetches.values()), 1):
+        yield progress_event("playlists", done, len(playlist_ids))
+    fetched = {}
+    failed = 0
+    for playlist_id, future in fetches.items():
         try:
-            album_cover = track["album"]["images"][0]["url"]
-        except IndexError:
-            album_cover = None
-
-        popularity = track["popularity"]
-        tempo = song_data["tempo"]
-        danceability = song_data["danceability"]
-
-        response_data["optimal_playlist"].append({
-            "position": position,
-            "track_name": track_name,
-            "artist": artist,
-            "album_name": album_name,
-            "album_cover": album_cover,
-            "popularity": popularity,
-            "tempo": tempo,
-            "danceability": danceability,
-            "uri": song,  # Add this line to include the URI
-        })
-
-    return jsonify(response_data), 200
-
+            fetched[playlist_id] = future.result()
+        except Exception as e:
+            failed += 1
+            yield {"event": "playlist", "playlist_id": playlist_id, "error": str(e)}
+
+    context = TrackContext()
+    all_tracks = list(dict.fromkeys(track for _, _, track_uris in fetched.values() for track in track_uris))
+    yield from context.load_progressively(all_tracks)
+    song_data_map = context.load(all_tracks)
+    with metrics.stage("costs"):
+        position = {track_id: i for i, track_id in enumerate(song_data_map)}
+        features = pack_song_features(list(song_data_map.values()))
+
+    def optimize(playlist_id):
+        snapshot_id, previous, track_uris = fetched[playlist_id]
+        track_uris = [track_id for track_id in dict.fromkeys(track_uris) if track_id in position]
+        rows = np.array([position[track_id] for track_id in track_uris], dtype=np.int64)
+        order, result = optimize_tracks(playlist_id, snapshot_id, track_uris, context.copy(track_uris),
+                                        take_song_features(features, rows), time_budget, previous)
+        return {"playlist_id": playlist_id, "snapshot_id": snapshot_id,
+                "tracks": [track_uris[i] for i in order], **result}
+
+    yield progress_event("sequence", 0, len(fetched))
+    orderings = {batch_executor.submit(optimize, playlist_id): playlist_id for playlist_id in fetched}
+    optimized = tracks_total = 0
+    for done, future in enumerate(as_completed(orderings), 1):
+        try:
+            playlist = future.result()
+        except Exception as e:
+            failed += 1
+            yield {"event": "playlist", "playlist_id": orderings[future], "error": str(e)}
+        else:
+            optimized += 1
+            tracks_total += len(playlist["tracks"])
+            yield {"event": "playlist", **playlist}
+        yield progress_event("sequence", done, len(fetched))
+
+    seconds = time.perf_counter() - started_at
+    yield {
+        "event": "result",
+        "playlists_optimized": optimized,
+        "playlists_failed": failed,
+        "tracks_total": tracks_total,
+        "unique_tracks": len(song_data_map),
+        "seconds": seconds,
+        "tracks_per_second": tracks_total / seconds if seconds else 0.0,
+    }
 
-@app.route('/generate_warmup', methods=['POST'])
-def generate_warmup():
+@app.route('/optimize_batch', methods=['POST'])
+def optimize_batch():
     data = request.get_json()
-    playlist_link = data.get('playlist_link')
-    if not playlist_link:
-        return jsonify({"error": "playlist_link is required"}), 400
-
-    uri = playlist_link.split("/")[-1].split("?")[0]
-    track_uris = [x["track"]["uri"] for x in get_all_playlist_tracks(uri)]
-
-    # Fetch song data in parallel
-    with ThreadPoolExecutor() as executor:
-        song_data_map = {song: data for song, data in zip(
-            track_uris, executor.map(get_song_data, track_uris)) if data is not None}
+    return respond(optimize_batch_events(data), data)
 
+def warmup_order(song_data_map):
     # Sort the songs by tempo and energy, in ascending order
     warmup_songs = dict(sorted(song_data_map.items(), key=lambda item: (
         item[1]['tempo'], item[1]['energy'])))
+    return list(warmup_songs.keys())
 
-    # Create response
-    response_data = {"warmup_playlist": []}
-
-    for i, song in enumerate(warmup_songs.keys()):
-        song_data = warmup_songs[song]
-        track = sp.track(song)  # Get the full track object
+# Cooldowns leave out songs faster than this many BPM unless a request sets
+# its own max_tempo
+COOLDOWN_MAX_TEMPO = 91
 
-        position = i + 1
-        track_name = track["name"]
-        artist = track["artists"][0]["name"]
-        album_name = track["album"]["name"]
+def cooldown_songs(song_data_map, max_tempo=COOLDOWN_MAX_TEMPO):
+    # Filter out songs with tempo greater than max_tempo, if there is one
+    return {song: data for song, data in song_data_map.items()
+            if max_tempo is None or data['tempo'] <= max_tempo}
 
-        try:
-            album_cover = track["album"]["images"][0]["url"]
-        except IndexError:
-            album_cover = None
-
-        popularity = track["popularity"]
-        tempo = song_data["tempo"]
-        danceability = song_data["danceability"]
-
-        response_data["warmup_playlist"].append({
-            "position": position,
-            "track_name": track_name,
-            "artist": artist,
-            "album_name": album_name,
-            "album_cover": album_cover,
-            "popularity": popularity,
-            "tempo": tempo,
-            "danceability": danceability,
-            "uri": song,
-        })
-
-    return jsonify(response_data), 200
-
-
-@app.route('/generate_cooldown', methods=['POST'])
-def generate_cooldown():
-    data = request.get_json()
-    playlist_link = data.get('playlist_link')
-    if not playlist_link:
-        return jsonify({"error": "playlist_link is required"}), 400
-
-    uri = playlist_link.split("/")[-1].split("?")[0]
-    track_uris = [x["track"]["uri"] for x in get_all_playlist_tracks(uri)]
-
-    # Fetch song data in parallel
-    with ThreadPoolExecutor() as executor:
-        song_data_map = {song: data for song, data in zip(
-            track_uris, executor.map(get_song_data, track_uris)) if data is not None}
-
-    # Filter out songs with tempo greater than 91
-    cooldown_songs = {song: data for song,
-                      data in song_data_map.items() if data['tempo'] <= 91}
+def cooldown_order(song_data_map, max_tempo=COOLDOWN_MAX_TEMPO):
+    cooldown = cooldown_songs(song_data_map, max_tempo)
 
     # Sort the remaining songs by tempo and energy, in descending order
-    cooldown_songs = dict(sorted(cooldown_songs.items(), key=lambda item: (
+    cooldown = dict(sorted(cooldown.items(), key=lambda item: (
         item[1]['tempo'], item[1]['energy']), reverse=True))
+    return list(cooldown.keys())
+
+# Named target curves for arc sequencing: intensity levels from 0 (the
+# playlist's calmest song) to 1 (its most intense) spread evenly over the
+# playlist and interpolated in between
+ENERGY_ARCS = {
+    'rise': [0.0, 1.0],
+    'fall': [1.0, 0.0],
+    'peak': [0.0, 1.0, 0.0],
+    'valley': [1.0, 0.0, 1.0],
+}
+
+# Default and largest number of partial orders arc_sequence keeps per step,
+# and the unplayed songs closest in tempo to the curve each one is extended
+# with
+ARC_BEAM_WIDTH = 16
+MAX_ARC_BEAM_WIDTH = 128
+ARC_CANDIDATES = 24
+
+# Cost of being a whole level off the curve, against the transition costs
+# of the path
+ARC_WEIGHT = 40.0
+
+def arc_levels(arc, n):
+    # Target level of each of n positions for an ENERGY_ARCS name or a list
+    # of levels
+    if isinstance(arc, str):
+        if arc not in ENERGY_ARCS:
+            raise ValueError(f"arc must be one of {', '.join(ENERGY_ARCS)} or a list of levels from 0 to 1")
+        points = ENERGY_ARCS[arc]
+    else:
+        if not isinstance(arc, list) or not arc or not all(
+                isinstance(level, (int, float)) and 0 <= level <= 1 for level in arc):
+            raise ValueError(f"arc must be one of {', '.join(ENERGY_ARCS)} or a list of levels from 0 to 1")
+        points = [float(level) for level in arc]
+    if len(points) == 1:
+        return np.full(n, points[0])
+    return np.interp(np.linspace(0, 1, n), np.linspace(0, 1, len(points)), points)
+
+def song_intensity(features):
+    # Each song's tempo and energy ranks within the set, averaged and scaled
+    # from 0 to 1
+    n = len(features['tempo'])
+    intensity = np.zeros(n)
+    for column in ('tempo', 'energy'):
+        ranks = np.empty(n)
+        ranks[np.argsort(features[column], kind='stable')] = np.arange(n)
+        intensity += ranks / max(n - 1, 1) / 2
+    return intensity
+
+def tempo_window(by_tempo, available, center, size):
+    # The size available songs nearest to position center of the tempo order
+    positions = np.flatnonzero(available[by_tempo])
+    at = np.searchsorted(positions, center)
+    nearby = positions[max(0, at - size):at + size]
+    nearest = np.argsort(np.abs(nearby - center), kind='stable')[:size]
+    return by_tempo[nearby[nearest]]
+
+def arc_sequence(features, levels, beam_width=ARC_BEAM_WIDTH, candidates=ARC_CANDIDATES, weight=ARC_WEIGHT):
+    # Beam search for an order of every song that keeps transition costs low
+    # while its intensity follows levels. Each step extends the beam_width
+    # cheapest partial orders with the unplayed songs nearest in tempo to the
+    # level, found in a window of the tempo order, so a step scores at most
+    # beam_width * candidates transitions whatever the playlist size.
+    n = len(features['tempo'])
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+    by_tempo = np.argsort(features['tempo'], kind='stable')
+    intensity = song_intensity(features)
+
+    visited = np.zeros((1, n), dtype=bool)
+    costs = np.zeros(1)
+    last = None
+    steps = []
+    for step in range(n):
+        # The level's tempo is the song at that rank of the tempo order
+        window = tempo_window(by_tempo, ~visited.all(axis=0), levels[step] * (n - 1), candidates)
+        total = costs[:, None] + weight * np.abs(intensity[window] - levels[step])[None, :]
+        if last is not None:
+            total += transition_cost_matrix(take_song_features(features, last), take_song_features(features, window))
+        total[visited[:, window]] = np.inf
+
+        total = total.ravel()
+        k = min(beam_width, int(np.isfinite(total).sum()))
+        best = np.argpartition(total, k - 1)[:k]
+        parents, columns = np.divmod(best, len(window))
+        last = window[columns]
+        visited = visited[parents]
+        visited[np.arange(k), last] = True
+        costs = total[best]
+        steps.append((last, parents))
+
+    # Follow the cheapest full order back through its parents
+    order = np.empty(n, dtype=np.int64)
+    beam = int(np.argmin(costs))
+    for step in range(n - 1, -1, -1):
+        songs, parents = steps[step]
+        order[step] = songs[beam]
+        beam = parents[beam]
+    return order
+
+def arc_order(song_data_map, arc, beam_width=ARC_BEAM_WIDTH):
+    # Track IDs of song_data_map ordered along arc by arc_sequence, and the
+    # order's summed transition cost and mean distance from the curve
+    track_ids = list(song_data_map)
+    features = pack_song_features(list(song_data_map.values()))
+    levels = arc_levels(arc, len(track_ids))
+    order = arc_sequence(features, levels, beam_width)
+    deviation = float(np.abs(song_intensity(features)[order] - levels).mean()) if len(order) else 0.0
+    return [track_ids[i] for i in order], {
+        "transition_cost": feature_path_cost(features, order),
+        "arc_deviation": deviation,
+    }
 
-    # Create response
-    response_data = {"cooldown_playlist": []}
-
-    for i, song in enumerate(cooldown_songs.keys()):
-        song_data = cooldown_songs[song]
-        track = sp.track(song)  # Get the full track object
-
-        position = i + 1
-        track_name = track["name"]
-        artist = track["artists"][0]["name"]
-        album_name = track["album"]["name"]
-
-        try:
-            album_cover = track["album"]["images"][0]["url"]
-        except IndexError:
-            album_cover = None
-
-        popularity = track["popularity"]
-        tempo = song_data["tempo"]
-        danceability = song_data["danceability"]
-
-        response_data["cooldown_playlist"].append({
-            "position": position,
-            "track_name": track_name,
-            "artist": artist,
-            "album_name": album_name,
-            "album_cover": album_cover,
-            "popularity": popularity,
-            "tempo": tempo,
-            "danceability": danceability,
-            "uri": song,
-        })
-
-    return jsonify(response_data), 200
-    
-
-def steps_in_circle_of_fifths(key1, key2):
-    circle_of_fifths = [0, 7, 2, 9, 4, 11, 6, 1, 8, 3, 10, 5]
-    index1 = circle_of_fifths.index(key1)
-    index2 = circle_of_fifths.index(key2)
-    steps = abs(index1 - index2)
-    return min(steps, 12 - steps)
-
-def key_compatibility(key1, mode1, key2, mode2):
-    if key1 == key2:
-        return True
-
-    # Check for relative major/minor relationship
-    if mode1 != mode2 and (key1 == get_relative_key(key2, mode2) or key2 == get_relative_key(key1, mode1)):
-        return True
-
-    # Check for compatibility based on circle of fifths
-    steps = steps_in_circle_of_fifths(key1, key2)
-    if (mode1 == mode2 and steps <= 2) or (mode1 != mode2 and steps <= 1):
-        return True
-
-    return False
-
-def genre_similarity(genres1, genres2):
-    if not genres1 or not genres2:
-        return 0
-    shared_genres = len(set(genres1).intersection(genres2))
-    return min(shared_genres, 5)
+def arc_options(data):
+    # (arc, beam_width) of a warmup or cooldown request, arc None when it
+    # asks for the plain sort. Raises ValueError for invalid options.
+    arc = data.get('arc')
+    if arc is not None:
+        arc_levels(arc, 2)
+    beam_width = integer_option(data, 'beam_width', ARC_BEAM_WIDTH)
+    if beam_width > MAX_ARC_BEAM_WIDTH:
+        raise ValueError(f"beam_width must be between 1 and {MAX_ARC_BEAM_WIDTH}")
+    return arc, beam_width
+
+def warmup_events(data):
+    if not has_requested_tracks(data, 'playlist_link'):
+        yield error_event("playlist_link or track_ids is required", 400)
+        return
+    try:
+        arc, beam_width = arc_options(data)
+    except (TypeError, ValueError) as e:
+        yield error_event(str(e), 400)
+        return
+
+    # Fetch song data once for the whole request, while paging through the
+    # playlist
+    context = TrackContext()
+    track_uris = []
+    yield from load_requested_tracks(context, data, 'playlist_link', track_uris)
+    song_data_map = context.load(track_uris)
+
+    # A requested arc is followed with transition costs in mind, otherwise
+    # the songs are sorted
+    with metrics.stage("sort"):
+        if arc is None:
+            warmup_playlist = warmup_order(song_data_map)
+        else:
+            warmup_playlist, arc_result = arc_order(song_data_map, arc, beam_width)
 
-def evaluate_transition(song1, song2):
-    score = 0
+    # Create response
+    yield from track_events(context, "warmup_playlist", warmup_playlist)
+    if arc is not None:
+        yield {"event": "result", **arc_result}
 
-    # Weights for different attributes
-    weights = {
-        'danceability': 7,
-        'energy': 5,
-        'loudness': 1,
-        'tempo': 100,
-        'valence': 5,
-        'genre': 4
-    }
+@app.route('/generate_warmup', methods=['POST'])
+def generate_warmup():
+    data = request.get_json()
+    return respond(warmup_events(data), data)
 
-    # Check key compatibility
-    if not key_compatibility(song1['key'], song1['mode'], song2['key'], song2['mode']):
-        score += 6  # Return a large score if keys are not compatible
 
-    # Calculate the differences in attributes
-    diff = {}
-    for attribute in weights:
-        if attribute == 'genre':
-            diff[attribute] = 5 - genre_similarity(song1[attribute], song2[attribute])
+def cooldown_events(data):
+    if not has_requested_tracks(data, 'playlist_link'):
+        yield error_event("playlist_link or track_ids is required", 400)
+        return
+    try:
+        arc, beam_width = arc_options(data)
+        # null turns the tempo cutoff off
+        max_tempo = data.get('max_tempo', COOLDOWN_MAX_TEMPO)
+        if max_tempo is not None:
+            max_tempo = number_option(data, 'max_tempo', COOLDOWN_MAX_TEMPO)
+    except (TypeError, ValueError) as e:
+        yield error_event(str(e), 400)
+        return
+
+    # Fetch song data once for the whole request, while paging through the
+    # playlist
+    context = TrackContext()
+    track_uris = []
+    yield from load_requested_tracks(context, data, 'playlist_link', track_uris)
+    song_data_map = context.load(track_uris)
+
+    with metrics.stage("sort"):
+        if arc is None:
+            cooldown_playlist = cooldown_order(song_data_map, max_tempo)
         else:
-            diff[attribute] = abs(song1[attribute] - song2[attribute])
-
-    # Normalize loudness differences
-    diff['loudness'] /= 60  # Assume max difference is 60 dB
+            cooldown_playlist, arc_result = arc_order(cooldown_songs(song_data_map, max_tempo), arc, beam_width)
 
-    # Calculate tempo difference considering double/half time mixing
-    tempo_diff = min(
-        abs(song1['tempo'] - song2['tempo']),
-        abs(song1['tempo'] * 2 - song2['tempo']),
-        abs(song1['tempo'] / 2 - song2['tempo'])
-    )
-    diff['tempo'] = tempo_diff / 200  # Normalize tempo difference
+    # Create response
+    yield from track_events(context, "cooldown_playlist", cooldown_playlist)
+    if arc is not None:
+        yield {"event": "result", **arc_result}
 
-    # Calculate the transition score
-    for attribute in weights:
-        score += weights[attribute] * diff[attribute]
+@app.route('/generate_cooldown', methods=['POST'])
+def generate_cooldown():
+    data = request.get_json()
+    return respond(cooldown_events(data), data)
 
-    return score
+def calculate_similarity(playlist1_tracks, playlist2_tracks):
+    # Fetch song data for both playlists in one set of batches
+    song_data_map = get_song_data_bulk(playlist1_tracks + playlist2_tracks)
+    playlist1_songs = [song_data_map[song] for song in playlist1_tracks if song in song_data_map]
+    playlist2_songs = [song_data_map[song] for song in playlist2_tracks if song in song_data_map]
+
+    return song_similarity(playlist1_songs, playlist2_songs)
+
+# Leaf size and tempo band width of the indexes /compare_playlists bounds
+# leaf pairs with
+SIMILARITY_LEAF_SIZE = 64
+SIMILARITY_TEMPO_BAND_WIDTH = 16.0
+
+# Defaults for approximate comparisons: seconds to spend, and how wide in
+# percentage points the similarity interval may stay
+SIMILARITY_TIME_BUDGET = float(os.getenv("SIMILARITY_TIME_BUDGET", 1.0))
+SIMILARITY_TOLERANCE = 1.0
+
+def max_transition_cost(songs1, songs2, time_budget=None, tolerance=0.0):
+    # (low, high) bounds on the highest evaluate_transition cost from a song
+    # in songs1 to one in songs2, without holding every score. Both lists are
+    # split into leaves and leaf pairs are bounded from above; rows of leaves
+    # are scored in order of their bound until no unscored pair can beat the
+    # best so far. With a time budget or tolerance the search may stop early,
+    # and high then comes from the remaining bounds.
+    index1 = TransitionIndex(list(range(len(songs1))), songs1,
+                             SIMILARITY_TEMPO_BAND_WIDTH, SIMILARITY_LEAF_SIZE)
+    index2 = TransitionIndex(list(range(len(songs2))), songs2,
+                             SIMILARITY_TEMPO_BAND_WIDTH, SIMILARITY_LEAF_SIZE)
+    deadline = None if time_budget is None else time.perf_counter() + time_budget
+
+    bounds = index1.upper_bounds(index2)
+    row_bounds = bounds.max(axis=1)
+    leaf_of_column = np.repeat(np.arange(len(index2.starts)), index2.ends - index2.starts)
+
+    # Leaves are scored one per cost engine worker at a time
+    best = -np.inf
+    order = np.argsort(-row_bounds, kind='stable')
+    with cost_engine.session(index1.features, index2.features, len(songs1) * len(songs2)) as session:
+        for wave_start in range(0, len(order), session.parallelism):
+            wave = order[wave_start:wave_start + session.parallelism]
+
+            # Bounds are summed in a different order than the scores, so allow
+            # for rounding before treating a leaf as beaten
+            if row_bounds[wave[0]] <= best - 1e-9:
+                return best, best
+            if best > -np.inf and ((tolerance > 0 and row_bounds[wave[0]] - best <= tolerance) or
+                                   (deadline is not None and time.perf_counter() > deadline)):
+                return best, max(best, float(row_bounds[wave[0]]))
+
+            blocks = [(np.arange(index1.starts[leaf], index1.ends[leaf]),
+                       np.flatnonzero((bounds[leaf] > best - 1e-9)[leaf_of_column]))
+                      for leaf in wave if row_bounds[leaf] > best - 1e-9]
+            for _, (cost, _, _) in session.map('max', blocks):
+                best = max(best, cost)
+    return best, best
+
+def similarity_from_cost(max_score):
+    return (1 - (max_score / 600)) * 100
+
+def song_similarity(playlist1_songs, playlist2_songs):
+    max_score, _ = max_transition_cost(playlist1_songs, playlist2_songs)
+    similarity_percentage = similarity_from_cost(max_score)
 
-def custom_distance(song1, song2):
-    return evaluate_transition(song1, song2)
+    return similarity_percentage
 
-def custom_clustering_algorithm(songs, n_clusters):
-    # Calculate pairwise distances
-    distances = np.zeros((len(songs), len(songs)))
-    for i in range(len(songs)):
-        for j in range(i + 1, len(songs)):
-            distance = custom_distance(songs[i], songs[j])
-            distances[i, j] = distance
-            distances[j, i] = distance
+def approximate_song_similarity(playlist1_songs, playlist2_songs,
+                                time_budget=SIMILARITY_TIME_BUDGET, tolerance=SIMILARITY_TOLERANCE):
+    # song_similarity within time_budget seconds, as the similarity of the
+    # highest cost found and a (low, high) interval the exact value is
+    # guaranteed to lie in. Stops once the interval is at most tolerance
+    # percentage points wide.
+    low_cost, high_cost = max_transition_cost(
+        playlist1_songs, playlist2_songs, time_budget, tolerance * 600 / 100)
+    return similarity_from_cost(low_cost), (similarity_from_cost(high_cost), similarity_from_cost(low_cost))
+
+def compare_playlists_events(data):
+    if not has_requested_tracks(data, 'playlist1_link') or not has_requested_tracks(data, 'playlist2_link'):
+        yield error_event("Both playlist1_link (or playlist1_track_ids) and "
+                          "playlist2_link (or playlist2_track_ids) are required", 400)
+        return
+    try:
+        time_budget = number_option(data, 'time_budget', SIMILARITY_TIME_BUDGET, MAX_SEQUENCE_TIME_BUDGET)
+        tolerance = number_option(data, 'tolerance', SIMILARITY_TOLERANCE)
+    except ValueError as e:
+        yield error_event(str(e), 400)
+        return
+
+    context = TrackContext()
+    playlist1_tracks = []
+    yield from load_requested_tracks(context, data, 'playlist1_link', playlist1_tracks)
+    playlist2_tracks = []
+    yield from load_requested_tracks(context, data, 'playlist2_link', playlist2_tracks)
 
-    # Apply Agglomerative Clustering
-    clustering = AgglomerativeClustering(
-        n_clusters=n_clusters, affinity='precomputed', linkage='complete')
-    clusters = clustering.fit_predict(distances)
+    if not playlist1_tracks or not playlist2_tracks:
+        yield error_event("One or both playlists are empty or not accessible", 400)
+        return
 
-    return clusters
+    playlist1_songs = list(context.load(playlist1_tracks).values())
+    playlist2_songs = list(context.load(playlist2_tracks).values())
 
-def calculate_similarity(playlist1_tracks, playlist2_tracks):
-    # Fetch song data in parallel for both playlists
-    with ThreadPoolExecutor() as executor:
-        playlist1_data_map = {song: data for song, data in zip(
-            playlist1_tracks, executor.map(get_song_data, playlist1_tracks)) if data is not None}
+    if not playlist1_songs or not playlist2_songs:
+        yield error_event("One or both playlists are empty or not accessible", 400)
+        return
 
-        playlist2_data_map = {song: data for song, data in zip(
-            playlist2_tracks, executor.map(get_song_data, playlist2_tracks)) if data is not None}
+    if not data.get('approximate'):
+        with metrics.stage("costs"):
+            similarity_percentage = song_similarity(playlist1_songs, playlist2_songs)
 
-    similarity_scores = []
-    
-    for song1 in playlist1_data_map:
-        for song2 in playlist2_data_map:
-            score = evaluate_transition(
-                playlist1_data_map[song1], playlist2_data_map[song2])
-            similarity_scores.append(score)
+        yield {
+            "event": "result",
+            "similarity_percentage": similarity_percentage
+        }
+        return
 
-    max_score = max(similarity_scores)
-    similarity_percentage = (1 - (max_score / 600)) * 100
+    with metrics.stage("costs"):
+        similarity_percentage, (low, high) = approximate_song_similarity(
+            playlist1_songs, playlist2_songs, time_budget, tolerance)
 
-    return similarity_percentage
+    yield {
+        "event": "result",
+        "similarity_percentage": similarity_percentage,
+        "similarity_interval": [low, high],
+        "exact": low == high
+    }
 
 @app.route('/compare_playlists', methods=['POST'])
 def compare_playlists():
     data = request.get_json()
-    playlist1_link = data.get('playlist1_link')
-    playlist2_link = data.get('playlist2_link')
-
-    if not playlist1_link or not playlist2_link:
-        return jsonify({"error": "Both playlist1_link and playlist2_link are required"}), 400
-
-    playlist1_uri = playlist1_link.split("/")[-1].split("?")[0]
-    playlist1_tracks = [x["track"]["uri"]
-                        for x in get_all_playlist_tracks(playlist1_uri)]
-
-    playlist2_uri = playlist2_link.split("/")[-1].split("?")[0]
-    playlist2_tracks = [x["track"]["uri"]
-                        for x in get_all_playlist_tracks(playlist2_uri)]
-
-    if not playlist1_tracks or not playlist2_tracks:
-        return jsonify({"error": "One or both playlists are empty or not accessible"}), 400
+    return respond(compare_playlists_events(data), data)
+
+# Endpoints that can run as background jobs, with the request fields that
+# hold playlist links
+JOB_TYPES = {
+    'optimize_playlist': (optimize_playlist_events, ['playlist_link']),
+    'generate_warmup': (warmup_events, ['playlist_link']),
+    'generate_cooldown': (cooldown_events, ['playlist_link']),
+    'b2b_playlist': (b2b_playlist_events, ['playlist1_link', 'playlist2_link']),
+    'compare_playlists': (compare_playlists_events, ['playlist1_link', 'playlist2_link']),
+}
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+
+# Finished jobs kept for polling and as cached results, oldest evicted first
+JOB_HISTORY_SIZE = int(os.getenv("JOB_HISTORY_SIZE", 256))
+
+class JobQueue:
+    # Runs endpoint computations on a bounded worker pool outside the request
+    # thread. Jobs are keyed by type, playlist snapshots and options, so an
+    # identical submission joins the in-flight job or gets the finished one.
+
+    def __init__(self, workers, history_size):
+        self.executor = InstrumentedExecutor('jobs', workers)
+        self.workers = workers
+        self.history_size = history_size
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.jobs_by_key = {}
+        self.finished = OrderedDict()
+        self.counters = {'submitted': 0, 'deduplicated': 0, 'cache_hits': 0, 'failed': 0}
+
+    def submit(self, job_type, data, key):
+        with self.lock:
+            job_id = self.jobs_by_key.get(key)
+            if job_id is not None:
+                job = self.jobs[job_id]
+                if job['status'] == 'done':
+                    self.counters['cache_hits'] += 1
+                    self.finished.move_to_end(job_id)
+                else:
+                    self.counters['deduplicated'] += 1
+                return self.view(job)
+
+            job = {
+                'id': uuid.uuid4().hex,
+                'type': job_type,
+                'key': key,
+                'status': 'queued',
+                'submitted_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+                'progress': None,
+                'result': None,
+                'error': None,
+            }
+            self.jobs[job['id']] = job
+            self.jobs_by_key[key] = job['id']
+            self.counters['submitted'] += 1
+            self.executor.submit(self.run, job, data)
+            return self.view(job)
+
+    def run(self, job, data):
+        job['status'] = 'running'
+        job['started_at'] = time.time()
+
+        def on_progress(event):
+            job['progress'] = {key: value for key, value in event.items() if key != 'event'}
+
+        events, _ = JOB_TYPES[job['type']]
+        metrics.begin(f"job:{job['type']}")
+        try:
+            result, status = collect_events(events(data), on_progress)
+        except Exception as e:
+            result, status = {"error": str(e)}, 500
+        metrics.set_status(status)
+        metrics.finish()
+
+        with self.lock:
+            job['finished_at'] = time.time()
+            if status == 200:
+                job['status'] = 'done'
+                job['result'] = result
+            else:
+                # Forget failed jobs' keys so resubmitting retries them
+                job['status'] = 'failed'
+                job['error'] = result['error']
+                self.counters['failed'] += 1
+                self.jobs_by_key.pop(job['key'], None)
+
+            self.finished[job['id']] = None
+            while len(self.finished) > self.history_size:
+                old_id, _ = self.finished.popitem(last=False)
+                old_job = self.jobs.pop(old_id)
+                if self.jobs_by_key.get(old_job['key']) == old_id:
+                    del self.jobs_by_key[old_job['key']]
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return None if job is None else self.view(job)
+
+    def view(self, job):
+        return {key: value for key, value in job.items() if key != 'key'}
+
+    def stats(self):
+        with self.lock:
+            statuses = [job['status'] for job in self.jobs.values()]
+            return {
+                'workers': self.workers,
+                'queued': statuses.count('queued'),
+                'running': statuses.count('running'),
+                'finished': len(self.finished),
+                **self.counters,
+            }
+
+job_queue = JobQueue(JOB_WORKERS, JOB_HISTORY_SIZE)
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    data = request.get_json()
+    job_type = data.get('type')
+    if job_type not in JOB_TYPES:
+        return jsonify({"error": f"type must be one of {', '.join(JOB_TYPES)}"}), 400
 
-    similarity_percentage = calculate_similarity(
-        playlist1_tracks, playlist2_tracks)
+    _, link_fields = JOB_TYPES[job_type]
+    if not all(has_requested_tracks(data, field) for field in link_fields):
+        return jsonify({"error": f"Required fields: {', '.join(link_fields)} "
+                                 f"(or {', '.join(TRACK_ID_FIELDS[field] for field in link_fields)})"}), 400
 
-    response_data = {
-        "similarity_percentage": similarity_percentage
-    }
-
-    return jsonify(response_data), 200
+    # Identical jobs are the same type and options on the same playlist
+    # versions. Listed track IDs are part of the options.
+    try:
+        snapshots = [None if data.get(TRACK_ID_FIELDS[field]) else playlist_snapshot_id(data[field])
+                     for field in link_fields]
+    except SpotifyException as e:
+        return jsonify({"error": str(e)}), 400
+    options = {key: value for key, value in data.items()
+               if key not in link_fields and key not in ('type', 'stream')}
+    key = json.dumps([job_type, snapshots, options], sort_keys=True)
+
+    return jsonify(job_queue.submit(job_type, data, key)), 202
+
+@app.route('/jobs/stats', methods=['GET'])
+def job_stats():
+    return jsonify(job_queue.stats()), 200
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job), 200
+
+@app.before_request
+def start_request_metrics():
+    # Labelled by route pattern so job IDs and unknown paths don't each get
+    # their own series
+    metrics.begin(request.url_rule.rule if request.url_rule else 'unmatched')
+
+@app.after_request
+def add_timing_header(response):
+    metrics.set_status(response.status_code)
+    # A streamed response's stages run after its headers are sent
+    if METRICS_TIMING_HEADERS and metrics.current() is not None and not response.is_streamed:
+        response.headers['Server-Timing'] = metrics.server_timing()
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error):
+    current = metrics.current()
+    if current is not None and not current.streamed:
+        metrics.finish()
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    lines = metrics.render()
+
+    def gauge(name, kind, help_text, samples):
+        lines.append(f"# HELP audify_{name} {help_text}")
+        lines.append(f"# TYPE audify_{name} {kind}")
+        lines.extend(f"audify_{name}{format_labels(labels)} {value}" for labels, value in samples)
+
+    scheduler = spotify_scheduler.stats()
+    gauge('spotify_concurrency', 'gauge', "Spotify requests the scheduler currently allows in flight",
+          [((), scheduler['concurrency'])])
+    gauge('spotify_in_flight', 'gauge', "Spotify requests in flight", [((), scheduler['in_flight'])])
+    gauge('spotify_paused_seconds', 'gauge', "Seconds left to wait out a 429", [((), scheduler['paused_for'])])
+    gauge('spotify_requests_total', 'counter', "Spotify requests that were not rate limited",
+          [((), scheduler.get('requests', 0))])
+    gauge('spotify_rate_limited_total', 'counter', "Spotify requests answered with a 429",
+          [((), scheduler.get('rate_limited', 0))])
+
+    # artist_genres is the cache get_related_artist_genres reads through
+    cache = feature_store.stats()
+    gauge('feature_cache_hits_total', 'counter', "Feature cache hits, by table",
+          [((('table', table),), stats['hits']) for table, stats in cache.items()])
+    gauge('feature_cache_misses_total', 'counter', "Feature cache misses, by table",
+          [((('table', table),), stats['misses']) for table, stats in cache.items()])
+    gauge('feature_cache_hit_ratio', 'gauge', "Share of feature cache lookups that hit, by table",
+          [((('table', table),), stats['hits'] / max(1, stats['hits'] + stats['misses']))
+           for table, stats in cache.items()])
+    gauge('feature_cache_entries', 'gauge', "Entries in the feature cache, by table",
+          [((('table', table),), stats['entries']) for table, stats in cache.items()])
+
+    gauge('executor_queued_tasks', 'gauge', "Tasks waiting for a worker, by thread pool",
+          [((('pool', pool.name),), pool.queued()) for pool in (spotify_executor, batch_executor, job_queue.executor)])
+    jobs = job_queue.stats()
+    gauge('jobs', 'gauge', "Background jobs, by status",
+          [((('status', status),), jobs[status]) for status in ('queued', 'running', 'finished')])
+
+    return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
 
 if __name__ == "__main__":
     app.run()
\ No newline at end of file
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# server.py builds its Spotify client and feature cache on import
+os.environ.setdefault("CLIENT_ID", "test")
+os.environ.setdefault("CLIENT_SECRET", "test")
+os.environ.setdefault("FEATURE_CACHE_PATH", ":memory:")
+os.environ.setdefault("METRICS_ENABLED", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
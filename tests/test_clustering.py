@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+import server
+from test_request_options import UnreachableSpotify
+from test_song_data import StubSpotify, fresh_feature_store
+from test_transition_scoring import random_songs
+
+
+@pytest.mark.parametrize("method", list(server.CLUSTERING_METHODS))
+def test_clustered_optimization_orders_every_track(method):
+    songs = random_songs(150, seed=4)
+    track_ids = [f"t{i}" for i in range(len(songs))]
+    features = server.pack_song_features(songs)
+
+    order, result = server.clustered_optimize_tracks(None, track_ids, songs, features, method, 5, 0.1)
+
+    assert sorted(order.tolist()) == list(range(len(songs)))
+    assert result["clustering"]["method"] == method
+    assert sum(result["clustering"]["sizes"]) == len(songs)
+    assert result["transition_cost_after"] == pytest.approx(server.feature_path_cost(features, order))
+
+    # Clusters play one after another, slowest first
+    clusters = server.custom_clustering_algorithm(songs, 5, method)
+    runs = [clusters[order[0]]] + [clusters[b] for a, b in zip(order, order[1:]) if clusters[a] != clusters[b]]
+    assert len(runs) == len(set(runs)) == len(result["clustering"]["sizes"])
+    tempos = [features['tempo'][clusters == cluster].mean() for cluster in runs]
+    assert tempos == sorted(tempos)
+
+
+def test_clustered_optimization_sequences_within_clusters():
+    songs = random_songs(120, seed=5)
+    features = server.pack_song_features(songs)
+    order, result = server.clustered_optimize_tracks(None, list(range(120)), songs, features, 'kmedoids', 4, 0.2)
+    assert result["transition_cost_after"] < result["transition_cost_before"]
+
+
+def test_optimize_playlist_with_clustering(monkeypatch):
+    monkeypatch.setattr(server, "sp", StubSpotify(80))
+    monkeypatch.setattr(server, "library", None)
+    monkeypatch.setattr(server, "feature_store", fresh_feature_store())
+    track_ids = [f"spotify:track:track{i}" for i in range(80)]
+
+    response = server.app.test_client().post("/optimize_playlist", json={
+        "track_ids": track_ids, "clustering": "kmedoids", "clusters": 3, "time_budget": 0.1})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["clustering"]["method"] == "kmedoids"
+    assert len(body["clustering"]["sizes"]) == 3
+    assert sorted(track["uri"] for track in body["optimal_playlist"]) == \
+        sorted(track_id for track_id in track_ids if server.get_song_data(track_id) is not None)
+
+
+@pytest.mark.parametrize("body,error", [
+    ({"clustering": "fastest"}, "clustering must be one of agglomerative, kmedoids, graph"),
+    ({"clustering": ["kmedoids"]}, "clustering must be one of agglomerative, kmedoids, graph"),
+    ({"clustering": "kmedoids", "clusters": 0}, "clusters must be a whole number of at least 1"),
+])
+def test_invalid_clustering_is_a_bad_request(monkeypatch, body, error):
+    monkeypatch.setattr(server, "sp", UnreachableSpotify())
+    response = server.app.test_client().post("/optimize_playlist", json={"track_ids": ["a"], **body})
+    assert response.status_code == 400
+    assert response.get_json()["error"] == error
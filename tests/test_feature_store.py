@@ -0,0 +1,76 @@
+import pytest
+
+import server
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class GenreSpotify:
+    def __init__(self):
+        self.calls = 0
+
+    def artist_related_artists(self, artist_id):
+        self.calls += 1
+        return {'artists': [{'genres': [f"genre{self.calls}"]}]}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(server.time, "time", clock)
+    return clock
+
+
+def store(max_entries=100):
+    return server.FeatureStore(":memory:", {'tracks': 0, 'artist_genres': 60}, max_entries)
+
+
+def test_stale_rows_are_refetched(monkeypatch, clock):
+    client = GenreSpotify()
+    monkeypatch.setattr(server, "sp", client)
+    monkeypatch.setattr(server, "feature_store", store())
+
+    assert server.get_related_artist_genres("artist") == ["genre1"]
+    clock.now += 59
+    assert server.get_related_artist_genres("artist") == ["genre1"]
+    assert client.calls == 1
+
+    clock.now += 2
+    assert server.get_related_artist_genres("artist") == ["genre2"]
+    assert client.calls == 2
+    assert server.feature_store.stats()['artist_genres'] == {'hits': 1, 'misses': 2, 'entries': 1}
+
+
+def test_tables_without_ttl_never_expire(clock):
+    feature_store = store()
+    feature_store.put('tracks', "track", {'name': "Track"})
+    clock.now += 10 ** 9
+    assert feature_store.get('tracks', "track") == {'name': "Track"}
+
+
+def test_least_recently_used_rows_are_evicted(clock):
+    feature_store = store(max_entries=3)
+    for item_id in ("a", "b", "c"):
+        clock.now += 1
+        feature_store.put('tracks', item_id, item_id)
+
+    # Reading a makes b the least recently used
+    clock.now += 1
+    assert feature_store.get('tracks', "a") == "a"
+    clock.now += 1
+    feature_store.put('tracks', "d", "d")
+
+    assert feature_store.get_many('tracks', ["a", "b", "c", "d"]) == {"a": "a", "c": "c", "d": "d"}
+    assert feature_store.stats()['tracks']['entries'] == 3
+
+    clock.now += 1
+    feature_store.get('tracks', "d")
+    clock.now += 1
+    feature_store.put_many('tracks', {"e": "e", "f": "f"})
+    assert set(feature_store.get_many('tracks', ["a", "c", "d", "e", "f"])) == {"d", "e", "f"}
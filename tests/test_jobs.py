@@ -0,0 +1,98 @@
+import time
+
+import pytest
+
+import server
+
+
+def finished_events(data):
+    yield server.progress_event("sequence", 1, 1)
+    yield {"event": "result", "tracks": data['track_ids']}
+
+
+def rejected_events(data):
+    yield server.error_event("no tracks could be loaded", 400)
+
+
+def crashing_events(data):
+    yield server.progress_event("fetch", 0, None)
+    raise RuntimeError("Spotify went away")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(server, "JOB_TYPES", {
+        'optimize_playlist': (finished_events, ['playlist_link']),
+        'generate_warmup': (rejected_events, ['playlist_link']),
+        'generate_cooldown': (crashing_events, ['playlist_link']),
+    })
+    monkeypatch.setattr(server, "job_queue", server.JobQueue(1, 2))
+    return server.app.test_client()
+
+
+def wait_for(client, job_id):
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        job = client.get(f"/jobs/{job_id}").get_json()
+        if job['status'] in ('done', 'failed'):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} didn't finish")
+
+
+def test_job_lifecycle(client):
+    response = client.post("/jobs", json={"type": "optimize_playlist", "track_ids": ["a", "b"]})
+    assert response.status_code == 202
+    job = response.get_json()
+    assert job['type'] == "optimize_playlist" and job['status'] in ('queued', 'running', 'done')
+
+    job = wait_for(client, job['id'])
+    assert job['status'] == "done"
+    assert job['result'] == {"tracks": ["a", "b"]}
+    assert job['progress'] == {"stage": "sequence", "done": 1, "total": 1}
+    assert job['error'] is None
+    assert job['started_at'] <= job['finished_at']
+
+    # An identical submission gets the finished job
+    again = client.post("/jobs", json={"type": "optimize_playlist", "track_ids": ["a", "b"]}).get_json()
+    assert again['id'] == job['id']
+    assert client.get("/jobs/stats").get_json()['cache_hits'] == 1
+
+
+def test_unknown_job_is_not_found(client):
+    response = client.get("/jobs/does-not-exist")
+    assert response.status_code == 404
+    assert response.get_json() == {"error": "Unknown job"}
+
+
+@pytest.mark.parametrize("job_type,error", [
+    ("generate_warmup", "no tracks could be loaded"),
+    ("generate_cooldown", "Spotify went away"),
+])
+def test_failed_job_reports_its_error(client, job_type, error):
+    job = client.post("/jobs", json={"type": job_type, "track_ids": ["a"]}).get_json()
+    job = wait_for(client, job['id'])
+    assert job['status'] == "failed"
+    assert job['error'] == error
+    assert job['result'] is None
+
+    # Failed jobs are retried, not served again
+    retry = client.post("/jobs", json={"type": job_type, "track_ids": ["a"]}).get_json()
+    assert retry['id'] != job['id']
+    wait_for(client, retry['id'])
+    assert client.get("/jobs/stats").get_json()['failed'] == 2
+
+
+def test_invalid_submissions(client):
+    assert client.post("/jobs", json={"type": "unknown", "track_ids": ["a"]}).status_code == 400
+    assert client.post("/jobs", json={"type": "optimize_playlist"}).status_code == 400
+
+
+def test_oldest_finished_jobs_are_forgotten(client):
+    job_ids = []
+    for i in range(3):
+        job = client.post("/jobs", json={"type": "optimize_playlist", "track_ids": [f"t{i}"]}).get_json()
+        wait_for(client, job['id'])
+        job_ids.append(job['id'])
+    assert client.get(f"/jobs/{job_ids[0]}").status_code == 404
+    assert client.get(f"/jobs/{job_ids[2]}").status_code == 200
@@ -0,0 +1,93 @@
+import csv
+import json
+import os
+
+import pytest
+
+import server
+
+FIELDS = ['track_id', 'track_name', 'artists', 'album_name', 'popularity', 'track_genre',
+          'danceability', 'energy', 'key', 'loudness', 'mode', 'tempo', 'valence']
+
+
+def track_row(i, **values):
+    row = {'track_id': f"track{i}", 'track_name': f"Track {i}", 'artists': f"Artist {i % 3}",
+           'album_name': "Album", 'popularity': i, 'track_genre': "pop",
+           'danceability': 0.5, 'energy': 0.6, 'key': i % 12, 'loudness': -6.0,
+           'mode': i % 2, 'tempo': 120.0 + i, 'valence': 0.4}
+    row.update(values)
+    return row
+
+
+def write_csv(path, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    return str(path)
+
+
+def import_and_open(dataset, library_path):
+    result = server.import_library(dataset, str(library_path))
+    return result, server.LibraryStore(str(library_path))
+
+
+def leftover_build_directories(tmp_path):
+    return [name for name in os.listdir(tmp_path) if name.startswith('.')]
+
+
+def test_import_empty_dataset(tmp_path):
+    result, library = import_and_open(write_csv(tmp_path / "empty.csv", []), tmp_path / "library")
+    assert result == {'tracks': 0, 'skipped': 0, 'duplicates': 0}
+    assert len(library) == 0
+    assert library.records(["track0"]) == {}
+    assert leftover_build_directories(tmp_path) == []
+
+
+def test_import_dataset_with_every_row_skipped(tmp_path):
+    rows = [track_row(i, tempo='') for i in range(5)]
+    result, library = import_and_open(write_csv(tmp_path / "no_tempo.csv", rows), tmp_path / "library")
+    assert result == {'tracks': 0, 'skipped': 5, 'duplicates': 0}
+    assert len(library) == 0
+    with open(tmp_path / "library" / "manifest.json") as f:
+        assert json.load(f)['count'] == 0
+
+
+def test_import_reads_back_tracks(tmp_path):
+    rows = [track_row(i) for i in range(10)] + [track_row(3, track_name="Repeat"), track_row(10, key='')]
+    result, library = import_and_open(write_csv(tmp_path / "tracks.csv", rows), tmp_path / "library")
+    assert result == {'tracks': 10, 'skipped': 1, 'duplicates': 1}
+    record = library.records(["spotify:track:track3"])["spotify:track:track3"]
+    assert record['track_name'] == "Track 3"
+    assert record['audio_features']['tempo'] == 123.0
+    assert record['genres'] == ["pop"]
+
+
+def test_reimport_replaces_existing_library(tmp_path):
+    library_path = tmp_path / "library"
+    import_and_open(write_csv(tmp_path / "first.csv", [track_row(i) for i in range(20)]), library_path)
+
+    result, library = import_and_open(write_csv(tmp_path / "second.csv", [track_row(i) for i in range(3)]),
+                                      library_path)
+    assert result['tracks'] == 3
+    assert len(library) == 3
+    assert set(library.records([f"track{i}" for i in range(20)])) == {"track0", "track1", "track2"}
+    assert leftover_build_directories(tmp_path) == []
+
+
+def test_failed_reimport_keeps_existing_library(tmp_path):
+    library_path = tmp_path / "library"
+    import_and_open(write_csv(tmp_path / "first.csv", [track_row(i) for i in range(20)]), library_path)
+
+    broken = tmp_path / "broken.jsonl"
+    with open(broken, 'w') as f:
+        for i in range(4):
+            f.write(json.dumps(track_row(i)) + "\n")
+        f.write("{not json\n")
+    with pytest.raises(ValueError):
+        server.import_library(str(broken), str(library_path), chunk_size=2)
+
+    library = server.LibraryStore(str(library_path))
+    assert len(library) == 20
+    assert library.records(["track19"])["track19"]['track_name'] == "Track 19"
+    assert leftover_build_directories(tmp_path) == []
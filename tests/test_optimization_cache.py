@@ -0,0 +1,28 @@
+import numpy as np
+
+import server
+
+
+def optimization(n):
+    return server.PlaylistOptimization("snapshot", [f"t{i}" for i in range(n)], server.TrackContext(),
+                                       np.zeros((n, n)), np.arange(n))
+
+
+def test_oversized_optimization_is_not_remembered(monkeypatch):
+    monkeypatch.setattr(server, "optimizations", server.OrderedDict())
+    monkeypatch.setattr(server, "OPTIMIZATION_CACHE_MAX_ENTRIES", 100)
+
+    assert server.remember_optimization("small", optimization(10))
+    assert not server.remember_optimization("large", optimization(11))
+    assert server.get_optimization("large") is None
+    assert server.get_optimization("small") is not None
+
+
+def test_least_recently_used_optimization_is_evicted(monkeypatch):
+    monkeypatch.setattr(server, "optimizations", server.OrderedDict())
+    monkeypatch.setattr(server, "OPTIMIZATION_CACHE_MAX_ENTRIES", 100)
+
+    server.remember_optimization("first", optimization(8))
+    server.remember_optimization("second", optimization(8))
+    assert server.get_optimization("first") is None
+    assert server.get_optimization("second") is not None
@@ -0,0 +1,133 @@
+import random
+from collections import Counter
+
+import pytest
+
+import server
+
+
+def reorder(items, range_start, insert_before, range_length):
+    # Spotify's reorder: the range moves to just before the item that was at
+    # insert_before
+    block = items[range_start:range_start + range_length]
+    rest = items[:range_start] + items[range_start + range_length:]
+    at = insert_before if insert_before <= range_start else insert_before - range_length
+    return rest[:at] + block + rest[at:]
+
+
+class StubPlaylist:
+    # One playlist behind the Spotify calls write_playlist_order makes. Writes
+    # that name a snapshot must name the latest one, and no write may drop a
+    # track the target order still needs.
+
+    def __init__(self, uris, target):
+        self.uris = list(uris)
+        self.snapshot = 0
+        self.needed = Counter(uris) & Counter(target)
+        self.writes = 0
+
+    def written(self):
+        self.writes += 1
+        self.snapshot += 1
+        assert not self.needed - Counter(self.uris), "a kept track was dropped"
+        return {"snapshot_id": f"snapshot{self.snapshot}"}
+
+    def check_snapshot(self, snapshot_id):
+        assert snapshot_id == f"snapshot{self.snapshot}"
+
+    def playlist(self, playlist_id, fields=None):
+        return {"snapshot_id": f"snapshot{self.snapshot}"}
+
+    def playlist_tracks(self, playlist_id, fields=None, limit=100, offset=0):
+        items = [{"track": {"uri": uri}} for uri in self.uris[offset:offset + limit]]
+        return {"items": items, "total": len(self.uris)}
+
+    def playlist_remove_specific_occurrences_of_items(self, playlist_id, items, snapshot_id):
+        self.check_snapshot(snapshot_id)
+        positions = set()
+        for item in items:
+            for position in item["positions"]:
+                assert self.uris[position] == item["uri"]
+                positions.add(position)
+        assert len(positions) <= server.PLAYLIST_WRITE_BATCH
+        self.uris = [uri for position, uri in enumerate(self.uris) if position not in positions]
+        return self.written()
+
+    def playlist_add_items(self, playlist_id, uris):
+        assert len(uris) <= server.PLAYLIST_WRITE_BATCH
+        self.uris.extend(uris)
+        return self.written()
+
+    def playlist_reorder_items(self, playlist_id, range_start, insert_before, range_length, snapshot_id):
+        self.check_snapshot(snapshot_id)
+        self.uris = reorder(self.uris, range_start, insert_before, range_length)
+        return self.written()
+
+
+def shuffled(items, rng):
+    items = list(items)
+    rng.shuffle(items)
+    return items
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_playlist_moves_rebuild_target(seed):
+    rng = random.Random(seed)
+    current = [f"t{rng.randrange(15)}" for _ in range(rng.randrange(1, 40))]
+    target = shuffled(current, rng)
+
+    moves = server.playlist_moves(current, target)
+    for move in moves:
+        current = reorder(current, *move)
+    assert current == target
+
+
+def test_playlist_moves_leave_increasing_run_in_place():
+    current = ["a", "b", "c", "d", "e", "f"]
+    target = ["a", "c", "d", "e", "f", "b"]
+    assert server.playlist_moves(current, target) == [(1, 6, 1)]
+    assert server.playlist_moves(current, current) == []
+    assert server.playlist_moves(current, list(reversed(current)), limit=2) is None
+
+
+@pytest.mark.parametrize("seed", range(12))
+def test_write_playlist_order(seed):
+    rng = random.Random(seed)
+    n = rng.choice([5, 60, 250])
+    current = [f"spotify:track:t{rng.randrange(n)}" for _ in range(n)]
+    kept = [uri for uri in current if rng.random() < 0.9]
+    added = [f"spotify:track:new{rng.randrange(n)}" for _ in range(rng.randrange(n // 5 + 1))]
+    target = kept + added
+    target = target if seed % 3 == 0 else shuffled(target, rng) if seed % 3 == 1 else \
+        target[:1] + target[2:] + target[1:2]
+
+    client = StubPlaylist(current, target)
+    result = server.write_playlist_order(client, "playlist", target)
+
+    assert client.uris == target
+    assert result["write_calls"] == client.writes
+    assert result["strategy"] in ("moves", "rebuild")
+
+
+def test_write_playlist_order_with_duplicates():
+    current = [f"t{i % 40}" for i in range(150)]
+    current.insert(30, "solo")
+    target = [uri for uri in current[:131] if uri != "solo"] + current[132:] + ["new"]
+    target.insert(120, "solo")
+    client = StubPlaylist(current, target)
+    result = server.write_playlist_order(client, "playlist", target)
+    assert client.uris == target
+    assert result["strategy"] == "moves"
+    assert result["removed"] == 1 and result["added"] == 1
+    assert result["write_calls"] == client.writes < 4
+
+
+def test_write_playlist_order_rebuilds_when_cheaper():
+    rng = random.Random(1)
+    current = [f"t{i}" for i in range(50)]
+    target = shuffled(current, rng)
+    client = StubPlaylist(current, target)
+    result = server.write_playlist_order(client, "playlist", target)
+    assert result["strategy"] == "rebuild"
+    assert result["write_calls"] == client.writes == 2
+    assert client.uris == target
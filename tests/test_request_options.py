@@ -0,0 +1,80 @@
+import pytest
+
+import server
+
+
+class UnreachableSpotify:
+    def __getattr__(self, name):
+        raise AssertionError(f"Spotify called for an invalid request: {name}")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(server, "sp", UnreachableSpotify())
+    return server.app.test_client()
+
+
+def test_number_option():
+    assert server.number_option({}, 'time_budget', 2.0) == 2.0
+    assert server.number_option({'time_budget': 0}, 'time_budget', 2.0) == 0.0
+    assert server.number_option({'time_budget': "1.5"}, 'time_budget', 2.0) == 1.5
+    assert server.number_option({'time_budget': 100}, 'time_budget', 2.0, maximum=30) == 30
+
+
+@pytest.mark.parametrize("value", ["soon", None, [], True, -1, float("nan"), float("inf")])
+def test_number_option_rejects(value):
+    with pytest.raises(ValueError, match="time_budget must be a non-negative number"):
+        server.number_option({'time_budget': value}, 'time_budget', 2.0)
+
+
+@pytest.mark.parametrize("path,body", [
+    ("/optimize_playlist", {"track_ids": ["a"], "time_budget": "soon"}),
+    ("/optimize_playlist", {"playlist_link": "abc", "time_budget": -1}),
+    ("/optimize_batch", {"playlists": ["abc"], "time_budget": "soon"}),
+    ("/compare_playlists", {"playlist1_track_ids": ["a"], "playlist2_track_ids": ["b"],
+                            "approximate": True, "tolerance": "close"}),
+    ("/compare_playlists", {"playlist1_track_ids": ["a"], "playlist2_track_ids": ["b"], "time_budget": -2}),
+])
+def test_invalid_numbers_are_bad_requests(client, path, body):
+    response = client.post(path, json=body)
+    assert response.status_code == 400
+    assert "must be a non-negative number" in response.get_json()["error"]
+
+
+def test_integer_option():
+    assert server.integer_option({}, 'k', 1) == 1
+    assert server.integer_option({'k': 5}, 'k', 1) == 5
+    assert server.integer_option({'k': "3"}, 'k', 1) == 3
+    assert server.integer_option({'k': 2.0}, 'k', 1) == 2
+
+
+@pytest.mark.parametrize("value", ["many", None, 0, -3, 1.5, True])
+def test_integer_option_rejects(value):
+    with pytest.raises(ValueError, match="k must be a whole number of at least 1"):
+        server.integer_option({'k': value}, 'k', 1)
+
+
+@pytest.mark.parametrize("k", ["many", 0])
+def test_invalid_k_is_a_bad_request(client, k):
+    response = client.post("/find_best_transition", json={"single_track": "a", "track_ids": ["b"], "k": k})
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "k must be a whole number of at least 1"
+
+
+@pytest.mark.parametrize("path,body,error", [
+    ("/generate_warmup", {"track_ids": ["a"], "arc": "rise", "beam_width": "wide"},
+     "beam_width must be a whole number of at least 1"),
+    ("/generate_warmup", {"track_ids": ["a"], "arc": "rise", "beam_width": 2.5},
+     "beam_width must be a whole number of at least 1"),
+    ("/generate_cooldown", {"track_ids": ["a"], "arc": "fall", "beam_width": True},
+     "beam_width must be a whole number of at least 1"),
+    ("/generate_cooldown", {"track_ids": ["a"], "beam_width": 0},
+     "beam_width must be a whole number of at least 1"),
+    ("/generate_cooldown", {"track_ids": ["a"], "beam_width": 1000}, "beam_width must be between 1 and 128"),
+    ("/generate_cooldown", {"track_ids": ["a"], "max_tempo": True}, "max_tempo must be a non-negative number"),
+    ("/generate_cooldown", {"track_ids": ["a"], "max_tempo": "slow"}, "max_tempo must be a non-negative number"),
+])
+def test_invalid_arc_options_are_bad_requests(client, path, body, error):
+    response = client.post(path, json=body)
+    assert response.status_code == 400
+    assert response.get_json()["error"] == error
@@ -0,0 +1,86 @@
+import random
+
+import pytest
+from spotipy.exceptions import SpotifyException
+
+import server
+
+GENRES = ['pop', 'dance pop', 'house', 'techno', 'indie', 'rock', 'edm', 'soul']
+
+
+class StubSpotify:
+    # The parts of the Spotify client get_song_data and get_song_data_bulk
+    # use, over generated tracks. Some tracks are missing, have no duration
+    # or have no audio features, like on the real API.
+
+    def __init__(self, n, seed=0):
+        rng = random.Random(seed)
+        self.tracks_by_id = {}
+        self.features_by_id = {}
+        for i in range(n):
+            track_id = f"track{i}"
+            self.tracks_by_id[track_id] = {
+                'id': track_id,
+                'uri': f"spotify:track:{track_id}",
+                'name': f"Track {i}",
+                'duration_ms': 0 if i % 17 == 5 else 200000,
+                'popularity': rng.randrange(100),
+                'artists': [{'id': f"artist{i % 7}", 'name': f"Artist {i % 7}"}],
+                'album': {'name': f"Album {i % 11}", 'images': [{'url': f"http://img/{i}"}] if i % 4 else []},
+            }
+            self.features_by_id[track_id] = None if i % 19 == 7 else {
+                'id': track_id,
+                'key': rng.randrange(-1, 12),
+                'mode': rng.randrange(2),
+                'danceability': rng.random(),
+                'energy': rng.random(),
+                'loudness': rng.uniform(-30, 0),
+                'tempo': rng.uniform(60, 180),
+                'valence': rng.random(),
+            }
+
+    def lookup(self, items, track_id):
+        track_id = server.spotify_id(track_id)
+        if track_id not in self.tracks_by_id:
+            raise SpotifyException(400, -1, "invalid id")
+        return items[track_id]
+
+    def track(self, track_id):
+        return self.lookup(self.tracks_by_id, track_id)
+
+    def tracks(self, track_ids):
+        return {'tracks': [self.lookup(self.tracks_by_id, track_id) for track_id in track_ids]}
+
+    def audio_features(self, track_ids):
+        if isinstance(track_ids, str):
+            track_ids = [track_ids]
+        return [self.lookup(self.features_by_id, track_id) for track_id in track_ids]
+
+    def artist_related_artists(self, artist_id):
+        rng = random.Random(artist_id)
+        return {'artists': [{'genres': rng.sample(GENRES, 3)} for _ in range(4)]}
+
+
+def fresh_feature_store():
+    return server.FeatureStore(":memory:", server.FEATURE_CACHE_TTLS, server.FEATURE_CACHE_MAX_ENTRIES)
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_bulk_song_data_matches_per_track_song_data(monkeypatch, cached):
+    monkeypatch.setattr(server, "sp", StubSpotify(120))
+    monkeypatch.setattr(server, "library", None)
+    track_ids = [f"spotify:track:track{i}" for i in range(120)] + ["spotify:track:unknown"]
+
+    monkeypatch.setattr(server, "feature_store", fresh_feature_store())
+    per_track = {track_id: server.get_song_data(track_id) for track_id in track_ids}
+    per_track = {track_id: song for track_id, song in per_track.items() if song is not None}
+
+    # Cached runs read back what the per-track path stored
+    if not cached:
+        monkeypatch.setattr(server, "feature_store", fresh_feature_store())
+    bulk = server.get_song_data_bulk(track_ids)
+
+    assert list(bulk) == list(per_track)
+    assert len(bulk) < 120
+    for track_id, song in bulk.items():
+        assert song.to_dict() == per_track[track_id].to_dict()
@@ -0,0 +1,17 @@
+import gc
+
+import server
+
+
+def test_user_clients_keep_the_shared_connection_pool():
+    pools = server.spotify_session.get_adapter("https://api.spotify.com").poolmanager.pools
+    server.spotify_session.get_adapter("https://api.spotify.com").poolmanager.connection_from_url(
+        "https://api.spotify.com/v1/me")
+    assert len(pools) == 1
+
+    sp_user = server.spotify_client(auth="user-token")
+    assert sp_user.client._session is server.spotify_session
+    del sp_user
+    gc.collect()
+
+    assert len(pools) == 1
@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+import server
+
+
+class UnreachableSpotify:
+    def __getattr__(self, name):
+        raise AssertionError(f"Spotify called before the first progress event: {name}")
+
+
+def test_playlist_fetch_reports_progress_before_first_request(monkeypatch):
+    monkeypatch.setattr(server, "sp", UnreachableSpotify())
+    events = server.load_requested_tracks(
+        server.TrackContext(), {"playlist_link": "https://open.spotify.com/playlist/abc"}, "playlist_link", [])
+    assert next(events) == server.progress_event("fetch", 0, None)
+    with pytest.raises(AssertionError):
+        next(events)
+
+
+def test_optimize_playlist_reports_progress_before_snapshot_lookup(monkeypatch):
+    monkeypatch.setattr(server, "sp", UnreachableSpotify())
+    events = server.optimize_playlist_events({"playlist_link": "https://open.spotify.com/playlist/abc"})
+    assert next(events) == server.progress_event("fetch", 0, None)
+    with pytest.raises(AssertionError):
+        next(events)
+
+
+class PagedSpotify:
+    def __init__(self, total):
+        self.total = total
+
+    def playlist_tracks(self, playlist_id, fields=None, limit=100, offset=0):
+        items = [{"track": {"uri": f"spotify:track:t{i}", "id": f"t{i}"}}
+                 for i in range(offset, min(offset + limit, self.total))]
+        return {"items": items, "total": self.total}
+
+
+class RecordingExecutor:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, *args, **kwargs):
+        self.submitted.append(kwargs["offset"])
+        future = server.Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+def test_remaining_pages_are_requested_before_the_first_page_is_yielded(monkeypatch):
+    executor = RecordingExecutor()
+    monkeypatch.setattr(server, "spotify_executor", executor)
+    pages = server.get_playlist_track_pages("abc", PagedSpotify(450))
+    items, total = next(pages)
+    assert len(items) == 100 and total == 450
+    assert executor.submitted == [100, 200, 300, 400]
+    assert [item["track"]["id"] for items, _ in pages for item in items] == [f"t{i}" for i in range(100, 450)]
+
+
+def failing_events(data):
+    yield server.progress_event("fetch", 0, None)
+    raise RuntimeError("Spotify went away")
+
+
+@pytest.mark.parametrize("stream_format", ["ndjson", "sse"])
+def test_stream_ends_with_error_event_on_failure(monkeypatch, stream_format):
+    monkeypatch.setattr(server, "optimize_playlist_events", failing_events)
+    response = server.app.test_client().post(
+        "/optimize_playlist", json={"track_ids": ["a"], "stream": stream_format})
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    if stream_format == "ndjson":
+        events = [json.loads(line) for line in body.splitlines()]
+    else:
+        events = [json.loads(line[len("data: "):]) for line in body.splitlines() if line.startswith("data: ")]
+    assert events == [server.progress_event("fetch", 0, None),
+                      server.error_event("Spotify went away", 500)]
@@ -0,0 +1,54 @@
+import random
+
+import numpy as np
+import pytest
+
+import server
+from test_transition_scoring import random_songs
+
+
+def graph_over(songs_by_id, track_ids, k):
+    features = server.pack_song_features([songs_by_id[track_id] for track_id in track_ids])
+    return features, server.TransitionGraph.build(track_ids, features, k)
+
+
+def assert_same_graph(graph, expected):
+    assert graph.track_ids == expected.track_ids
+    np.testing.assert_array_equal(graph.indptr, expected.indptr)
+    np.testing.assert_array_equal(graph.indices, expected.indices)
+    np.testing.assert_allclose(graph.costs, expected.costs)
+
+
+@pytest.mark.parametrize("n,k", [(300, 16), (40, 8), (6, 8)])
+def test_update_matches_rebuild(n, k):
+    rng = random.Random(n)
+    songs_by_id = {f"t{i}": song for i, song in enumerate(random_songs(2 * n, seed=n))}
+    pool = list(songs_by_id)
+    track_ids = pool[:n]
+    _, graph = graph_over(songs_by_id, track_ids, k)
+
+    # Removals, additions, both at once, and a reordering
+    for step in range(4):
+        kept = [track_id for track_id in track_ids if rng.random() > (0.2 if step != 1 else 0)]
+        unused = [track_id for track_id in pool if track_id not in set(track_ids)]
+        added = rng.sample(unused, min(len(unused), n // 5 + 1)) if step else []
+        track_ids = kept + added
+        if step == 3:
+            rng.shuffle(track_ids)
+
+        features, expected = graph_over(songs_by_id, track_ids, k)
+        graph = graph.update(track_ids, features)
+        assert_same_graph(graph, expected)
+
+
+def test_update_reuses_untouched_rows():
+    songs_by_id = {f"t{i}": song for i, song in enumerate(random_songs(120, seed=3))}
+    track_ids = list(songs_by_id)[:100]
+    _, graph = graph_over(songs_by_id, track_ids, 8)
+
+    track_ids = track_ids + list(songs_by_id)[100:]
+    features, expected = graph_over(songs_by_id, track_ids, 8)
+    updated = graph.update(track_ids, features)
+    assert updated.rows_reused == 100
+    assert_same_graph(updated, expected)
+    assert updated.update(track_ids, features) is updated
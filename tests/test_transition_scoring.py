@@ -0,0 +1,119 @@
+import random
+
+import numpy as np
+import pytest
+
+import server
+
+# The key rules and scoring as they were before KEY_PENALTY, kept here as the
+# reference the table has to reproduce, apart from key -1, which is neutral
+
+CIRCLE_OF_FIFTHS = [0, 7, 2, 9, 4, 11, 6, 1, 8, 3, 10, 5]
+
+
+def baseline_relative_key(key, mode):
+    return (key + 9) % 12 if mode == 1 else (key + 3) % 12
+
+
+def baseline_key_compatibility(key1, mode1, key2, mode2):
+    if key1 == key2:
+        return True
+    if mode1 != mode2 and (key1 == baseline_relative_key(key2, mode2)
+                           or key2 == baseline_relative_key(key1, mode1)):
+        return True
+    index1 = CIRCLE_OF_FIFTHS.index(key1)
+    index2 = CIRCLE_OF_FIFTHS.index(key2)
+    steps = min(abs(index1 - index2), 12 - abs(index1 - index2))
+    return (mode1 == mode2 and steps <= 2) or (mode1 != mode2 and steps <= 1)
+
+
+def reference_compatible(key1, mode1, key2, mode2):
+    # Key -1 (no key detected) has no key term at all
+    if key1 < 0 or key2 < 0:
+        return True
+    return baseline_key_compatibility(key1, mode1, key2, mode2)
+
+
+def baseline_evaluate_transition(song1, song2):
+    weights = {'danceability': 7, 'energy': 5, 'loudness': 1, 'tempo': 100, 'valence': 5, 'genre': 4}
+    score = 0
+    if not reference_compatible(song1['key'], song1['mode'], song2['key'], song2['mode']):
+        score += 6
+    diff = {}
+    for attribute in weights:
+        if attribute == 'genre':
+            shared = len(set(song1['genre']).intersection(song2['genre'])) if song1['genre'] and song2['genre'] else 0
+            diff[attribute] = 5 - min(shared, 5)
+        else:
+            diff[attribute] = abs(song1[attribute] - song2[attribute])
+    diff['loudness'] /= 60
+    diff['tempo'] = min(
+        abs(song1['tempo'] - song2['tempo']),
+        abs(song1['tempo'] * 2 - song2['tempo']),
+        abs(song1['tempo'] / 2 - song2['tempo'])
+    ) / 200
+    for attribute in weights:
+        score += weights[attribute] * diff[attribute]
+    return score
+
+
+KEYS_AND_MODES = [(key, mode) for key in range(-1, 12) for mode in (0, 1)]
+GENRES = ['pop', 'dance pop', 'house', 'techno', 'indie', 'rock', 'edm', 'soul']
+
+
+def random_songs(n, seed=0):
+    rng = random.Random(seed)
+    return [{
+        'key': rng.randrange(-1, 12),
+        'mode': rng.randrange(2),
+        'danceability': rng.random(),
+        'energy': rng.random(),
+        'loudness': rng.uniform(-30, 0),
+        'tempo': rng.uniform(60, 180),
+        'valence': rng.random(),
+        'genre': rng.sample(GENRES, rng.randrange(4)),
+    } for _ in range(n)]
+
+
+@pytest.mark.parametrize("key1,mode1", KEYS_AND_MODES)
+def test_key_penalty_table_matches_baseline_rules(key1, mode1):
+    for key2, mode2 in KEYS_AND_MODES:
+        expected = 0.0 if reference_compatible(key1, mode1, key2, mode2) else 6.0
+        assert server.KEY_PENALTY[server.key_index(key1, mode1), server.key_index(key2, mode2)] == expected
+        assert server.key_compatibility(key1, mode1, key2, mode2) == (expected == 0.0)
+
+
+@pytest.mark.parametrize("mode", [0, 1])
+def test_no_key_is_neutral(mode):
+    # No key detected adds no penalty against any key, in either direction
+    assert server.key_index(-1, mode) == server.NO_KEY
+    assert not server.KEY_PENALTY[server.NO_KEY].any()
+    assert not server.KEY_PENALTY[:, server.NO_KEY].any()
+
+    # A no-key song costs what it would in the other song's own key
+    song1, song2 = random_songs(2)
+    no_key = dict(song1, key=-1, mode=mode)
+    for key, other_mode in KEYS_AND_MODES[2:]:
+        other = dict(song2, key=key, mode=other_mode)
+        in_same_key = dict(song1, key=key, mode=other_mode)
+        assert server.evaluate_transition(no_key, other) == baseline_evaluate_transition(in_same_key, other)
+        assert server.evaluate_transition(other, no_key) == baseline_evaluate_transition(other, in_same_key)
+
+    songs = [no_key] + [dict(song2, key=key, mode=other_mode) for key, other_mode in KEYS_AND_MODES]
+    costs = server.transition_cost_matrix(server.pack_song_features(songs))
+    assert costs[0, 1:].tolist() == [server.evaluate_transition(no_key, song) for song in songs[1:]]
+    assert costs[1:, 0].tolist() == [server.evaluate_transition(song, no_key) for song in songs[1:]]
+
+
+def test_evaluate_transition_matches_baseline():
+    songs = random_songs(300)
+    for song1 in songs[:60]:
+        for song2 in songs:
+            assert server.evaluate_transition(song1, song2) == baseline_evaluate_transition(song1, song2)
+
+
+def test_transition_cost_matrix_matches_baseline():
+    songs = random_songs(200, seed=1)
+    costs = server.transition_cost_matrix(server.pack_song_features(songs))
+    expected = np.array([[baseline_evaluate_transition(song1, song2) for song2 in songs] for song1 in songs])
+    np.testing.assert_array_equal(costs, expected)